@@ -0,0 +1,130 @@
+"""
+Measures recall of the nearest-neighbour index from utils.ann_index against brute-force search:
+share of the true k nearest modules (by cosine distance) found by the index, and time per query.
+
+Usage: python -m benchmarks.ann_index [--store PATH] [--modules N] [--queries Q] [--k K]
+--store should point to an embeddings store of detect_similarity without extension (e.g. WE_embeddings);
+without it, synthetic embeddings are generated: clusters of modules around random centers,
+with groups of exact copies, as modules copied between wikis.
+"""
+
+import time
+import argparse
+
+import numpy as np
+
+from utils.ann_index import AnnIndex, normalize
+from utils.embedding_store import EmbeddingStore
+
+
+def make_embeddings(n_modules, dim, rng):
+    """
+    :return: float32 matrix of n_modules embeddings
+    """
+    centers = rng.normal(size=(max(n_modules // 100, 1), dim))
+    vectors = centers[rng.integers(len(centers), size=n_modules)]
+    vectors += 0.3 * rng.normal(size=vectors.shape)
+    # a tenth of the modules are copies of others
+    copies = rng.integers(n_modules, size=n_modules // 10)
+    vectors[rng.integers(n_modules, size=len(copies))] = vectors[copies]
+    return vectors.astype(np.float32)
+
+
+def brute_force(normalized, row, k):
+    """
+    :return: rows of the k nearest neighbours of the row and their distances
+    """
+    distances = 1 - normalized.dot(normalized[row])
+    distances[row] = np.inf
+    nearest = np.argpartition(distances, k)[:k]
+    return nearest, distances[nearest]
+
+
+def recall(true_distances, distances):
+    """
+    Share of the true neighbours found; neighbours at the same distance as the k-th one are interchangeable,
+    which matters for exact copies.
+    """
+    found = np.sum(distances <= true_distances.max() + 1e-6)
+    return min(found, len(true_distances)) / len(true_distances)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the nearest-neighbour index against brute-force search."
+    )
+    parser.add_argument("--store", type=str, help="Path of the embeddings store.")
+    parser.add_argument(
+        "--modules", type=int, default=200000, help="Number of synthetic modules."
+    )
+    parser.add_argument(
+        "--dim", type=int, default=32, help="Size of synthetic embeddings."
+    )
+    parser.add_argument("--queries", type=int, default=500, help="Number of queries.")
+    parser.add_argument("--k", type=int, default=10, help="Number of neighbours.")
+    parser.add_argument(
+        "--trees", type=int, nargs="+", default=[5, 10, 20], help="Numbers of trees."
+    )
+    parser.add_argument(
+        "--search-k",
+        type=int,
+        nargs="+",
+        default=[100, 500, 2000],
+        help="Numbers of candidates compared exactly.",
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.store:
+        vectors = EmbeddingStore(args.store).vectors
+    else:
+        vectors = make_embeddings(args.modules, args.dim, rng)
+    normalized = normalize(vectors)
+    queries = rng.choice(
+        len(vectors), size=min(args.queries, len(vectors)), replace=False
+    )
+    print("%d modules, %d queries, k = %d" % (len(vectors), len(queries), args.k))
+
+    start = time.perf_counter()
+    truth = [brute_force(normalized, row, args.k) for row in queries]
+    print(
+        "brute force %8.3f ms/query"
+        % ((time.perf_counter() - start) / len(queries) * 1000)
+    )
+
+    for n_trees in args.trees:
+        start = time.perf_counter()
+        index = AnnIndex.build(vectors, n_trees=n_trees)
+        build_time = time.perf_counter() - start
+        size = sum(
+            array.nbytes
+            for array in [
+                index.normals,
+                index.offsets,
+                index.children,
+                index.leaf_bounds,
+                index.leaf_items,
+            ]
+        )
+        print(
+            "%2d trees: built in %.2f s, %.1f MB" % (n_trees, build_time, size / 2**20)
+        )
+        for search_k in args.search_k:
+            total = 0
+            start = time.perf_counter()
+            results = [
+                index.query(vectors, vectors[row], args.k, search_k, exclude=[row])
+                for row in queries
+            ]
+            elapsed = time.perf_counter() - start
+            for (_, distances), (_, true_distances) in zip(results, truth):
+                total += recall(true_distances, distances)
+            print(
+                "    search_k %5d: recall@%d %.3f   %8.3f ms/query"
+                % (
+                    search_k,
+                    args.k,
+                    total / len(queries),
+                    elapsed / len(queries) * 1000,
+                )
+            )
@@ -0,0 +1,97 @@
+"""
+Compares the clustering backends of utils.clustering, used by detect_similarity --clustering:
+runtime, peak memory allocated while clustering (numpy and python objects, measured with tracemalloc),
+number of clusters and share of noise modules, and agreement of the clusters with OPTICS
+(adjusted Rand index and normalized mutual information over the modules, which OPTICS clustered).
+
+Usage: python -m benchmarks.clustering [--store PATH] [--modules N] [--backends NAME ...]
+--store should point to an embeddings store of detect_similarity without extension (e.g. WE_embeddings);
+without it, synthetic embeddings are generated. OPTICS takes quadratic time, so keep --modules modest
+or leave it out of --backends for big stores (agreement is not reported then).
+"""
+
+import time
+import argparse
+import tracemalloc
+
+import numpy as np
+from sklearn.metrics import adjusted_rand_score, normalized_mutual_info_score
+
+from utils.clustering import CLUSTERING_BACKENDS
+from utils.embedding_store import EmbeddingStore
+from benchmarks.ann_index import make_embeddings
+
+
+def measure(backend, X):
+    """
+    :return: (labels, seconds, peak memory in bytes)
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    labels, _, _ = CLUSTERING_BACKENDS[backend](X)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return labels, elapsed, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the clustering backends against OPTICS."
+    )
+    parser.add_argument("--store", type=str, help="Path of the embeddings store.")
+    parser.add_argument(
+        "--modules",
+        type=int,
+        default=20000,
+        help="Number of synthetic modules, or of the modules sampled from the store.",
+    )
+    parser.add_argument(
+        "--dim", type=int, default=32, help="Size of synthetic embeddings."
+    )
+    parser.add_argument(
+        "--backends",
+        nargs="+",
+        choices=list(CLUSTERING_BACKENDS),
+        default=list(CLUSTERING_BACKENDS),
+        help="Backends to compare.",
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.store:
+        vectors = EmbeddingStore(args.store).vectors
+        rows = np.sort(
+            rng.choice(len(vectors), min(args.modules, len(vectors)), replace=False)
+        )
+        X = np.asarray(vectors[rows])
+    else:
+        X = make_embeddings(args.modules, args.dim, rng)
+    print("%d modules" % len(X))
+
+    reference = None
+    for backend in ["optics"] + [name for name in args.backends if name != "optics"]:
+        if backend not in args.backends:
+            continue
+        labels, elapsed, peak = measure(backend, X)
+        line = "%-12s %8.2f s %9.1f MB   %6d clusters %7d noise (%5.1f%%)" % (
+            backend,
+            elapsed,
+            peak / 2**20,
+            labels.max() + 1,
+            (labels < 0).sum(),
+            100 * (labels < 0).mean(),
+        )
+        if backend == "optics":
+            reference = labels
+        elif reference is not None:
+            clustered = reference >= 0
+            # noise modules are counted as clusters of their own
+            compared = np.where(
+                labels >= 0, labels, labels.max() + 1 + np.arange(len(labels))
+            )
+            line += "   ARI %.3f   NMI %.3f" % (
+                adjusted_rand_score(reference[clustered], compared[clustered]),
+                normalized_mutual_info_score(reference[clustered], compared[clustered]),
+            )
+        print(line)
@@ -0,0 +1,76 @@
+"""
+Compares building dataframes from pymysql rows with applymap(encode_if_necessary)
+and with rows_to_dataframe, which decodes only the text columns.
+
+Usage: python -m benchmarks.decode_rows [--rows N] [--length L] [--repeat R]
+"""
+import time
+import random
+import datetime
+import argparse
+import pandas as pd
+from utils.db_query import encode_if_necessary, rows_to_dataframe
+
+COLS = ["page_id", "dbname", "sourcecode", "length", "touched"]
+
+
+def make_rows(n_rows, length):
+    """
+    Generates rows, shaped like the ones pymysql returns for Scripts table.
+
+    :param n_rows: number of rows.
+    :param length: length of the sourcecode in every row.
+    :return: list of tuples
+    """
+    random.seed(0)
+    text = ("local p = {} -- ümlaut\n" * (length // 24 + 1))[:length].encode("utf8")
+    start = datetime.datetime(2021, 1, 1)
+    return [
+        (
+            i,
+            random.choice([b"enwiki", b"dewiki", b"ruwiktionary"]),
+            text,
+            length,
+            start + datetime.timedelta(seconds=i),
+        )
+        for i in range(n_rows)
+    ]
+
+
+def old_path(rows):
+    return pd.DataFrame(rows, columns=COLS).applymap(encode_if_necessary)
+
+
+def new_path(rows):
+    return rows_to_dataframe(rows, COLS, ["dbname", "sourcecode"])
+
+
+def measure(func, rows, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        df = func(rows)
+        best = min(best, time.perf_counter() - start)
+    return best, df
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmark of decoding query results into dataframes."
+    )
+    parser.add_argument("--rows", type=int, default=100000, help="Number of rows.")
+    parser.add_argument(
+        "--length", type=int, default=2000, help="Length of every sourcecode."
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs.")
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows, args.length)
+    old_time, old_df = measure(old_path, rows, args.repeat)
+    new_time, new_df = measure(new_path, rows, args.repeat)
+
+    assert old_df.equals(new_df), "Results differ"
+    print("applymap(encode_if_necessary): %.3f s" % old_time)
+    print("rows_to_dataframe:             %.3f s" % new_time)
+    print("Speedup: %.1fx" % (old_time / new_time))
+    print("Dtypes:", dict(new_df.dtypes.astype(str)))
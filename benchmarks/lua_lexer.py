@@ -0,0 +1,145 @@
+"""
+Compares the regex comment stripper, which utils.sourcecode_processing used before,
+with the Lua lexer: time of detecting data modules and of tokenizing for similarity detection,
+and the number of modules on which they disagree. Also checks that the lexer keeps
+number literals of all the Lua forms whole.
+
+Usage: python -m benchmarks.lua_lexer [--files DIR] [--modules N] [--repeat R]
+--files should point to a directory with real module bodies, one per file
+(e.g. dumped from Sourcecodes table); without it, synthetic modules are generated.
+"""
+
+import re
+import time
+import random
+import argparse
+from benchmarks.sourcecode_codec import make_module, load_modules
+from utils.sourcecode_processing import tokenize, check_if_data_function, get_words
+
+# Lua number literals, each of which must be a single token
+NUMBERS = [
+    "3",
+    "345",
+    "3.",
+    "3.0",
+    "3.1416",
+    ".5",
+    "3.e5",
+    "314.16e-2",
+    "0.31416E1",
+    "34e1",
+    "0xff",
+    "0xA.",
+    "0x.1E",
+    "0xA23p-4",
+    "0X1.921FB54442D18P+1",
+]
+
+
+def old_remove_comments(code):
+    no_comments_code = re.sub(r"--\[\[[\s\S]*\]\]|--\[=\[[\s\S]*\]=\]|--.*", "", code)
+    return re.sub(r"^\s*", "", no_comments_code, flags=re.MULTILINE)
+
+
+def old_is_data(code):
+    return bool(re.match(r"^return\s*{[\s\S]*$", old_remove_comments(code)))
+
+
+def old_words(code):
+    return re.findall(r"(?u)\w+|[^\w\s]", code)
+
+
+def new_is_data(code):
+    return check_if_data_function(code)
+
+
+def new_words(code):
+    return get_words(tokenize(code))
+
+
+def make_corpus(n_modules):
+    """
+    Generates modules with comments in various places, a third of them being data modules.
+
+    :param n_modules: number of modules.
+    :return: list of str
+    """
+    modules = []
+    for i in range(n_modules):
+        body = make_module(min(int(random.paretovariate(1.2) * 1000), 200000))
+        header = "--[[\nDocumentation of the module %d.\n]]\n" % i
+        if i % 3 == 0:
+            body = "return {\n" + body.replace("local p = {}", "--[=[ data ]=]") + "\n}"
+        body = body.replace(
+            "return p",
+            '-- "--[[" in a comment\nlocal s = "-- not a comment"\n'
+            "local n = 3. + 3.e5 + .5\nreturn p",
+        )
+        modules.append(header + body)
+    return modules
+
+
+def check_numbers():
+    """
+    :return: list of the literals, which the lexer splits, with their tokens
+    """
+    split = []
+    for number in NUMBERS:
+        tokens = tokenize("x = %s + 1" % number)
+        if tokens[2] != ("number", number):
+            split.append((number, tokens[2:-2]))
+    return split
+
+
+def measure(function, modules, repeat):
+    """
+    :return: (best time of the runs, results of the last run)
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [function(module) for module in modules]
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark of the Lua lexer against the regex comment stripper."
+    )
+    parser.add_argument("--files", type=str, help="Directory with module sourcecodes.")
+    parser.add_argument(
+        "--modules", type=int, default=5000, help="Number of synthetic modules."
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs.")
+    args = parser.parse_args()
+
+    random.seed(0)
+    modules = load_modules(args.files) if args.files else make_corpus(args.modules)
+    print(
+        "%d modules, %d characters in total"
+        % (len(modules), sum(len(module) for module in modules))
+    )
+
+    split = check_numbers()
+    print(
+        "numbers  %d of %d literals kept whole%s"
+        % (
+            len(NUMBERS) - len(split),
+            len(NUMBERS),
+            "".join("\n    %s split into %s" % case for case in split),
+        )
+    )
+
+    for task, old, new in [
+        ("is_data", old_is_data, new_is_data),
+        ("tokens", old_words, new_words),
+    ]:
+        old_time, old_results = measure(old, modules, args.repeat)
+        new_time, new_results = measure(new, modules, args.repeat)
+        differ = sum(a != b for a, b in zip(old_results, new_results))
+        print(
+            "%-8s regex %8.3f s   lexer %8.3f s   differ on %d modules"
+            % (task, old_time, new_time, differ)
+        )
@@ -0,0 +1,267 @@
+"""
+Compares storing sourcecodes as plain TEXT and compressed with utils.sourcecode_codec:
+bytes transferred from the database and end-to-end time of reading them.
+
+With --database, the modules are written into temporary scratch tables of the user database
+(MEDIUMTEXT for plain TEXT, MEDIUMBLOB for the codecs) and read back with
+`SELECT sourcecode` (`SELECT LEFT(sourcecode, MAXLEN)` for TEXT), the way the tools read Sourcecodes;
+transferred bytes are the server's Bytes_sent counter of the session, and end-to-end time covers
+the query, fetching the rows and decoding them. The tables disappear with the connection.
+Without --database, the numbers are a model estimate: stored bytes over a link of the given bandwidth
+plus measured decoding time.
+
+Usage: python -m benchmarks.sourcecode_codec [--files DIR] [--modules N] [--database [-udb PORT -u USER -p PASS]]
+       python -m benchmarks.sourcecode_codec [--files DIR] [--modules N] [--bandwidth MBIT]
+Without --files, synthetic modules are generated; real ones (e.g. dumped *.lua files) compress worse
+than the synthetic ones, so use them for more realistic numbers.
+"""
+
+import os
+import time
+import random
+import argparse
+import utils.sourcecode_codec as codec
+import utils.db_access as db_acc
+from utils.db_query import close_conn
+from constants import DATABASE_NAME
+
+MAXLEN = 20000  # same as detect_similarity.MAXLEN
+INSERT_BATCH = 100  # modules written into the scratch table with one statement
+
+WORDS = [
+    "args",
+    "frame",
+    "title",
+    "value",
+    "data",
+    "name",
+    "lang",
+    "item",
+    "label",
+    "link",
+]
+
+
+def make_module(length):
+    """
+    Generates Lua-like module of approximately the given length.
+
+    :param length: number of characters.
+    :return: str
+    """
+    lines = ["local p = {}", ""]
+    size = 0
+    while size < length:
+        if random.random() < 0.5:
+            line = '    ["%s_%d"] = "%s",' % (
+                random.choice(WORDS),
+                random.randint(0, 10**6),
+                " ".join(random.choices(WORDS, k=random.randint(1, 6))),
+            )
+        else:
+            line = "    local %s = %s(%s.%s, %d)" % (
+                random.choice(WORDS),
+                random.choice(WORDS),
+                random.choice(WORDS),
+                random.choice(WORDS),
+                random.randint(0, 1000),
+            )
+        lines.append(line)
+        size += len(line) + 1
+    lines.append("return p")
+    return "\n".join(lines)
+
+
+def load_modules(directory):
+    """
+    :param directory: directory with module sourcecodes, one per file.
+    :return: list of str
+    """
+    modules = []
+    for name in sorted(os.listdir(directory)):
+        with open(os.path.join(directory, name), encoding="utf8") as file:
+            modules.append(file.read())
+    return modules
+
+
+def measure(modules, codec_name, bandwidth):
+    """
+    Model estimate, which doesn't touch the database.
+
+    :param modules: list of sourcecodes.
+    :param codec_name: codec to store the sourcecodes with.
+    :param bandwidth: link speed in bytes per second.
+    :return: (bytes transferred, decoding seconds, end-to-end seconds)
+    """
+    if codec_name == "text":
+        # plain TEXT column, truncated by the database with LEFT(sourcecode, MAXLEN)
+        stored = [module[:MAXLEN].encode("utf8") for module in modules]
+        start = time.perf_counter()
+        decoded = [value.decode("utf8") for value in stored]
+    else:
+        stored = [codec.encode(module, codec_name) for module in modules]
+        start = time.perf_counter()
+        decoded = codec.decode_column(stored, MAXLEN)
+    decode_time = time.perf_counter() - start
+
+    assert decoded == [module[:MAXLEN] for module in modules]
+    transferred = sum(len(value) for value in stored)
+    return transferred, decode_time, transferred / bandwidth + decode_time
+
+
+def bytes_sent(cur):
+    """
+    :return: number of bytes the server has sent in this session
+    """
+    cur.execute("SHOW SESSION STATUS LIKE 'Bytes_sent'")
+    return int(cur.fetchone()[1])
+
+
+def measure_database(conn, modules, codec_name, repeat):
+    """
+    Writes the modules into a temporary table and times reading them back.
+
+    :param conn: connection to the user database; the table lives while it is open.
+    :param modules: list of sourcecodes.
+    :param codec_name: codec to store the sourcecodes with, "text" for plain TEXT column.
+    :param repeat: number of reads; the fastest one is reported.
+    :return: (bytes transferred, decoding seconds, end-to-end seconds)
+    """
+    table = "CodecBenchmark_" + codec_name
+    column = "mediumtext" if codec_name == "text" else "mediumblob"
+    with conn.cursor() as cur:
+        cur.execute("DROP TEMPORARY TABLE IF EXISTS %s" % table)
+        cur.execute(
+            "CREATE TEMPORARY TABLE %s (id int PRIMARY KEY, sourcecode %s)"
+            % (table, column)
+        )
+        for i in range(0, len(modules), INSERT_BATCH):
+            cur.executemany(
+                "INSERT INTO %s VALUES (%%s, %%s)" % table,
+                [
+                    (
+                        i + j,
+                        (
+                            module
+                            if codec_name == "text"
+                            else codec.encode(module, codec_name)
+                        ),
+                    )
+                    for j, module in enumerate(modules[i : i + INSERT_BATCH])
+                ],
+            )
+        conn.commit()
+
+        if codec_name == "text":
+            query = "SELECT LEFT(sourcecode, %d) FROM %s ORDER BY id" % (MAXLEN, table)
+        else:
+            query = "SELECT sourcecode FROM %s ORDER BY id" % table
+        best = None
+        for _ in range(repeat):
+            sent = bytes_sent(cur)
+            start = time.perf_counter()
+            cur.execute(query)
+            values = [row[0] for row in cur.fetchall()]
+            fetched = time.perf_counter()
+            decoded = codec.decode_column(values, MAXLEN)
+            end = time.perf_counter()
+            # the counter itself is read with a query, whose own response is small
+            transferred = bytes_sent(cur) - sent
+            if best is None or end - start < best[2]:
+                best = (transferred, end - fetched, end - start)
+        cur.execute("DROP TEMPORARY TABLE %s" % table)
+
+    assert decoded == [module[:MAXLEN] for module in modules]
+    return best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark of compressed sourcecode storage against plain TEXT."
+    )
+    parser.add_argument("--files", type=str, help="Directory with module sourcecodes.")
+    parser.add_argument(
+        "--modules", type=int, default=20000, help="Number of synthetic modules."
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        default=100,
+        help="Speed of the link to the database for the model estimate, Mbit/s.",
+    )
+    parser.add_argument(
+        "--database",
+        "-db",
+        action="store_true",
+        help="Whether to measure real reads from scratch tables of the user database.",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=3, help="Number of reads from the database."
+    )
+    local_data = parser.add_argument_group(
+        title="Info for connecting to Toolforge from local pc"
+    )
+    local_data.add_argument(
+        "--user-db-port",
+        "-udb",
+        type=int,
+        default=None,
+        help="Port for connecting to tables, created by user in Toolforge, "
+        "through ssh tunneling, if used.",
+    )
+    local_data.add_argument(
+        "--user", "-u", type=str, default=None, help="Toolforge username of the tool."
+    )
+    local_data.add_argument(
+        "--password",
+        "-p",
+        type=str,
+        default=None,
+        help="Toolforge password of the tool.",
+    )
+    args = parser.parse_args()
+
+    random.seed(0)
+    if args.files:
+        modules = load_modules(args.files)
+    else:
+        # most modules are small, some are very big
+        modules = [
+            make_module(min(int(random.paretovariate(1.2) * 1000), 400000))
+            for _ in range(args.modules)
+        ]
+    bandwidth = args.bandwidth * 10**6 / 8
+
+    print(
+        "%d modules, %d characters in total"
+        % (len(modules), sum(len(module) for module in modules))
+    )
+    if args.database:
+        print("Measured reads from the user database:")
+        # a connection of its own, so the temporary tables are dropped with it
+        conn = db_acc.open_user_database(
+            DATABASE_NAME, args.user_db_port, args.user, args.password
+        )
+    else:
+        print("Model estimate for a %.0f Mbit/s link:" % args.bandwidth)
+        conn = None
+    print(
+        "%-6s %14s %12s %14s" % ("codec", "transferred", "decode, s", "end-to-end, s")
+    )
+    try:
+        for codec_name in ["text"] + codec.available_codecs():
+            if conn:
+                transferred, decode_time, total = measure_database(
+                    conn, modules, codec_name, args.repeat
+                )
+            else:
+                transferred, decode_time, total = measure(
+                    modules, codec_name, bandwidth
+                )
+            print(
+                "%-6s %12.1f MB %12.3f %14.3f"
+                % (codec_name, transferred / 10**6, decode_time, total)
+            )
+    finally:
+        if conn:
+            close_conn(conn)
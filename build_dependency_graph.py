@@ -0,0 +1,305 @@
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import utils.db_access as db_acc
+from utils.db_query import (
+    query_data_generator,
+    rows_to_dataframe,
+    bulk_upsert,
+    bulk_update,
+    close_conn,
+    df_to_rows,
+    BATCH_SIZE,
+)
+from utils.sourcecode_processing import get_features
+from utils.sourcecode_codec import decode
+from utils.dependency_graph import resolve_dependencies, count_dependents
+from constants import DATABASE_NAME
+
+WORKERS = 4
+CHUNK_SIZE = 500  # sourcecodes fetched, parsed and saved at once
+POOL_CHUNK_SIZE = 20  # sourcecodes sent to a worker process at once
+
+
+def get_required(data):
+    """
+    Decodes stored sourcecode and finds modules it loads; run in worker processes.
+
+    :param data: sourcecode, as stored in Sourcecodes table.
+    :return: list of names of the loaded modules, e.g. ["Module:Arguments"]
+    """
+    return get_features(decode(data))["required"]
+
+
+def save_edges(hashes, required, user_db_port=None, user=None, password=None):
+    """
+    Replaces edges of the modules with the given sourcecodes in Dependencies table,
+    marking the modules as parsed with graph_hash.
+
+    :param hashes: list of content_hash of the parsed sourcecodes.
+    :param required: list of lists of names of the modules, loaded by each of the sourcecodes.
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :return: number of updated modules
+    """
+    required = dict(zip(hashes, required))
+    conn = db_acc.connect_to_user_database(DATABASE_NAME, user_db_port, user, password)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT page_id, dbname, content_hash FROM Scripts "
+                "WHERE content_hash IN (%s) AND NOT (graph_hash <=> content_hash)"
+                % ", ".join(["%s"] * len(hashes)),
+                hashes,
+            )
+            pages = rows_to_dataframe(
+                cur.fetchall(), ["page_id", "dbname", "content_hash"]
+            )
+
+            keys = [
+                [page_id, dbname]
+                for page_id, dbname in pages[["page_id", "dbname"]].values
+            ]
+            for i in range(0, len(keys), BATCH_SIZE):
+                batch = keys[i : i + BATCH_SIZE]
+                cur.execute(
+                    "DELETE FROM Dependencies WHERE (page_id, dbname) IN (%s)"
+                    % ", ".join(["(%s, %s)"] * len(batch)),
+                    [value for key in batch for value in key],
+                )
+
+            edges = [
+                [dbname, page_id, dependency]
+                for page_id, dbname, content_hash in pages.values
+                for dependency in required[content_hash]
+            ]
+            bulk_upsert(
+                cur,
+                "Dependencies",
+                ["dbname", "page_id", "dependency"],
+                edges,
+                ["dependency"],
+            )
+            bulk_update(
+                cur,
+                "Scripts",
+                ["page_id", "dbname"],
+                ["graph_hash"],
+                pages.values.tolist(),
+            )
+        conn.commit()
+    finally:
+        close_conn(conn)
+    return len(pages)
+
+
+def update_edges(
+    full_run=False, user_db_port=None, user=None, password=None, workers=WORKERS
+):
+    """
+    Parses require/mw.loadData calls out of sourcecodes of the modules, which changed since they were parsed
+    (or of all the modules, if full_run), and saves them as edges into Dependencies table.
+    Every distinct sourcecode is parsed once.
+
+    :param full_run: whether to parse all the modules, even the unchanged ones.
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :param workers: number of processes parsing sourcecodes; 1 to parse them in this process.
+    :return: None
+    """
+    if full_run:
+        conn = db_acc.connect_to_user_database(
+            DATABASE_NAME, user_db_port, user, password
+        )
+        with conn.cursor() as cur:
+            cur.execute("UPDATE Scripts SET graph_hash = NULL")
+        conn.commit()
+        close_conn(conn)
+
+    query = (
+        "SELECT content_hash, sourcecode "
+        "FROM Sourcecodes "
+        "WHERE {keyset} AND content_hash IN "
+        "    (SELECT content_hash FROM Scripts WHERE NOT (graph_hash <=> content_hash))"
+    )
+    updated = 0
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    try:
+        for df in query_data_generator(
+            query,
+            "build_dependency_graph",
+            ["content_hash", "sourcecode"],
+            db="user_db",
+            replicas=False,
+            user_db_port=user_db_port,
+            user=user,
+            password=password,
+            row_count=CHUNK_SIZE,
+            key="content_hash",
+            text_cols=["content_hash"],
+        ):
+            if executor:
+                results = executor.map(
+                    get_required, df["sourcecode"], chunksize=POOL_CHUNK_SIZE
+                )
+            else:
+                results = map(get_required, df["sourcecode"])
+            updated += save_edges(
+                list(df["content_hash"]), list(results), user_db_port, user, password
+            )
+    finally:
+        if executor:
+            executor.shutdown()
+
+    print("Parsed dependencies of %d changed modules." % updated)
+
+
+def update_graph(user_db_port=None, user=None, password=None):
+    """
+    Resolves edges from Dependencies table to the modules they point to, and saves number of
+    direct (fan_in) and transitive (dependents) dependents of every module into Scripts table.
+    Only the changed values are written.
+
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :return: None
+    """
+    conn = db_acc.connect_to_user_database(DATABASE_NAME, user_db_port, user, password)
+    try:
+        with conn.cursor() as cur:
+            # edges of the modules, which were removed from Scripts
+            cur.execute(
+                "DELETE d FROM Dependencies d LEFT JOIN Scripts s "
+                "ON s.page_id = d.page_id AND s.dbname = d.dbname WHERE s.page_id IS NULL"
+            )
+
+            scripts_cols = ["page_id", "dbname", "title", "fan_in", "dependents"]
+            cur.execute("SELECT " + ", ".join(scripts_cols) + " FROM Scripts")
+            scripts = rows_to_dataframe(
+                cur.fetchall(), scripts_cols, ["dbname", "title"]
+            )
+
+            edges_cols = ["dbname", "page_id", "dependency", "dep_page_id"]
+            cur.execute("SELECT " + ", ".join(edges_cols) + " FROM Dependencies")
+            edges = rows_to_dataframe(
+                cur.fetchall(), edges_cols, ["dbname", "dependency"]
+            )
+
+            start = time.time()
+            resolved = resolve_dependencies(scripts, edges)
+            stored = pd.to_numeric(edges["dep_page_id"]).values
+            changed = ~((resolved == stored) | (np.isnan(resolved) & np.isnan(stored)))
+            edges["dep_page_id"] = resolved
+            bulk_update(
+                cur,
+                "Dependencies",
+                ["dbname", "page_id", "dependency"],
+                ["dep_page_id"],
+                df_to_rows(edges[changed]),
+            )
+
+            nodes = pd.Series(
+                np.arange(len(scripts)),
+                index=pd.MultiIndex.from_arrays(
+                    [scripts["dbname"], scripts["page_id"]]
+                ),
+            )
+            edges = edges.dropna(subset=["dep_page_id"])
+            sources = nodes.reindex(
+                pd.MultiIndex.from_arrays([edges["dbname"], edges["page_id"]])
+            ).values
+            targets = nodes.reindex(
+                pd.MultiIndex.from_arrays(
+                    [edges["dbname"], edges["dep_page_id"].astype(np.int64)]
+                )
+            ).values
+            # a module, removed from Scripts while the graph was read, is just skipped
+            found = ~(np.isnan(sources) | np.isnan(targets))
+            fan_in, dependents = count_dependents(
+                len(scripts), sources[found], targets[found]
+            )
+            print(
+                "Dependency graph of %d modules and %d edges computed in %.2f seconds."
+                % (len(scripts), len(edges), time.time() - start)
+            )
+
+            changed = (scripts["fan_in"].values != fan_in) | (
+                scripts["dependents"].values != dependents
+            )
+            rows = [
+                [int(page_id), dbname, int(f), int(d)]
+                for page_id, dbname, f, d in zip(
+                    scripts["page_id"][changed],
+                    scripts["dbname"][changed],
+                    fan_in[changed],
+                    dependents[changed],
+                )
+            ]
+            bulk_update(
+                cur, "Scripts", ["page_id", "dbname"], ["fan_in", "dependents"], rows
+            )
+        conn.commit()
+    finally:
+        close_conn(conn)
+
+    print("Updated dependents of %d modules." % len(rows))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Builds graph of dependencies between modules from require/mw.loadData calls "
+        "in their sourcecodes, saving the edges into Dependencies table, and number of direct "
+        "(fan_in) and transitive (dependents) dependents of modules into Scripts table. "
+        "By default only modules, which changed since the last run, are parsed."
+        "To use from local PC, provide all the additional flags needed for "
+        "establishing connection through ssh tunneling."
+        "More help available at "
+        "https://wikitech.wikimedia.org/wiki/Help:Toolforge/Database#SSH_tunneling_for_local_testing_which_makes_use_of_Wiki_Replica_databases"
+    )
+    parser.add_argument(
+        "--full-run",
+        "-f",
+        action="store_true",
+        help="Set to parse all the modules, even the unchanged ones.",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=WORKERS,
+        help="Number of processes parsing sourcecodes.",
+    )
+    local_data = parser.add_argument_group(
+        title="Info for connecting to Toolforge from local pc"
+    )
+    local_data.add_argument(
+        "--user-db-port",
+        "-udb",
+        type=int,
+        default=None,
+        help="Port for connecting to tables, created by user in Toolforge, "
+        "through ssh tunneling, if used.",
+    )
+    local_data.add_argument(
+        "--user", "-u", type=str, default=None, help="Toolforge username of the tool."
+    )
+    local_data.add_argument(
+        "--password",
+        "-p",
+        type=str,
+        default=None,
+        help="Toolforge password of the tool.",
+    )
+    args = parser.parse_args()
+
+    update_edges(
+        args.full_run, args.user_db_port, args.user, args.password, args.workers
+    )
+    update_graph(args.user_db_port, args.user, args.password)
@@ -4,7 +4,7 @@ import pymysql
 import numpy as np
 
 import utils.db_access as db_acc
-from utils.db_query import encode_if_necessary, get_dbs
+from utils.db_query import get_dbs, bulk_upsert
 import constants
 
 pymysql.converters.encoders[np.int64] = pymysql.converters.escape_int
@@ -25,30 +25,17 @@ def save_to_db(entries, db, user_db_port=None, user=None, password=None):
     :return: None
     """
 
-    query = (
-        "INSERT INTO Scripts(dbname, page_id, in_database, page_is_redirect, page_is_new) "
-        "VALUES(%s, %s, %s, %s, %s) "
-        "ON DUPLICATE KEY UPDATE in_database = %s, page_is_redirect = %s, page_is_new = %s"
-    )
+    cols = ["dbname", "page_id", "in_database", "page_is_redirect", "page_is_new"]
+    rows = [
+        [db, elem["page_id"], 1, elem["page_is_redirect"], elem["page_is_new"]]
+        for elem in entries.to_dict("records")
+    ]
     try:
         conn = db_acc.connect_to_user_database(
             constants.DATABASE_NAME, user_db_port, user, password
         )
         with conn.cursor() as cur:
-            for index, elem in entries.iterrows():
-                cur.execute(
-                    query,
-                    [
-                        db,
-                        elem["page_id"],
-                        1,
-                        elem["page_is_redirect"],
-                        elem["page_is_new"],
-                        1,
-                        elem["page_is_redirect"],
-                        elem["page_is_new"],
-                    ],
-                )
+            bulk_upsert(cur, "Scripts", cols, rows, cols[2:])
         conn.commit()
         conn.close()
     except Exception as err:
@@ -82,7 +69,8 @@ def get_data(dbs, replicas_port=None, user_db_port=None, user=None, password=Non
                     "WHERE page_content_model='Scribunto' AND page_namespace=828",
                     conn,
                 )
-                df_page = pd.DataFrame(SQL_Query).applymap(encode_if_necessary)
+                # all the columns are numeric, nothing to decode
+                df_page = pd.DataFrame(SQL_Query)
 
                 # Saving to db
                 save_to_db(df_page, db, user_db_port, user, password)
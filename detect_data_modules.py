@@ -1,63 +1,108 @@
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 
-from utils.db_query import query_data_generator, save_data
-from utils.sourcecode_processing import remove_comments, check_if_data_function
+from utils.db_query import (
+    query_data_generator,
+    save_data,
+    get_dedup_stats,
+    print_dedup_ratio,
+)
+from utils.sourcecode_processing import check_if_data_function
+from utils.sourcecode_codec import decode
 
+WORKERS = 4
+CHUNK_SIZE = 500  # sourcecodes fetched, classified and saved at once
+POOL_CHUNK_SIZE = 50  # sourcecodes sent to a worker process at once
 
-def detect_data_modules(full_run=False, user_db_port=None, user=None, password=None):
+
+def classify(data):
+    """
+    Decodes stored sourcecode and checks whether it's a data function; run in worker processes.
+
+    :param data: sourcecode, as stored in Sourcecodes table.
+    :return: True/False
+    """
+    return check_if_data_function(decode(data))
+
+
+def detect_data_modules(
+    full_run=False, user_db_port=None, user=None, password=None, workers=WORKERS
+):
     """
     Gets sourcecodes of Lua functions from user's database and evaluates
     whether function is considered to be 'data function'
     (used only for storing information), saving it's results back to user's database.
+    Every distinct sourcecode is evaluated once, and the result is saved for all the modules sharing it.
+    The hash of the evaluated sourcecode is saved into is_data_hash, so the full run skips
+    the modules, which haven't changed since they were evaluated.
 
-    :param full_run: determines whether to check all scripts or only unhandled ones.
+    :param full_run: determines whether to check all changed scripts or only unhandled ones.
     :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
     :param user: Toolforge username of the tool.
     :param password: Toolforge password of the tool.
+    :param workers: number of processes evaluating sourcecodes; 1 to evaluate them in this process.
     :return: None
     """
     query = (
-        "SELECT page_id, dbname, sourcecode, is_data "
-        "FROM Scripts "
+        "SELECT content_hash, sourcecode "
+        "FROM Sourcecodes "
+        "WHERE {keyset} AND content_hash IN "
+        "    (SELECT content_hash FROM Scripts WHERE %s)"
     )
-    new_values_query = "WHERE is_data IS NULL"
+    if full_run:
+        condition = "NOT (is_data_hash <=> content_hash)"
+    else:
+        condition = "is_data IS NULL"
 
-    cols = ["page_id", "dbname", "sourcecode", "is_data"]
+    cols = ["content_hash", "sourcecode"]
     function_name = "detect_data_modules"
 
-    no_offset = False
-    if not full_run:
-        query += new_values_query
-        no_offset = True
-
-    for df in query_data_generator(
-            query,
-            function_name,
-            cols,
-            db="user_db",
-            replicas=False,
-            user_db_port=user_db_port,
-            user=user,
-            password=password,
-            no_offset=no_offset
-    ):
-        sourcecodes = df.loc[:, 'sourcecode']
-        for i in range(sourcecodes.shape[0]):
-            curr_code = remove_comments(sourcecodes.iat[i])
-            df.loc[i, 'is_data'] = check_if_data_function(curr_code)
+    pages, distinct = get_dedup_stats(user_db_port, user, password, condition)
+    if full_run:
+        total, _ = get_dedup_stats(user_db_port, user, password)
+        print("Skipping %d unchanged modules of %d." % (total - pages, total))
+    query = query % condition
 
-        grouped = df.groupby(df["dbname"])
-        for db_name in df["dbname"].unique():
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    try:
+        for df in query_data_generator(
+                query,
+                function_name,
+                cols,
+                db="user_db",
+                replicas=False,
+                user_db_port=user_db_port,
+                user=user,
+                password=password,
+                row_count=CHUNK_SIZE,
+                key="content_hash",
+                text_cols=["content_hash"],
+        ):
+            if executor:
+                results = executor.map(
+                    classify, df["sourcecode"], chunksize=POOL_CHUNK_SIZE
+                )
+            else:
+                results = map(classify, df["sourcecode"])
+            df["is_data"] = list(results)
+            df["is_data_hash"] = df["content_hash"]
+            # one bulk update per chunk, for all the modules sharing the sourcecodes
             save_data(
-                grouped.get_group(db_name),
-                db_name,
+                df[["content_hash", "is_data", "is_data_hash"]],
+                "user_db",
                 function_name,
                 user_db_port,
                 user,
-                password)
+                password,
+                key_cols=["content_hash"],
+            )
+    finally:
+        if executor:
+            executor.shutdown()
 
+    print_dedup_ratio(pages, distinct, "Evaluated")
     if full_run:
-        print("Done evaluating all Lua scripts content.")
+        print("Done evaluating all changed Lua scripts content.")
     else:
         print("Done evaluating new Lua scripts content.")
 
@@ -75,7 +120,14 @@ if __name__ == "__main__":
         "--full-run",
         "-f",
         action="store_true",
-        help="Set to check all the entries in the database.",
+        help="Set to check all the entries in the database, which changed since they were checked.",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=WORKERS,
+        help="Number of processes evaluating sourcecodes.",
     )
     local_data = parser.add_argument_group(
         title="Info for connecting to Toolforge from local pc"
@@ -104,4 +156,6 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
 
-    detect_data_modules(args.full_run, args.user_db_port, args.user, args.password)
+    detect_data_modules(
+        args.full_run, args.user_db_port, args.user, args.password, args.workers
+    )
@@ -0,0 +1,304 @@
+import time
+import argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import utils.db_access as db_acc
+from utils.db_query import (
+    query_data_generator,
+    rows_to_dataframe,
+    bulk_upsert,
+    close_conn,
+    df_to_rows,
+    get_dedup_stats,
+    print_dedup_ratio,
+)
+from utils.sourcecode_processing import preprocess_text
+from utils.sourcecode_codec import decode
+from utils.minhash import (
+    get_signature,
+    get_candidate_pairs,
+    estimate_jaccard,
+    group_pairs,
+    MAX_HASH,
+)
+from constants import DATABASE_NAME
+
+WORKERS = 4
+CHUNK_SIZE = 500  # sourcecodes fetched and signed at once
+POOL_CHUNK_SIZE = 20  # sourcecodes sent to a worker process at once
+THRESHOLD = 0.8  # estimated Jaccard similarity of near-duplicates
+
+
+def sign(data, lexer=False):
+    """
+    Decodes stored sourcecode and computes MinHash signature of its tokens; run in worker processes.
+
+    :param data: sourcecode, as stored in Sourcecodes table.
+    :param lexer: whether to tokenize the sourcecode with Lua lexer, see preprocess_text.
+    :return: uint32 numpy array
+    """
+    return get_signature(preprocess_text(decode(data), lexer))
+
+
+def get_signatures(
+    user_db_port=None, user=None, password=None, lexer=False, workers=WORKERS
+):
+    """
+    Computes MinHash signatures of all the distinct sourcecodes of the modules in Scripts table.
+
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :param lexer: whether to tokenize sourcecodes with Lua lexer, see preprocess_text.
+    :param workers: number of processes computing signatures; 1 to compute them in this process.
+    :return: (list of content_hash, uint32 matrix of signatures, row per content_hash)
+    """
+    query = (
+        "SELECT content_hash, sourcecode "
+        "FROM Sourcecodes "
+        "WHERE {keyset} AND content_hash IN (SELECT content_hash FROM Scripts)"
+    )
+    hashes, signatures = [], []
+    function = partial(sign, lexer=lexer)
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    try:
+        for df in query_data_generator(
+            query,
+            "detect_duplicates",
+            ["content_hash", "sourcecode"],
+            db="user_db",
+            replicas=False,
+            user_db_port=user_db_port,
+            user=user,
+            password=password,
+            row_count=CHUNK_SIZE,
+            key="content_hash",
+            text_cols=["content_hash"],
+        ):
+            if executor:
+                results = executor.map(
+                    function, df["sourcecode"], chunksize=POOL_CHUNK_SIZE
+                )
+            else:
+                results = map(function, df["sourcecode"])
+            signatures.extend(results)
+            hashes.extend(df["content_hash"])
+    finally:
+        if executor:
+            executor.shutdown()
+
+    return hashes, np.array(signatures, dtype=np.uint32).reshape(len(hashes), -1)
+
+
+def find_duplicates(hashes, signatures, threshold=THRESHOLD):
+    """
+    Finds pairs of near-duplicate sourcecodes with LSH banding of their MinHash signatures,
+    and groups the sourcecodes connected by them. Sourcecodes without tokens aren't grouped.
+
+    :param hashes: list of content_hash.
+    :param signatures: uint32 matrix of signatures, row per content_hash.
+    :param threshold: minimal estimated Jaccard similarity of near-duplicates.
+    :return: (DataFrame of the pairs with columns content_hash, dup_content_hash, jaccard;
+    numpy array of group number of every content_hash, -1 for the empty ones)
+    """
+    hashes = np.array(hashes, dtype=object)
+    rows = np.flatnonzero((signatures != MAX_HASH).any(axis=1))
+    first, second = get_candidate_pairs(signatures[rows])
+    first, second = rows[first], rows[second]
+    jaccard = estimate_jaccard(signatures, first, second)
+    similar = jaccard >= threshold
+    print(
+        "%d candidate pairs, %d of them with estimated Jaccard similarity >= %.2f."
+        % (len(first), similar.sum(), threshold)
+    )
+    pairs = pd.DataFrame(
+        {
+            "content_hash": hashes[first[similar]],
+            "dup_content_hash": hashes[second[similar]],
+            "jaccard": jaccard[similar],
+        }
+    )
+
+    groups = np.full(len(hashes), -1, dtype=np.int64)
+    groups[rows] = group_pairs(len(hashes), first[similar], second[similar])[rows]
+    return pairs, groups
+
+
+def save_groups(
+    hashes, signatures, groups, user_db_port=None, user=None, password=None
+):
+    """
+    Replaces contents of Duplicates table with the groups of modules, which have equal or near-duplicate sourcecodes.
+    Every module gets estimated Jaccard similarity to the sourcecode, used by the most modules of its group.
+
+    :param hashes: list of content_hash.
+    :param signatures: uint32 matrix of signatures, row per content_hash.
+    :param groups: group number of every content_hash, -1 for the ones, which aren't grouped.
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :return: number of saved modules
+    """
+    rows = pd.Series(np.arange(len(hashes)), index=hashes)
+    conn = db_acc.connect_to_user_database(DATABASE_NAME, user_db_port, user, password)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT dbname, page_id, content_hash FROM Scripts "
+                "WHERE content_hash IS NOT NULL"
+            )
+            df = rows_to_dataframe(
+                cur.fetchall(),
+                ["dbname", "page_id", "content_hash"],
+                ["dbname", "content_hash"],
+            )
+            df["row"] = rows.reindex(df["content_hash"]).values
+            df = df.dropna(subset=["row"])
+            df["row"] = df["row"].astype(np.int64)
+            df["dup_group"] = groups[df["row"].values]
+            df = df[df["dup_group"] >= 0]
+            df = df[df.groupby("dup_group")["page_id"].transform("size") > 1]
+
+            # sourcecode, used by the most modules of the group
+            counts = df.groupby(["dup_group", "row"]).size().reset_index(name="count")
+            representatives = counts.sort_values(
+                "count", ascending=False, kind="stable"
+            ).drop_duplicates("dup_group")
+            representatives = representatives.set_index("dup_group")["row"]
+            df["similarity"] = estimate_jaccard(
+                signatures,
+                df["row"].values,
+                representatives.reindex(df["dup_group"]).values,
+            )
+            # groups are renumbered from 1
+            df["dup_group"] = pd.factorize(df["dup_group"], sort=True)[0] + 1
+
+            cur.execute("DELETE FROM Duplicates")
+            bulk_upsert(
+                cur,
+                "Duplicates",
+                ["dbname", "page_id", "dup_group", "similarity"],
+                df_to_rows(df[["dbname", "page_id", "dup_group", "similarity"]]),
+                ["dup_group", "similarity"],
+            )
+        conn.commit()
+    finally:
+        close_conn(conn)
+    return len(df)
+
+
+def detect_duplicates(
+    user_db_port=None,
+    user=None,
+    password=None,
+    lexer=False,
+    threshold=THRESHOLD,
+    workers=WORKERS,
+    pairs_file=None,
+):
+    """
+    Detects near-duplicate modules across all wikis: sourcecodes are tokenized, split into shingles
+    of consecutive tokens and summarized with MinHash signatures; sourcecodes, which signatures share
+    a band, are compared by estimated Jaccard similarity, and the similar ones are grouped.
+    The groups are saved into Duplicates table.
+
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :param lexer: whether to tokenize sourcecodes with Lua lexer, see preprocess_text.
+    :param threshold: minimal estimated Jaccard similarity of near-duplicates.
+    :param workers: number of processes computing signatures; 1 to compute them in this process.
+    :param pairs_file: path of csv file to save the pairs of near-duplicate sourcecodes to, if given.
+    :return: None
+    """
+    pages, distinct = get_dedup_stats(user_db_port, user, password)
+    print_dedup_ratio(pages, distinct, "Duplicates")
+
+    start = time.time()
+    hashes, signatures = get_signatures(user_db_port, user, password, lexer, workers)
+    print(
+        "Signatures of %d sourcecodes computed in %.2f seconds."
+        % (len(hashes), time.time() - start)
+    )
+
+    start = time.time()
+    pairs, groups = find_duplicates(hashes, signatures, threshold)
+    print("Near-duplicates found in %.2f seconds." % (time.time() - start))
+    if pairs_file:
+        pairs.to_csv(pairs_file, index=False)
+
+    saved = save_groups(hashes, signatures, groups, user_db_port, user, password)
+    print("Saved %d modules with duplicates." % saved)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Detects near-duplicate modules across all wikis with MinHash and LSH, "
+        "and saves groups of them into Duplicates table. "
+        "To use from local PC, provide all the additional flags needed for "
+        "establishing connection through ssh tunneling."
+        "More help available at "
+        "https://wikitech.wikimedia.org/wiki/Help:Toolforge/Database#SSH_tunneling_for_local_testing_which_makes_use_of_Wiki_Replica_databases"
+    )
+    parser.add_argument(
+        "--lexer",
+        "-lx",
+        action="store_true",
+        help="Whether to tokenize sourcecodes with Lua lexer (drops comments).",
+    )
+    parser.add_argument(
+        "--threshold",
+        "-t",
+        type=float,
+        default=THRESHOLD,
+        help="Minimal estimated Jaccard similarity of near-duplicates.",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=WORKERS,
+        help="Number of processes computing signatures.",
+    )
+    parser.add_argument(
+        "--pairs-file",
+        type=str,
+        default=None,
+        help="Path of csv file to save pairs of near-duplicate sourcecodes with their estimated similarity.",
+    )
+    local_data = parser.add_argument_group(
+        title="Info for connecting to Toolforge from local pc"
+    )
+    local_data.add_argument(
+        "--user-db-port",
+        "-udb",
+        type=int,
+        default=None,
+        help="Port for connecting to tables, created by user in Toolforge, "
+        "through ssh tunneling, if used.",
+    )
+    local_data.add_argument(
+        "--user", "-u", type=str, default=None, help="Toolforge username of the tool."
+    )
+    local_data.add_argument(
+        "--password",
+        "-p",
+        type=str,
+        default=None,
+        help="Toolforge password of the tool.",
+    )
+    args = parser.parse_args()
+
+    detect_duplicates(
+        args.user_db_port,
+        args.user,
+        args.password,
+        args.lexer,
+        args.threshold,
+        args.workers,
+        args.pairs_file,
+    )
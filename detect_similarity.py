@@ -1,12 +1,22 @@
-import re
+import os
+import glob
+import time
 import pickle
+import hashlib
+import resource
 import argparse
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-from sklearn.cluster import OPTICS
 from gensim.models.fasttext import FastText
 from gensim.models.doc2vec import Doc2Vec, TaggedDocument
+from scipy.sparse import csr_matrix
 from utils.db_query import *
+from utils.sourcecode_codec import decode_column
+from utils.sourcecode_processing import preprocess_text
+from utils.embedding_store import EmbeddingStore
+from utils.ann_index import AnnIndex
+from utils.clustering import CLUSTERING_BACKENDS
 import utils.db_access as db_acc
 from constants import DATABASE_NAME
 
@@ -15,13 +25,14 @@ WINDOW = 5
 MIN_COUNT = 5
 MAX_VOCAB = 60000
 MAXLEN = 20000
-MAX_EPS = np.inf
-MIN_SAMPLES = 5
-METRIC = "minkowski"
-ALGORITHM = "auto"
-CLUSTER_METHOD = "xi"
-XI = 0.0005
 EPOCHS = 10
+WORKERS = 2  # processes computing embeddings; each of them needs the model in memory
+EMBEDDING_CHUNK = 500  # sourcecodes embedded at once by a worker
+MODEL_FILES = {True: "fasttext.model", False: "doc2vec.model"}
+STORE_FILES = {True: "WE_embeddings", False: "doc_embeddings"}  # see EmbeddingStore
+INDEX_SUFFIX = ".ann.npz"  # nearest-neighbour index is saved next to the store
+
+MODEL = None  # embedding model, loaded once per process
 
 
 def get_data(
@@ -30,42 +41,51 @@ def get_data(
     user,
     password,
     maxlen=MAXLEN,
+    skip=None,
 ):
     """
-    Gets all sourcecodes of Lua functions from user's database.
+    Gets all Lua functions and their distinct sourcecodes from user's database.
 
     :param with_data: whether to grab all modules or only those that are not data modules (when false).
     :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
     :param user: Toolforge username of the tool.
     :param password: Toolforge password of the tool.
     :param maxlen: The length to which the sourcecode should be truncated.
-    :return: DataFrame with columns page_id, dbname, sourcecode
+    :param skip: content_hash values, which sourcecodes aren't needed (e.g. are already embedded).
+    :return: (DataFrame with columns page_id, dbname, content_hash;
+    DataFrame with columns content_hash, sourcecode, one row for every distinct sourcecode of these modules,
+    which is not skipped)
     """
-    query = "SELECT page_id, dbname, LEFT(sourcecode, %s) FROM Scripts" % maxlen
+    condition = "content_hash IS NOT NULL"
     if not with_data:
-        query += " WHERE is_data=0"
+        condition += " AND is_data=0"
+    query = "SELECT page_id, dbname, content_hash FROM Scripts WHERE " + condition
 
-    cols = ["page_id", "dbname", "sourcecode"]
+    cols = ["page_id", "dbname", "content_hash"]
+    codes_cols = ["content_hash", "sourcecode"]
     conn = db_acc.connect_to_user_database(
         DATABASE_NAME, user_db_port, user, password)
     with conn.cursor() as cur:
         cur.execute(query)
-        df = pd.DataFrame(cur.fetchall(), columns=cols).applymap(
-            encode_if_necessary)
+        df = rows_to_dataframe(cur.fetchall(), cols, ["dbname", "content_hash"])
+
+        skip = set(skip) if skip is not None else set()
+        hashes = [h for h in df["content_hash"].unique() if h not in skip]
+        rows = []
+        for i in range(0, len(hashes), BATCH_SIZE):
+            batch = hashes[i: i + BATCH_SIZE]
+            cur.execute(
+                "SELECT content_hash, sourcecode FROM Sourcecodes WHERE content_hash IN (%s)"
+                % ", ".join(["%s"] * len(batch)),
+                batch,
+            )
+            rows += cur.fetchall()
+        codes = rows_to_dataframe(rows, codes_cols, ["content_hash"])
     close_conn(conn)
+    # sourcecodes may be stored compressed, so they are truncated only after decoding
+    codes["sourcecode"] = decode_column(codes["sourcecode"], maxlen)
 
-    return df
-
-
-def preprocess_text(document):
-    """
-    Tokenizes a string of sourcecode into a list of tokens.
-
-    :param document: A string of sourcecode.
-    :return: List of tokens.
-    """
-    pat = r"(?u)\w+|[^\w\s]"
-    return re.findall(pat, document)
+    return df, codes
 
 
 def train_embedding(
@@ -76,6 +96,7 @@ def train_embedding(
     limit=10000,
     maxlen=MAXLEN,
     embedding_size=EMBEDDING_SIZE,
+    lexer=False,
 ):
     """
     Trains and saves a embedding model on all the sourcecode data available in user's database.
@@ -87,6 +108,7 @@ def train_embedding(
     :param limit: Number of rows to fetch for each loop of training.
     :param maxlen: The length to which the sourcecode should be truncated.
     :param embedding_size: Size of the embedding vector.
+    :param lexer: Whether to tokenize sourcecodes with Lua lexer, see preprocess_text.
     :return: None
     """
     if is_word:
@@ -105,9 +127,13 @@ def train_embedding(
             max_vocab_size=MAX_VOCAB,
         )
 
-    query = "SELECT page_id, dbname, LEFT(sourcecode, %s) FROM Scripts" % maxlen
+    # every distinct sourcecode is used once
+    query = (
+        "SELECT content_hash, sourcecode FROM Sourcecodes "
+        "WHERE {keyset} AND content_hash IN (SELECT content_hash FROM Scripts)"
+    )
 
-    cols = ["page_id", "dbname", "sourcecode"]
+    cols = ["content_hash", "sourcecode"]
     first_iter = True
     for df in query_data_generator(
         query,
@@ -120,14 +146,17 @@ def train_embedding(
         password,
         False,
         limit,
+        key="content_hash",
+        text_cols=["content_hash"],
     ):
+        df["sourcecode"] = decode_column(df["sourcecode"], maxlen)
 
         list_of_list = []
-        for i, code in df["sourcecode"].iteritems():
+        for i, code in df["sourcecode"].items():
             if is_word:
-                list_of_list.append(preprocess_text(code))
+                list_of_list.append(preprocess_text(code, lexer))
             else:
-                list_of_list.append(TaggedDocument(preprocess_text(code), [i]))
+                list_of_list.append(TaggedDocument(preprocess_text(code, lexer), [i]))
 
         if is_word:
             model.build_vocab(sentences=list_of_list, update=(not first_iter))
@@ -148,65 +177,138 @@ def train_embedding(
         model.save("doc2vec.model")
 
 
-def get_embedding(df, is_word):
+def load_model(is_word):
     """
-    Generates embedding for sourcecodes provided through the dataframe.
+    Loads the saved embedding model into this process, if it's not loaded yet.
+
+    :param is_word: Whether to load fasttext word-embeddings or doc2vec document-embedding model.
+    :return: the model
+    """
+    global MODEL
+    if MODEL is None:
+        MODEL = FastText.load(MODEL_FILES[True]) if is_word else Doc2Vec.load(MODEL_FILES[False])
+    return MODEL
+
+
+def get_model_version(is_word, lexer=False):
+    """
+    Identifies the saved embedding model by the contents of its files, so embeddings cached
+    for another model (or tokenization) are not reused.
 
-    :param df: Dataframe containing sourecodes in the column 'sourcecode'.
     :param is_word: Whether to use fasttext word-embeddings or doc2vec document-embedding.
-    :return: List of embeddings as a numpy array.
+    :param lexer: Whether sourcecodes are tokenized with Lua lexer.
+    :return: str
     """
+    sha1 = hashlib.sha1()
+    # gensim stores big arrays of the model in separate files next to it
+    for path in sorted(glob.glob(MODEL_FILES[is_word] + "*")):
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                sha1.update(block)
+    return sha1.hexdigest() + ("-lexer" if lexer else "")
+
+
+def pool_word_vectors(wv, documents):
+    """
+    Averages word vectors of the tokens of every document in one step: vectors of distinct tokens
+    of all the documents are looked up once, and summed per document with a sparse matrix product.
+
+    :param wv: Word vectors of the model, e.g. model.wv.
+    :param documents: List of lists of tokens.
+    :return: Matrix of embeddings, row per document; zeros for documents without tokens
+    """
+    vocabulary = {}
+    indices = [
+        vocabulary.setdefault(token, len(vocabulary))
+        for document in documents
+        for token in document
+    ]
+    lengths = np.array([len(document) for document in documents], dtype=np.int64)
+    if not vocabulary:
+        return np.zeros((len(documents), wv.vector_size), dtype=np.float32)
+
+    counts = csr_matrix(
+        (
+            np.ones(len(indices), dtype=np.float32),
+            np.array(indices, dtype=np.int64),
+            np.concatenate([[0], np.cumsum(lengths)]),
+        ),
+        shape=(len(documents), len(vocabulary)),
+    )
+    vectors = np.asarray(wv[list(vocabulary)], dtype=np.float32)
+    return np.asarray(counts @ vectors) / np.maximum(lengths, 1)[:, None]
+
+
+def embed_chunk(codes, is_word, lexer=False):
+    """
+    Generates embeddings for a chunk of sourcecodes; run in worker processes.
+
+    :param codes: List of sourcecodes.
+    :param is_word: Whether to use fasttext word-embeddings or doc2vec document-embedding.
+    :param lexer: Whether to tokenize sourcecodes with Lua lexer; should match the one used in training.
+    :return: Matrix of embeddings, row per sourcecode
+    """
+    model = load_model(is_word)
+    documents = [preprocess_text(code, lexer) for code in codes]
     if is_word:
-        model = FastText.load("fasttext.model")
-    else:
-        model = Doc2Vec.load("doc2vec.model")
+        return pool_word_vectors(model.wv, documents)
+    return np.array(
+        [model.infer_vector(document) for document in documents], dtype=np.float32
+    ).reshape(len(documents), model.vector_size)
 
-    def get_emb(sent):
-        if is_word:
-            AV = np.zeros(model.vector_size)
-            for word in sent:
-                AV += model.wv[word]
-            AV /= len(AV)
-            return AV
-        else:
-            return model.infer_vector(sent)
 
-    list_of_embeddings = []
+def get_embedding(df, is_word, lexer=False, workers=WORKERS):
+    """
+    Generates embedding for sourcecodes provided through the dataframe.
+    Chunks of sourcecodes are embedded in parallel by worker processes.
 
-    for code in df["sourcecode"]:
-        list_of_embeddings.append(get_emb(preprocess_text(code)))
+    :param df: Dataframe containing sourecodes in the column 'sourcecode'.
+    :param is_word: Whether to use fasttext word-embeddings or doc2vec document-embedding.
+    :param lexer: Whether to tokenize sourcecodes with Lua lexer; should match the one used in training.
+    :param workers: Number of worker processes; 1 to compute embeddings in this process.
+    :return: List of embeddings as a numpy array.
+    """
+    # loaded before starting the workers, so forked workers share it
+    model = load_model(is_word)
+    codes = list(df["sourcecode"])
+    chunks = [
+        codes[i: i + EMBEDDING_CHUNK] for i in range(0, len(codes), EMBEDDING_CHUNK)
+    ]
+    if not chunks:
+        return np.zeros((0, model.vector_size), dtype=np.float32)
+
+    if workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(
+            min(workers, len(chunks)), initializer=load_model, initargs=(is_word,)
+        ) as executor:
+            results = list(
+                executor.map(
+                    embed_chunk,
+                    chunks,
+                    [is_word] * len(chunks),
+                    [lexer] * len(chunks),
+                )
+            )
+    else:
+        results = [embed_chunk(chunk, is_word, lexer) for chunk in chunks]
 
-    return np.array(list_of_embeddings)
+    return np.vstack(results)
 
 
-def find_clusters(df, X):
+def find_clusters(df, X, backend="optics"):
     """
     Run clustering algorithm over the embeddings.
+    Noise modules get labels between the clusters: label of the closest cluster + 0.5, or -0.5.
 
     :param df: The dataframe to which labels are appended.
     :param X: The list of embeddings to train the clustering algorithm on.
+    :param backend: Name of the clustering algorithm, see utils.clustering.CLUSTERING_BACKENDS.
     :return: (The dataframe with labels in the 'group' column, the clustering model itself)
     """
-    clustering = OPTICS(
-        max_eps=MAX_EPS,
-        min_samples=MIN_SAMPLES,
-        metric=METRIC,
-        algorithm=ALGORITHM,
-        cluster_method=CLUSTER_METHOD,
-        xi=XI,
-        n_jobs=-1,
-    ).fit(X)
-
-    # Mark clusters
-    df = df.assign(group=clustering.labels_)
-
-    # Remove Noise
-    last_num = -0.5
-    for i, row in df.iloc[clustering.ordering_].iterrows():
-        if row['group'] == -1:
-            df.loc[i, 'group'] = last_num
-        else:
-            last_num = row['group'] + 0.5
+    labels, nearest, clustering = CLUSTERING_BACKENDS[backend](X)
+
+    # Mark clusters and noise
+    df = df.assign(group=np.where(labels >= 0, labels, nearest + 0.5))
 
     return df, clustering
 
@@ -223,7 +325,7 @@ def store_data(df, col, user_db_port, user, password):
     :return: None
     """
     query1 = "UPDATE Scripts SET " + col + "=NULL"
-    query2 = "UPDATE Scripts SET " + col + "=%s WHERE page_id=%s AND dbname=%s"
+    rows = df_to_rows(df[["page_id", "dbname", "group"]])
     max_tries = 3
     retry_counter = 1
 
@@ -235,11 +337,7 @@ def store_data(df, col, user_db_port, user, password):
             )
             with conn.cursor() as cur:
                 cur.execute(query1)
-                for _, elem in df.iterrows():
-                    cur.execute(
-                        query2, [elem["group"],
-                                 elem["page_id"], elem["dbname"]]
-                    )
+                bulk_update(cur, "Scripts", ["page_id", "dbname"], [col], rows)
             conn.commit()
             close_conn(conn)
             break
@@ -255,8 +353,78 @@ def store_data(df, col, user_db_port, user, password):
             break
 
 
+def get_peak_memory():
+    """
+    :return: peak resident memory of this process and of its largest finished worker process, in MB
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    )
+
+
+def build_index(store):
+    """
+    Builds nearest-neighbour index over all the embeddings in the store and saves it next to the store,
+    so similar modules can be found without clustering, see find_similar_modules.
+
+    :param store: EmbeddingStore.
+    :return: None
+    """
+    start = time.time()
+    index = AnnIndex.build(store.vectors)
+    path = store.path + INDEX_SUFFIX
+    index.save(path + ".tmp", version=store.version, rows=len(store))
+    os.replace(path + ".tmp", path)
+    print(
+        "Nearest-neighbour index of %d modules built in %.2f seconds."
+        % (len(store), time.time() - start)
+    )
+
+
+def find_similar_modules(dbname, page_id, word_embedding=True, k=10, search_k=None):
+    """
+    Finds modules with the embeddings closest to the embedding of the given module, across all wikis,
+    with the index built by the last run of get_similarity.
+
+    :param dbname: name of the database of the module.
+    :param page_id: page ID of the module.
+    :param word_embedding: whether to use word-embedding or document-embedding.
+    :param k: number of the modules to find.
+    :param search_k: number of candidates compared exactly; more give better recall for slower queries.
+    :return: pandas.DataFrame with columns dbname, page_id, content_hash, distance (cosine), sorted by distance;
+    None, if the module isn't in the store or the index is out of date
+    """
+    store = EmbeddingStore(STORE_FILES[word_embedding])
+    try:
+        index, meta = AnnIndex.load(store.path + INDEX_SUFFIX)
+    except OSError:
+        return None
+    if meta.get("version") != store.version or meta.get("rows") != len(store):
+        return None
+
+    row = store.find(pd.DataFrame({"dbname": [dbname], "page_id": [int(page_id)]}))[0]
+    if row < 0:
+        return None
+    rows, distances = index.query(
+        store.vectors, store.vectors[row], k, search_k, exclude=[row]
+    )
+    df = store.index.iloc[rows].reset_index(drop=True)
+    df["distance"] = distances
+    return df
+
+
 def get_similarity(
-    with_data, train_model, word_embedding, user_db_port, user, password
+    with_data,
+    train_model,
+    word_embedding,
+    user_db_port,
+    user,
+    password,
+    lexer=False,
+    workers=WORKERS,
+    clustering="optics",
 ):
     """
     Train and perform clustering of Lua modules from users database, save the cluster labels back to user database.
@@ -267,24 +435,81 @@ def get_similarity(
     :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
     :param user: Toolforge username of the tool.
     :param password: Toolforge password of the tool.
+    :param lexer: whether to tokenize sourcecodes with Lua lexer instead of the plain word pattern.
+    :param workers: number of processes computing embeddings.
+    :param clustering: name of the clustering algorithm, see utils.clustering.CLUSTERING_BACKENDS.
     :return: None
     """
     if train_model:
-        train_embedding(word_embedding, user_db_port, user, password)
-
-    df = get_data(with_data, user_db_port, user, password)
-    X = get_embedding(df, word_embedding)
-    del df["sourcecode"]
-    df, clustering = find_clusters(df, X)
+        train_embedding(word_embedding, user_db_port, user, password, lexer=lexer)
+
+    # embeddings of all the modules are kept in the store between the runs;
+    # sourcecodes, embedded by the previous runs with the same model, are not embedded again
+    store = EmbeddingStore(STORE_FILES[word_embedding])
+    version = get_model_version(word_embedding, lexer)
+    is_current = store.version == version
+    df, codes = get_data(
+        with_data,
+        user_db_port,
+        user,
+        password,
+        skip=store.index["content_hash"].unique() if is_current else None,
+    )
+    print_dedup_ratio(len(df), df["content_hash"].nunique(), "Embedding")
+    print("Embedding %d new sourcecodes." % len(codes))
+    if len(codes):
+        new_vectors = get_embedding(codes, word_embedding, lexer, workers)
+    new_rows = pd.Series(np.arange(len(codes)), index=codes["content_hash"].values)
+    del codes
+
+    # modules, which are new or changed, get embeddings of their sourcecodes: the new ones,
+    # or the stored ones of the current model; modules without a sourcecode in Sourcecodes table have neither
+    changed = df[store.changed(df) if is_current else np.ones(len(df), dtype=bool)]
+    is_new = changed["content_hash"].isin(new_rows.index).values
+    stored_rows = np.full(len(changed), -1, dtype=np.int64)
+    if is_current and (~is_new).any():
+        stored_rows[~is_new] = store.find_hashes(changed["content_hash"][~is_new])
+    embedded = is_new | (stored_rows >= 0)
+    if not embedded.all():
+        print("%d modules without sourcecode are skipped." % (~embedded).sum())
+    changed, is_new, stored_rows = (
+        changed[embedded],
+        is_new[embedded],
+        stored_rows[embedded],
+    )
+    dim = new_vectors.shape[1] if len(new_rows) else store.vectors.shape[1]
+    vectors = np.zeros((len(changed), dim), dtype=np.float32)
+    if is_new.any():
+        vectors[is_new] = new_vectors[new_rows[changed["content_hash"][is_new]].values]
+    if (~is_new).any():
+        vectors[~is_new] = store.vectors[stored_rows[~is_new]]
+    store.update(changed, vectors, version)
+    if with_data:
+        # all the modules were checked, so the removed ones can be dropped
+        store.retain(df)
+
+    build_index(store)
+
+    # modules are clustered in the order of the store; if they are all the modules of the store,
+    # the memory-mapped matrix is clustered as it is, without copying it into memory
+    rows = store.find(df)
+    df = df[rows >= 0].assign(row=rows[rows >= 0]).sort_values("row")
+    if len(df) == len(store):
+        X = store.vectors
+    else:
+        X = store.vectors[df["row"].values]
+    df = df.drop(columns=["content_hash", "row"])
+    df, model = find_clusters(df, X, clustering)
 
     col = "cluster" if with_data else "cluster_wo_data"
     word = "WE" if word_embedding else "doc"
 
     # Save model for later use
     with open(word + "_" + col + ".pkl", "wb") as f:
-        pickle.dump(clustering, f)
+        pickle.dump(model, f)
 
     store_data(df, col, user_db_port, user, password)
+    print("Peak memory: %.0f MB, of a worker process: %.0f MB." % get_peak_memory())
 
 
 def get_cluster(
@@ -321,8 +546,7 @@ def get_cluster(
         DATABASE_NAME, user_db_port, user, password)
     with conn.cursor() as cur:
         cur.execute(query)
-        df = pd.DataFrame(cur.fetchall(), columns=cols).applymap(
-            encode_if_necessary)
+        df = rows_to_dataframe(cur.fetchall(), cols, ["dbname"])
     close_conn(conn)
 
     return df
@@ -330,7 +554,7 @@ def get_cluster(
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
-        description="Detects similar modules with OPTICS algorithm and saves cluster labels in Scripts table."
+        description="Detects similar modules with OPTICS (or another clustering algorithm) and saves cluster labels in Scripts table."
         "To use from local PC, provide all the additional flags needed for "
         "establishing connection through ssh tunneling."
         "More help available at "
@@ -354,6 +578,28 @@ if __name__ == "__main__":
         action="store_true",
         help="Whether to use word-embedding (FastText). If not set, doc2vec will be used.",
     )
+    parser.add_argument(
+        "--lexer",
+        "-lx",
+        action="store_true",
+        help="Whether to tokenize sourcecodes with Lua lexer (drops comments). "
+        "The model has to be trained with the same setting.",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=WORKERS,
+        help="Number of processes computing embeddings; each of them needs the model in memory.",
+    )
+    parser.add_argument(
+        "--clustering",
+        "-cl",
+        choices=list(CLUSTERING_BACKENDS),
+        default="optics",
+        help="Clustering algorithm: optics (exact, quadratic time), kmeans (mini-batch k-means) "
+        "or knn-density (density-based clustering over k-NN graph); the last two scale near-linearly.",
+    )
     local_data = parser.add_argument_group(
         title="Info for connecting to Toolforge from local pc"
     )
@@ -383,4 +629,7 @@ if __name__ == "__main__":
         args.user_db_port,
         args.user,
         args.password,
+        args.lexer,
+        args.workers,
+        args.clustering,
     )
@@ -0,0 +1,153 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+
+from utils.db_query import (
+    query_data_generator,
+    save_data,
+    get_dedup_stats,
+    print_dedup_ratio,
+)
+from utils.sourcecode_processing import get_features, FEATURES
+from utils.sourcecode_codec import decode
+
+WORKERS = 4
+CHUNK_SIZE = 500  # sourcecodes fetched, analyzed and saved at once
+POOL_CHUNK_SIZE = 20  # sourcecodes sent to a worker process at once
+
+
+def extract(data):
+    """
+    Decodes stored sourcecode and calculates its features; run in worker processes.
+
+    :param data: sourcecode, as stored in Sourcecodes table.
+    :return: list of values of FEATURES
+    """
+    features = get_features(decode(data))
+    return [features[name] for name in FEATURES]
+
+
+def extract_features(
+    full_run=False, user_db_port=None, user=None, password=None, workers=WORKERS
+):
+    """
+    Calculates static features of modules' sourcecodes (see utils.sourcecode_processing.get_features)
+    and saves them into Scripts table. Every distinct sourcecode is analyzed once.
+    The hash of the analyzed sourcecode is saved into features_hash, so the modules,
+    which haven't changed since they were analyzed, are skipped.
+
+    :param full_run: whether to analyze all the modules, even the unchanged ones.
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :param workers: number of processes analyzing sourcecodes; 1 to analyze them in this process.
+    :return: None
+    """
+    query = (
+        "SELECT content_hash, sourcecode "
+        "FROM Sourcecodes "
+        "WHERE {keyset} AND content_hash IN "
+        "    (SELECT content_hash FROM Scripts WHERE %s)"
+    )
+    condition = "TRUE" if full_run else "NOT (features_hash <=> content_hash)"
+
+    cols = ["content_hash", "sourcecode"]
+    function_name = "extract_features"
+
+    pages, distinct = get_dedup_stats(user_db_port, user, password, condition)
+    if not full_run:
+        total, _ = get_dedup_stats(user_db_port, user, password)
+        print("Skipping %d unchanged modules of %d." % (total - pages, total))
+    query = query % condition
+
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    try:
+        for df in query_data_generator(
+            query,
+            function_name,
+            cols,
+            db="user_db",
+            replicas=False,
+            user_db_port=user_db_port,
+            user=user,
+            password=password,
+            row_count=CHUNK_SIZE,
+            key="content_hash",
+            text_cols=["content_hash"],
+        ):
+            if executor:
+                results = executor.map(
+                    extract, df["sourcecode"], chunksize=POOL_CHUNK_SIZE
+                )
+            else:
+                results = map(extract, df["sourcecode"])
+            features = pd.DataFrame(list(results), columns=FEATURES)
+            features.insert(0, "content_hash", df["content_hash"].values)
+            features["features_hash"] = features["content_hash"]
+            save_data(
+                features,
+                "user_db",
+                function_name,
+                user_db_port,
+                user,
+                password,
+                key_cols=["content_hash"],
+            )
+    finally:
+        if executor:
+            executor.shutdown()
+
+    print_dedup_ratio(pages, distinct, "Analyzed")
+    print("Done extracting features of Lua scripts.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Calculates static features of modules (number of functions, dependencies, "
+        "exported keys, tokens, branching and share of literal data) and saves them in Scripts table. "
+        "By default only modules, which changed since the last run, are analyzed."
+        "To use from local PC, provide all the additional flags needed for "
+        "establishing connection through ssh tunneling."
+        "More help available at "
+        "https://wikitech.wikimedia.org/wiki/Help:Toolforge/Database#SSH_tunneling_for_local_testing_which_makes_use_of_Wiki_Replica_databases"
+    )
+    parser.add_argument(
+        "--full-run",
+        "-f",
+        action="store_true",
+        help="Set to analyze all the modules, even the unchanged ones.",
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=WORKERS,
+        help="Number of processes analyzing sourcecodes.",
+    )
+    local_data = parser.add_argument_group(
+        title="Info for connecting to Toolforge from local pc"
+    )
+    local_data.add_argument(
+        "--user-db-port",
+        "-udb",
+        type=int,
+        default=None,
+        help="Port for connecting to tables, created by user in Toolforge, "
+        "through ssh tunneling, if used.",
+    )
+    local_data.add_argument(
+        "--user", "-u", type=str, default=None, help="Toolforge username of the tool."
+    )
+    local_data.add_argument(
+        "--password",
+        "-p",
+        type=str,
+        default=None,
+        help="Toolforge password of the tool.",
+    )
+    args = parser.parse_args()
+
+    extract_features(
+        args.full_run, args.user_db_port, args.user, args.password, args.workers
+    )
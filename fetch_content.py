@@ -1,5 +1,8 @@
 import sys
-import mwapi
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import toolforge
 import pandas as pd
 import pymysql
@@ -7,6 +10,16 @@ import numpy as np
 import argparse
 from urllib.parse import unquote
 import utils.db_access as db_acc
+import utils.api_access as api_acc
+import utils.sourcecode_codec as codec
+from utils.db_query import (
+    bulk_upsert,
+    save_sourcecodes,
+    get_content_hash,
+    get_dedup_stats,
+    print_dedup_ratio,
+    BATCH_SIZE,
+)
 import constants
 
 pymysql.converters.encoders[np.int64] = pymysql.converters.escape_int
@@ -15,6 +28,10 @@ pymysql.converters.conversions.update(pymysql.converters.decoders)
 
 ## define constants
 MIN_IDX = 0
+API_MULTI_LIMIT = 50  # max number of values the API accepts in a multi-value parameter (revids, pageids)
+WIKI_DBNAMES = {}  # url-dbname mapping, filled by get_dbname
+CHECKPOINT_MAX_AGE = 72  # hours; older crawls belong to the previous cycle
+WORKERS = 16  # wikis crawled at the same time; more than api_acc.MAX_CONNECTIONS, so the limit throttles
 
 
 def get_wiki_list(start_idx, end_idx, user_db_port=None, user=None, password=None):
@@ -22,7 +39,7 @@ def get_wiki_list(start_idx, end_idx, user_db_port=None, user=None, password=Non
     Fetches urls of all wikis and chooses the ones in the given indexes (both start and end indexes are included).
 
     :param start_idx: starting index of the wikis, which should be processed.
-    :param end_idx: starting index of the wikis, which should be processed.
+    :param end_idx: ending index of the wikis, which should be processed; None means up to the last wiki.
     :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
     :param user: Toolforge username of the tool.
     :param password: Toolforge password of the tool.
@@ -36,7 +53,9 @@ def get_wiki_list(start_idx, end_idx, user_db_port=None, user=None, password=Non
             cur.execute(
                 "select url from Sources where url is not NULL"
             )  # all, except 'meta'
-            ret = [wiki[0] for wiki in cur][start_idx : end_idx + 1]
+            ret = [wiki[0] for wiki in cur][
+                start_idx : (end_idx + 1 if end_idx is not None else None)
+            ]
         conn.close()
         return ret
     except Exception as err:
@@ -44,11 +63,47 @@ def get_wiki_list(start_idx, end_idx, user_db_port=None, user=None, password=Non
         exit(1)
 
 
+def get_dbname(wiki, user_db_port=None, user=None, password=None):
+    """
+    Returns dbname of the wiki. The url-dbname mapping of all the wikis is fetched
+    from Sources table only once per run.
+
+    :param wiki: url of the wiki.
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :return: dbname of the wiki
+    """
+    if not WIKI_DBNAMES:
+        try:
+            conn = db_acc.connect_to_user_database(
+                constants.DATABASE_NAME, user_db_port, user, password
+            )
+            with conn.cursor() as cur:
+                cur.execute("SELECT url, dbname FROM Sources WHERE url IS NOT NULL")
+                WIKI_DBNAMES.update({data[0]: data[1] for data in cur})
+            conn.close()
+        except Exception as err:
+            print("Something went wrong.\n", err)
+            raise
+
+    return WIKI_DBNAMES[wiki]
+
+
 def save_content(
-    wiki, data_list, in_api, in_database, user_db_port=None, user=None, password=None
+    wiki,
+    data_list,
+    in_api,
+    in_database,
+    user_db_port=None,
+    user=None,
+    password=None,
+    batch_size=BATCH_SIZE,
+    codec_name=codec.DEFAULT_CODEC,
 ):
     """
-    Saves data into Scripts table.
+    Saves data into Scripts table. Sourcecodes are stored once per distinct content in Sourcecodes table,
+    Scripts references them by content_hash.
 
     :param wiki: The wiki project corresponding to the data provided.
     :param data_list: The data to be saved in Scripts table.
@@ -57,7 +112,9 @@ def save_content(
     :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
     :param user: Toolforge username of the tool.
     :param password: Toolforge password of the tool.
-    :return: None
+    :param batch_size: Maximum number of rows written with one statement.
+    :param codec_name: Format, in which new sourcecodes are stored, see utils.sourcecode_codec.
+    :return: True if the data was saved, False otherwise
     """
     data_df = pd.DataFrame(
         data_list,
@@ -73,56 +130,63 @@ def save_content(
         ],
     )
 
-    query = (
-        "INSERT INTO Scripts(dbname, page_id, title, sourcecode, touched, "
-        "in_api, in_database, length, content_model, lastrevid, url) "
-        "VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s) "
-        "ON DUPLICATE KEY UPDATE title = %s, sourcecode = %s, touched = %s, in_api = %s, in_database = %s, "
-        "length = %s, content_model = %s, lastrevid = %s, url = %s, is_missed=%s"
-    )
+    cols = [
+        "dbname",
+        "page_id",
+        "title",
+        "content_hash",
+        "touched",
+        "in_api",
+        "in_database",
+        "length",
+        "content_model",
+        "lastrevid",
+        "url",
+        "is_missed",
+    ]
     try:
+        dbname = get_dbname(wiki, user_db_port, user, password)
+        data_df["content_hash"] = [
+            get_content_hash(content) for content in data_df["content"]
+        ]
+        sourcecodes = dict(zip(data_df["content_hash"], data_df["content"]))
+        rows = [
+            [
+                dbname,
+                elem["id"],
+                elem["title"],
+                elem["content_hash"],
+                elem["touched"].replace("T", " ").replace("Z", " "),
+                in_api,
+                in_database,
+                elem["length"],
+                elem["content_model"],
+                elem["lastrevid"],
+                elem["url"],
+                0,
+            ]
+            for elem in data_df.to_dict("records")
+        ]
+
         conn = db_acc.connect_to_user_database(
             constants.DATABASE_NAME, user_db_port, user, password
         )
         with conn.cursor() as cur:
-            cur.execute("SELECT dbname FROM Sources WHERE url = %s", wiki)
-            dbname = cur.fetchone()[0]
-            for index, elem in data_df.iterrows():
-                time = elem["touched"].replace("T", " ").replace("Z", " ")
-                cur.execute(
-                    query,
-                    [
-                        dbname,
-                        elem["id"],
-                        elem["title"],
-                        elem["content"],
-                        time,
-                        in_api,
-                        in_database,
-                        elem["length"],
-                        elem["content_model"],
-                        elem["lastrevid"],
-                        elem["url"],
-                        elem["title"],
-                        elem["content"],
-                        time,
-                        in_api,
-                        in_database,
-                        elem["length"],
-                        elem["content_model"],
-                        elem["lastrevid"],
-                        elem["url"],
-                        0,
-                    ],
-                )
+            # sourcecodes go first, so Scripts never references a missing one
+            save_sourcecodes(cur, sourcecodes, batch_size, codec_name)
+            bulk_upsert(cur, "Scripts", cols, rows, cols[2:], batch_size)
         conn.commit()
         conn.close()
+        return True
     except Exception as err:
         print("Error saving pages from", wiki)
         print(err)
+        return False
 
 
-def save_missed_content(wiki, missed, user_db_port=None, user=None, password=None):
+def save_missed_content(
+    wiki, missed, user_db_port=None, user=None, password=None, batch_size=BATCH_SIZE
+):
     """
     Mark missed pages as is_missed=True in Scripts table.
 
@@ -131,160 +195,567 @@ def save_missed_content(wiki, missed, user_db_port=None, user=None, password=Non
     :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
     :param user: Toolforge username of the tool.
     :param password: Toolforge password of the tool.
+    :param batch_size: Maximum number of rows written with one statement.
     :return: None
     """
     missed_df = pd.DataFrame(missed, columns=["id"])
 
+    cols = ["dbname", "page_id", "in_api", "is_missed"]
+    try:
+        dbname = get_dbname(wiki, user_db_port, user, password)
+        rows = [[dbname, page_id, 1, 1] for page_id in missed_df["id"].tolist()]
+
+        conn = db_acc.connect_to_user_database(
+            constants.DATABASE_NAME, user_db_port, user, password
+        )
+        with conn.cursor() as cur:
+            bulk_upsert(cur, "Scripts", cols, rows, cols[2:], batch_size)
+        conn.commit()
+        conn.close()
+    except Exception as err:
+        print("Something went wrong.\n", err)
+        raise
+
+
+def get_stored_revisions(wiki, user_db_port=None, user=None, password=None):
+    """
+    Fetches revision info of the modules from the given wiki, which are already stored in Scripts table
+    with their sourcecode in Sourcecodes table. Modules without content_hash (stored before
+    deduplication) aren't returned, so they are refetched.
+
+    :param wiki: The wiki project, whose modules' info is needed.
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :return: dictionary in form {page_id: (lastrevid, touched)}
+    """
     query = (
-        "INSERT INTO Scripts(dbname, page_id, in_api, is_missed) "
-        "values(%s, %s, %s, %s) "
-        "ON DUPLICATE KEY UPDATE in_api = %s, is_missed = %s"
+        "SELECT page_id, lastrevid, touched "
+        "FROM Scripts "
+        "INNER JOIN Sources "
+        "    ON Sources.dbname=Scripts.dbname "
+        "    AND Sources.url=%s "
+        "WHERE is_missed=0 AND content_hash IS NOT NULL"
     )
     try:
         conn = db_acc.connect_to_user_database(
             constants.DATABASE_NAME, user_db_port, user, password
         )
         with conn.cursor() as cur:
-            cur.execute("SELECT dbname FROM Sources WHERE url = %s", wiki)
-            dbname = cur.fetchone()[0]
-            for index, elem in missed_df.iterrows():
-                cur.execute(query, [dbname, elem["id"], 1, 1, 1, 1])
-        conn.commit()
+            cur.execute(query, wiki)
+            ret = {data[0]: (data[1], data[2]) for data in cur}
         conn.close()
+        return ret
     except Exception as err:
         print("Something went wrong.\n", err)
-        exit(1)
+        raise
 
 
-def needs_update(wiki, pageid, title, touched, revid):
-    return True
+def get_checkpoint(wiki, user_db_port=None, user=None, password=None):
+    """
+    Fetches the crawl checkpoint of the wiki from Checkpoints table.
 
+    :param wiki: The wiki project, whose checkpoint is needed.
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :return: dictionary with keys revise, status, gapcontinue, continue, loaded, missed, age (hours since
+    the crawl was started); None if the wiki has no checkpoint
+    """
+    query = (
+        "SELECT revise, status, gapcontinue, api_continue, loaded, missed, "
+        "TIMESTAMPDIFF(SECOND, started_at, UTC_TIMESTAMP()) / 3600 "
+        "FROM Checkpoints "
+        "INNER JOIN Sources "
+        "    ON Sources.dbname=Checkpoints.dbname "
+        "    AND Sources.url=%s"
+    )
+    try:
+        conn = db_acc.connect_to_user_database(
+            constants.DATABASE_NAME, user_db_port, user, password
+        )
+        with conn.cursor() as cur:
+            cur.execute(query, wiki)
+            row = cur.fetchone()
+        conn.close()
+    except Exception as err:
+        print("Something went wrong.\n", err)
+        raise
 
-def get_contents(wikis, revise=False, user_db_port=None, user=None, password=None):
+    if row is None:
+        return None
+    keys = ["revise", "status", "gapcontinue", "continue", "loaded", "missed", "age"]
+    return dict(zip(keys, row))
+
+
+def save_checkpoint(
+    wiki,
+    status,
+    revise,
+    gapcontinue,
+    api_continue,
+    loaded,
+    missed,
+    new=False,
+    user_db_port=None,
+    user=None,
+    password=None,
+):
+    """
+    Saves the crawl progress of the wiki into Checkpoints table.
+
+    :param wiki: The wiki project, whose progress is saved.
+    :param status: 'running' while the wiki is being crawled, 'done' after the last page was loaded.
+    :param revise: Whether the crawl only revises the stored contents.
+    :param gapcontinue: `gapcontinue` value of the next API request.
+    :param api_continue: `continue` value of the next API request.
+    :param loaded: Number of pages loaded so far.
+    :param missed: Number of pages missed so far.
+    :param new: Whether a new crawl of the wiki is started; if so, its start time is saved.
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :return: None
+    """
+    query = (
+        "INSERT INTO Checkpoints(dbname, revise, status, gapcontinue, api_continue, "
+        "loaded, missed, started_at, updated_at) "
+        "VALUES(%s, %s, %s, %s, %s, %s, %s, UTC_TIMESTAMP(), UTC_TIMESTAMP()) "
+        "ON DUPLICATE KEY UPDATE revise=VALUES(revise), status=VALUES(status), "
+        "gapcontinue=VALUES(gapcontinue), api_continue=VALUES(api_continue), "
+        "loaded=VALUES(loaded), missed=VALUES(missed), updated_at=VALUES(updated_at), "
+        "started_at=IF(%s, VALUES(started_at), started_at)"
+    )
+    try:
+        dbname = get_dbname(wiki, user_db_port, user, password)
+        conn = db_acc.connect_to_user_database(
+            constants.DATABASE_NAME, user_db_port, user, password
+        )
+        with conn.cursor() as cur:
+            cur.execute(
+                query,
+                (
+                    dbname,
+                    revise,
+                    status,
+                    gapcontinue,
+                    api_continue,
+                    loaded,
+                    missed,
+                    new,
+                ),
+            )
+        conn.commit()
+        conn.close()
+    except Exception as err:
+        print("Error saving checkpoint of", wiki)
+        print(err)
+
+
+def needs_update(stored_revisions, pageid, revid):
+    """
+    Checks whether the content of the page has to be (re-)fetched.
+    Only the revision is compared, as `touched` also changes on every re-render of the page,
+    e.g. when a module it depends on is edited.
+
+    :param stored_revisions: dictionary in form {page_id: (lastrevid, touched)}, see get_stored_revisions.
+    :param pageid: Id of the page.
+    :param revid: Id of the latest revision of the page.
+    :return: True if the page is not stored yet or was edited since it was stored, False otherwise.
+    """
+    if pageid not in stored_revisions:
+        return True
+    return stored_revisions[pageid][0] != revid
+
+
+def get_revisions_content(session, wiki, revids, parallel=False):
+    """
+    Fetches contents of the given revisions, requesting up to API_MULTI_LIMIT revisions per API call.
+    An error while fetching one batch doesn't affect the other batches.
+
+    :param session: mwapi.Session, connected to the wiki.
+    :param wiki: The wiki project, from which the revisions are fetched.
+    :param revids: List of revision ids, whose contents are needed.
+    :param parallel: Whether to request all the batches at once; the session's RequestLimiter
+            decides how many of them actually run at the same time.
+    :return: dictionary in form {revid: (content, content_model)}; revisions that couldn't be fetched are absent.
+    """
+
+    def get_batch(batch):
+        params = {
+            "action": "query",
+            "format": "json",
+            "prop": "revisions",
+            "revids": "|".join(str(revid) for revid in batch),
+            "rvprop": "ids|content",
+            "rvslots": "main",
+            "formatversion": 2,
+        }
+        batch_contents = {}
+
+        try:
+            # big contents may not fit into one response, so continuation is followed
+            for result in session.get(params, continuation=True):
+                for page in result["query"]["pages"]:
+                    for revision in page.get("revisions", []):
+                        content_info = revision["slots"]["main"]
+                        if "content" in content_info:
+                            batch_contents[revision["revid"]] = (
+                                content_info["content"],
+                                content_info["contentmodel"],
+                            )
+        except Exception as e:
+            print("Could not GET contents from", wiki, "\n", e)
+        return batch_contents
+
+    batches = [
+        revids[i : i + API_MULTI_LIMIT] for i in range(0, len(revids), API_MULTI_LIMIT)
+    ]
+    contents = {}
+    if parallel and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=len(batches)) as executor:
+            for batch_contents in executor.map(get_batch, batches):
+                contents.update(batch_contents)
+    else:
+        for batch in batches:
+            contents.update(get_batch(batch))
+
+    return contents
+
+
+def get_wiki_contents(
+    wiki,
+    revise=False,
+    limiter=None,
+    fresh=False,
+    user_db_port=None,
+    user=None,
+    password=None,
+    codec_name=codec.DEFAULT_CODEC,
+):
     """
     Connects to the wiki by using API, fetches Scribunto modules and additional info from there
     and saves them to the user's database.
 
+    Progress is saved into Checkpoints table after every saved batch of pages. If the crawl of the wiki
+    was started less than CHECKPOINT_MAX_AGE hours ago, an unfinished crawl is resumed from its
+    checkpoint and a finished one is skipped.
+
     Possible ways for the process to fail:
     1. Failed to connect to wiki (See from output)
     2. Connected but could not GET wiki (See from output)
     3. Could not grab a page (Listed in missed pages)
 
-    :param wikis: list of urls of wikis, from which the modules will be collected
+    :param wiki: url of the wiki, from which the modules will be collected
     :param revise: `False` collects all contents and saves fresh
-            `True` only collects those that have been edited
+            `True` only collects those that have been edited since they were stored in Scripts table
+    :param limiter: utils.api_access.RequestLimiter to send API requests through, if used.
+    :param fresh: Whether to start the crawl from the beginning, ignoring the saved checkpoint.
     :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
     :param user: Toolforge username of the tool.
     :param password: Toolforge password of the tool.
-    :return: None
+    :param codec_name: Format, in which new sourcecodes are stored, see utils.sourcecode_codec.
+    :return: number of pages loaded by this run
     """
-    for wiki in wikis:
+    data_list = []
+    cnt_data_list = 0
+    missed = []
+    cnt_missed = 0
+    cnt_skipped = 0
+    cnt_refetched = 0
+    _gapcontinue = ""
+    _continue = ""
+    finished = False
+    saved = True  # whether all the loaded pages were saved, so the checkpoint may move
+
+    checkpoint = None if fresh else get_checkpoint(wiki, user_db_port, user, password)
+    if (
+        checkpoint is not None
+        and bool(checkpoint["revise"]) == revise
+        and checkpoint["age"] is not None
+        and checkpoint["age"] < CHECKPOINT_MAX_AGE
+    ):
+        if checkpoint["status"] == "done":
+            print("Skipping %s, already loaded in this cycle" % wiki)
+            return 0
+        _gapcontinue = checkpoint["gapcontinue"] or ""
+        _continue = checkpoint["continue"] or ""
+        cnt_data_list = checkpoint["loaded"]
+        cnt_missed = checkpoint["missed"]
+        print("Resuming %s after %d loaded pages..." % (wiki, cnt_data_list))
+    else:
+        save_checkpoint(
+            wiki, "running", revise, "", "", 0, 0, True, user_db_port, user, password
+        )
+    cnt_resumed = cnt_data_list
+
+    try:
+        session = api_acc.create_session(wiki, limiter)
+    except Exception as e:
+        print("Failed to connect to", wiki, "\n", e)
+        return 0
+
+    if revise:
+        stored_revisions = get_stored_revisions(wiki, user_db_port, user, password)
+
+    while True:
+        params = {
+            "action": "query",
+            "generator": "allpages",
+            "gapnamespace": 828,
+            "gaplimit": 300,
+            "format": "json",
+            "prop": "info",
+            "inprop": "url",
+            "gapcontinue": _gapcontinue,
+            "continue": _continue,
+        }
+
         try:
-            session = mwapi.Session(wiki, user_agent="abstract-wiki-ds")
+            result = session.get(params)
         except Exception as e:
-            print("Failed to connect to", wiki, "\n", e)
-            continue
+            print("Could not GET", wiki, "\n", e)
+            break
 
-        data_list = []
-        cnt_data_list = 0
-        missed = []
-        cnt_missed = 0
-        _gapcontinue = ""
-        _continue = ""
+        if "query" in result.keys():
+            pages = []
+            for page in list(result["query"]["pages"].values()):
+                try:
+                    pageid = page["pageid"]
+                    title = page["title"]
+                    touched = page["touched"]
+                    length = page["length"]
+                    url = unquote(page["fullurl"])
+                    revid = page["lastrevid"]
 
-        while True:
-            params = {
-                "action": "query",
-                "generator": "allpages",
-                "gapnamespace": 828,
-                "gaplimit": 300,
-                "format": "json",
-                "prop": "info",
-                "inprop": "url",
-                "gapcontinue": _gapcontinue,
-                "continue": _continue,
-            }
+                    if (not revise) or needs_update(stored_revisions, pageid, revid):
+                        pages.append([pageid, title, url, length, touched, revid])
+                    else:
+                        cnt_skipped += 1
+                except Exception as err:
+                    if "pageid" in page.keys():
+                        missed.append([page["pageid"]])
+                        print(
+                            "Miss:",
+                            wiki,
+                            page.get("title"),
+                            page["pageid"],
+                            "\n",
+                            err,
+                        )
 
-            try:
-                result = session.get(params)
-            except Exception as e:
-                print("Could not GET", wiki, "\n", e)
-                break
-
-            if "query" in result.keys():
-                for page in list(result["query"]["pages"].values()):
-                    try:
-                        pageid = page["pageid"]
-                        title = page["title"]
-                        touched = page["touched"]
-                        length = page["length"]
-                        url = unquote(page["fullurl"])
-                        revid = page["lastrevid"]
-
-                        if (not revise) or needs_update(
-                            wiki, pageid, title, touched, revid
-                        ):
-                            params = {
-                                "action": "query",
-                                "format": "json",
-                                "prop": "revisions",
-                                "revids": revid,
-                                "rvprop": "content",
-                                "rvslots": "main",
-                                "formatversion": 2,
-                            }
-
-                            rev_result = session.get(params)
-
-                            content_info = rev_result["query"]["pages"][0]["revisions"][
-                                0
-                            ]["slots"]["main"]
-                            content = content_info["content"]
-                            content_model = content_info["contentmodel"]
-
-                            if content_model == "Scribunto":
-                                data_list.append(
-                                    [
-                                        pageid,
-                                        title,
-                                        url,
-                                        length,
-                                        content,
-                                        content_model,
-                                        touched,
-                                        revid,
-                                    ]
-                                )
-                    except Exception as err:
-                        if "pageid" in page.keys():
-                            missed.append([pageid])
-                            print("Miss:", wiki, title, pageid, "\n", err)
-
-                cnt_data_list += len(data_list)
-                cnt_missed += len(missed)
-                save_missed_content(wiki, missed, user_db_port, user, password)
-                save_content(wiki, data_list, 1, 0, user_db_port, user, password)
-                print(cnt_data_list, "pages loaded...")
-                data_list, missed = [], []
+            cnt_refetched += len(pages)
+            contents = get_revisions_content(
+                session, wiki, [page[-1] for page in pages], limiter is not None
+            )
 
-            try:
-                _continue = result["continue"]["continue"]
-                _gapcontinue = (
-                    result["continue"]["gapcontinue"]
-                    if "gapcontinue" in result["continue"]
-                    else ""
+            for pageid, title, url, length, touched, revid in pages:
+                if revid not in contents:
+                    missed.append([pageid])
+                    print("Miss:", wiki, title, pageid, "\n", "No content fetched")
+                    continue
+
+                content, content_model = contents[revid]
+                if content_model == "Scribunto":
+                    data_list.append(
+                        [
+                            pageid,
+                            title,
+                            url,
+                            length,
+                            content,
+                            content_model,
+                            touched,
+                            revid,
+                        ]
+                    )
+
+            cnt_data_list += len(data_list)
+            cnt_missed += len(missed)
+            save_missed_content(wiki, missed, user_db_port, user, password)
+            saved = (
+                save_content(
+                    wiki,
+                    data_list,
+                    1,
+                    0,
+                    user_db_port,
+                    user,
+                    password,
+                    codec_name=codec_name,
                 )
-            except:
-                break
+                and saved
+            )
+            print(cnt_data_list, "pages loaded from %s..." % wiki)
+            data_list, missed = [], []
+
+        try:
+            _continue = result["continue"]["continue"]
+            _gapcontinue = (
+                result["continue"]["gapcontinue"]
+                if "gapcontinue" in result["continue"]
+                else ""
+            )
+        except:
+            finished = True
+            break
 
+        if saved:
+            save_checkpoint(
+                wiki,
+                "running",
+                revise,
+                _gapcontinue,
+                _continue,
+                cnt_data_list,
+                cnt_missed,
+                False,
+                user_db_port,
+                user,
+                password,
+            )
+
+    if finished and saved:
+        save_checkpoint(
+            wiki,
+            "done",
+            revise,
+            "",
+            "",
+            cnt_data_list,
+            cnt_missed,
+            False,
+            user_db_port,
+            user,
+            password,
+        )
+
+    print(
+        "All pages loaded for %s. Missed: %d, Loaded: %d"
+        % (wiki, cnt_missed, cnt_data_list)
+    )
+    if revise:
         print(
-            "All pages loaded for %s. Missed: %d, Loaded: %d"
-            % (wiki, cnt_missed, cnt_data_list)
+            "Revised %s. Skipped unchanged: %d, Refetched: %d"
+            % (wiki, cnt_skipped, cnt_refetched)
+        )
+
+    return cnt_data_list - cnt_resumed
+
+
+def get_contents(
+    wikis,
+    revise=False,
+    fresh=False,
+    user_db_port=None,
+    user=None,
+    password=None,
+    codec_name=codec.DEFAULT_CODEC,
+):
+    """
+    Fetches Scribunto modules from the wikis one after another, see get_wiki_contents.
+
+    :param wikis: list of urls of wikis, from which the modules will be collected
+    :param revise: `False` collects all contents and saves fresh
+            `True` only collects those that have been edited since they were stored in Scripts table
+    :param fresh: Whether to crawl the wikis from the beginning, ignoring the saved checkpoints.
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :param codec_name: Format, in which new sourcecodes are stored, see utils.sourcecode_codec.
+    :return: None
+    """
+    for wiki in wikis:
+        get_wiki_contents(
+            wiki, revise, None, fresh, user_db_port, user, password, codec_name
         )
 
     print("Done loading!")
 
 
+def crawl_contents(
+    wikis,
+    revise=False,
+    workers=WORKERS,
+    connections=api_acc.MAX_CONNECTIONS,
+    host_connections=api_acc.MAX_HOST_CONNECTIONS,
+    fresh=False,
+    user_db_port=None,
+    user=None,
+    password=None,
+    codec_name=codec.DEFAULT_CODEC,
+):
+    """
+    Fetches Scribunto modules from many wikis at once, see get_wiki_contents.
+    Worker threads take wikis from a shared queue, so a thread, which finished a small wiki,
+    just takes the next one. Every worker requests the content batches of its wiki at the same time,
+    and API requests are limited both in total and per host, independently of the number of workers.
+
+    :param wikis: list of urls of wikis, from which the modules will be collected
+    :param revise: `False` collects all contents and saves fresh
+            `True` only collects those that have been edited since they were stored in Scripts table
+    :param workers: number of wikis processed at the same time.
+    :param connections: maximum number of simultaneous API requests to all hosts.
+    :param host_connections: maximum number of simultaneous API requests to a single host.
+    :param fresh: Whether to crawl the wikis from the beginning, ignoring the saved checkpoints.
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :param codec_name: Format, in which new sourcecodes are stored, see utils.sourcecode_codec.
+    :return: None
+    """
+    wiki_queue = queue.Queue()
+    for wiki in wikis:
+        wiki_queue.put(wiki)
+
+    limiter = api_acc.RequestLimiter(connections, host_connections)
+    lock = threading.Lock()
+    cnt_loaded = 0
+    failed = []
+
+    def work():
+        nonlocal cnt_loaded
+        while True:
+            try:
+                wiki = wiki_queue.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                loaded = get_wiki_contents(
+                    wiki,
+                    revise,
+                    limiter,
+                    fresh,
+                    user_db_port,
+                    user,
+                    password,
+                    codec_name,
+                )
+            except Exception as err:
+                # the worker goes on with the next wiki; KeyboardInterrupt and SystemExit stop the crawl
+                print("Something went wrong loading", wiki, "\n", repr(err))
+                with lock:
+                    failed.append(wiki)
+                continue
+            with lock:
+                cnt_loaded += loaded
+
+    start_time = time.time()
+    threads = [threading.Thread(target=work) for _ in range(min(workers, len(wikis)))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start_time
+
+    print(
+        "Done loading! %d pages from %d wikis in %.1f s (%.2f pages/s)"
+        % (cnt_loaded, len(wikis), elapsed, cnt_loaded / max(elapsed, 1e-9))
+    )
+    if failed:
+        print("Failed to load %d wikis: %s" % (len(failed), ", ".join(failed)))
+
+
 def get_db_map(wikis=[], dbs=[], user_db_port=None, user=None, password=None):
     """
     Fetches info from the users database about the wikis with given dbnames or urls.
@@ -326,10 +797,115 @@ def get_db_map(wikis=[], dbs=[], user_db_port=None, user=None, password=None):
     return db_map, placeholders
 
 
-def get_pages(df, in_api, in_database, user_db_port=None, user=None, password=None):
+def get_pages_batch(session, wiki, pageids):
+    """
+    Fetches content and info of the pages with a single API request. If the request fails
+    (even after retries, see utils.api_access.get_with_retries), the batch is split in two
+    and both halves are fetched separately, so a single bad page doesn't sink the others.
+
+    :param session: mwapi.Session of the wiki, see utils.api_access.create_session.
+    :param wiki: url of the wiki.
+    :param pageids: list of at most API_MULTI_LIMIT page ids.
+    :return: (data_list, missed) - rows of the fetched modules as used by save_content,
+    and lists [pageid] of the missed pages
+    """
+
+    def split():
+        middle = len(pageids) // 2
+        first_data, first_missed = get_pages_batch(session, wiki, pageids[:middle])
+        second_data, second_missed = get_pages_batch(session, wiki, pageids[middle:])
+        return first_data + second_data, first_missed + second_missed
+
+    params = {
+        "action": "query",
+        "format": "json",
+        "prop": "revisions|info",
+        "pageids": "|".join(str(pageid) for pageid in pageids),
+        "rvprop": "content",
+        "rvslots": "main",
+        "inprop": "url",
+        "formatversion": 2,
+    }
+
+    try:
+        result = api_acc.get_with_retries(session, params)
+        pages = result["query"]["pages"]
+    except Exception as err:
+        if len(pageids) > 1:
+            return split()
+        print("Miss:", pageids[0], "from wiki:", wiki, "\n", err)
+        return [], [[pageids[0]]]
+
+    data_list = []
+    missed = []
+    unfinished = []  # pages, whose content didn't fit into the response
+    returned = set()
+
+    for page in pages:
+        pageid = page.get("pageid")
+        returned.add(pageid)
+        if "revisions" not in page and "missing" not in page and "continue" in result:
+            unfinished.append(pageid)
+            continue
+        try:
+            if page["lastrevid"] != 0:
+                url = unquote(page["fullurl"])
+                title = page["title"]
+                length = page["length"]
+                content_info = page["revisions"][0]["slots"]["main"]
+                content = content_info["content"]
+                content_model = content_info["contentmodel"]
+                touched = page["touched"]
+                revid = page["lastrevid"]
+
+                if content_model == "Scribunto":
+                    data_list.append(
+                        [
+                            pageid,
+                            title,
+                            url,
+                            length,
+                            content,
+                            content_model,
+                            touched,
+                            revid,
+                        ]
+                    )
+        except Exception as err:
+            missed.append([pageid])
+            print("Miss:", pageid, "from wiki:", wiki, "\n", err)
+
+    for pageid in pageids:
+        if pageid not in returned:
+            missed.append([pageid])
+            print("Miss:", pageid, "from wiki:", wiki, "\n", "Not returned by API")
+
+    if unfinished:
+        if len(unfinished) == len(pageids):
+            if len(pageids) > 1:
+                return split()
+            missed.append([pageids[0]])
+        else:
+            more_data, more_missed = get_pages_batch(session, wiki, unfinished)
+            data_list += more_data
+            missed += more_missed
+
+    return data_list, missed
+
+
+def get_pages(
+    df,
+    in_api,
+    in_database,
+    user_db_port=None,
+    user=None,
+    password=None,
+    codec_name=codec.DEFAULT_CODEC,
+):
     """
     Connects to the wikis from wiki field and fetches infomation for the pages with given page_id,
     then saving fetched content and missing content to the user's database.
+    Pages are requested in batches of API_MULTI_LIMIT, see get_pages_batch.
 
     :param df: dataframe with columns page_id, dbname, wiki (represents url of wiki). dbname is not required.
     :param in_api: the value to which in_api field will be set
@@ -337,62 +913,37 @@ def get_pages(df, in_api, in_database, user_db_port=None, user=None, password=No
     :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
     :param user: Toolforge username of the tool.
     :param password: Toolforge password of the tool.
+    :param codec_name: Format, in which new sourcecodes are stored, see utils.sourcecode_codec.
     :return: None
     """
     for wiki, w_df in df.groupby("wiki"):
         try:
-            session = mwapi.Session(wiki, user_agent="abstract-wiki-ds")
+            session = api_acc.create_session(wiki)
         except Exception as e:
             print("Failed to connect to", wiki, "\n", e)
             continue
 
-        pageids = w_df["page_id"].values
+        pageids = [int(pageid) for pageid in w_df["page_id"].values]
         data_list = []
         missed = []
 
-        for pageid in list(pageids):
-            params = {
-                "action": "query",
-                "format": "json",
-                "prop": "revisions|info",
-                "pageids": pageid,
-                "rvprop": "content",
-                "rvslots": "main",
-                "inprop": "url",
-                "formatversion": 2,
-            }
-
-            try:
-                result = session.get(params)
-                page = result["query"]["pages"][0]
-                if page["lastrevid"] != 0:
-                    url = unquote(page["fullurl"])
-                    title = page["title"]
-                    length = page["length"]
-                    content_info = page["revisions"][0]["slots"]["main"]
-                    content = content_info["content"]
-                    content_model = content_info["contentmodel"]
-                    touched = page["touched"]
-                    revid = page["lastrevid"]
-
-                    if content_model == "Scribunto":
-                        data_list.append(
-                            [
-                                pageid,
-                                title,
-                                url,
-                                length,
-                                content,
-                                content_model,
-                                touched,
-                                revid,
-                            ]
-                        )
-            except Exception as err:
-                missed.append([pageid])
-                print("Miss:", pageid, "from wiki:", wiki, "\n", err)
+        for idx in range(0, len(pageids), API_MULTI_LIMIT):
+            batch_data, batch_missed = get_pages_batch(
+                session, wiki, pageids[idx : idx + API_MULTI_LIMIT]
+            )
+            data_list += batch_data
+            missed += batch_missed
 
-        save_content(wiki, data_list, in_api, in_database, user_db_port, user, password)
+        save_content(
+            wiki,
+            data_list,
+            in_api,
+            in_database,
+            user_db_port,
+            user,
+            password,
+            codec_name=codec_name,
+        )
         save_missed_content(wiki, missed, user_db_port, user, password)
         print(
             "All pages loaded for %s. Missed: %d, Loaded: %d"
@@ -400,7 +951,9 @@ def get_pages(df, in_api, in_database, user_db_port=None, user=None, password=No
         )
 
 
-def get_missed_contents(wikis, user_db_port=None, user=None, password=None):
+def get_missed_contents(
+    wikis, user_db_port=None, user=None, password=None, codec_name=codec.DEFAULT_CODEC
+):
     """
     Retry fetching data for missed pages.
 
@@ -408,6 +961,7 @@ def get_missed_contents(wikis, user_db_port=None, user=None, password=None):
     :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
     :param user: Toolforge username of the tool.
     :param password: Toolforge password of the tool.
+    :param codec_name: Format, in which new sourcecodes are stored, see utils.sourcecode_codec.
     :return: None
     """
 
@@ -434,7 +988,7 @@ def get_missed_contents(wikis, user_db_port=None, user=None, password=None):
         exit(1)
 
     df["wiki"] = df["dbname"].map(db_map)
-    get_pages(df, 1, 0)
+    get_pages(df, 1, 0, user_db_port, user, password, codec_name)
     print("Done loading missed pages!")
 
 
@@ -448,8 +1002,8 @@ def index_type(x):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Updates Lua scripts and their additional info in database in Toolforge, "
-        "fetching info from Wikimedia API. For testing and parallelization sake, use start-idx and end-idx "
-        "parameters to choose which wikis from Sources table will be worked with."
+        "fetching info from Wikimedia API. By default all wikis from Sources table are crawled concurrently; "
+        "for testing sake, use start-idx and end-idx parameters to choose which wikis will be worked with."
         "To use from local PC, provide all the additional flags needed for "
         "establishing connection through ssh tunneling."
         "More help available at "
@@ -458,12 +1012,17 @@ if __name__ == "__main__":
     parser.add_argument(
         "start_idx",
         type=index_type,
+        nargs="?",
+        default=MIN_IDX,
         help="Starting index of info, fetched from database Sources, sorted by key (min=0).",
     )
     parser.add_argument(
         "end_idx",
         type=index_type,
-        help="Ending index of info, fetched from database Sources, sorted by key.(min=0)",
+        nargs="?",
+        default=None,
+        help="Ending index of info, fetched from database Sources, sorted by key.(min=0). "
+        "All wikis up to the last one are used, if not set.",
     )
     parser.add_argument(
         "--revise",
@@ -471,6 +1030,43 @@ if __name__ == "__main__":
         action="store_true",
         help="Whether content should be revised.",
     )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=int,
+        default=WORKERS,
+        help="Number of wikis crawled at the same time.",
+    )
+    parser.add_argument(
+        "--connections",
+        "-c",
+        type=int,
+        default=api_acc.MAX_CONNECTIONS,
+        help="Maximum number of simultaneous API requests to all hosts.",
+    )
+    parser.add_argument(
+        "--host-connections",
+        "-hc",
+        type=int,
+        default=api_acc.MAX_HOST_CONNECTIONS,
+        help="Maximum number of simultaneous API requests to a single host.",
+    )
+    parser.add_argument(
+        "--codec",
+        type=str,
+        choices=codec.available_codecs(),
+        default=codec.DEFAULT_CODEC,
+        help="Format, in which new sourcecodes are stored in Sourcecodes table: "
+        "plain utf8 or compressed.",
+    )
+    parser.add_argument(
+        "--fresh",
+        "-f",
+        action="store_true",
+        help="Whether to crawl all the wikis from the beginning. By default unfinished crawls, "
+        "started less than %d hours ago, are resumed from their checkpoints, "
+        "and finished ones are skipped." % CHECKPOINT_MAX_AGE,
+    )
     local_data = parser.add_argument_group(
         title="Info for connecting to Toolforge from local pc"
     )
@@ -494,11 +1090,27 @@ if __name__ == "__main__":
     )
     args = parser.parse_args()
 
-    if args.start_idx > args.end_idx:
+    if args.end_idx is not None and args.start_idx > args.end_idx:
         sys.exit("Error: Ending index must be greater than start index.")
 
     wikis = get_wiki_list(
         args.start_idx, args.end_idx, args.user_db_port, args.user, args.password
     )
-    get_contents(wikis, args.revise, args.user_db_port, args.user, args.password)
-    get_missed_contents(wikis, args.user_db_port, args.user, args.password)
+    crawl_contents(
+        wikis,
+        args.revise,
+        args.workers,
+        args.connections,
+        args.host_connections,
+        args.fresh,
+        args.user_db_port,
+        args.user,
+        args.password,
+        args.codec,
+    )
+    get_missed_contents(wikis, args.user_db_port, args.user, args.password, args.codec)
+
+    try:
+        print_dedup_ratio(*get_dedup_stats(args.user_db_port, args.user, args.password))
+    except Exception as err:
+        print("Could not count distinct sourcecodes.\n", err)
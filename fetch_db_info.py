@@ -1,14 +1,37 @@
-import numpy as np
+import time
+import datetime
 import argparse
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import pandas as pd
 import mwapi
+from pymysql.converters import escape_string
 
 import utils.db_access as db_acc
-from utils.db_query import query_data_generator, save_data, get_dbs
+from utils.db_query import (
+    query_data_generator,
+    save_data,
+    get_dbs,
+    encode_if_necessary,
+    get_watermark,
+    save_watermark,
+)
 from constants import DATABASE_NAME
 
+TEMPLATELINKS_WATERMARK = "get_templatelinks_info"
+WATERMARK_OVERLAP = 24 * 60 * 60  # seconds, covers replication lag between runs
+# transclusions of all modules are recounted at least this often; must stay below the 30 days,
+# for which recentchanges is kept on Wikimedia wikis, as incremental runs look for changed pages there
+FULL_RECOUNT_DAYS = 28
+TITLES_BATCH_SIZE = 500  # number of module titles recounted with one query
+IWLINKS_CHUNK_SIZE = 10000  # number of iwlinks rows processed at once
+
+IWLINKS_MAPS = {}
+IWLINKS_MAPS_LOCK = threading.Lock()
 
-def get_interwiki(user_db_port=None, user=None, password=None):
 
+def get_interwiki(user_db_port=None, user=None, password=None):
     """
     Get interwiki mapping from API and save in user database.
 
@@ -75,6 +98,7 @@ def get_revision_info(
         "    AND page_content_model='Scribunto' "
         "LEFT JOIN actor "
         "    ON rev_actor=actor_id "
+        "WHERE {keyset} "
         "GROUP BY page_id"
     )
 
@@ -96,10 +120,48 @@ def get_revision_info(
         user_db_port,
         user,
         password,
+        key="page_id",
     ):
         save_data(df, db, function_name, user_db_port, user, password)
 
 
+def get_iwlinks_maps(user_db_port=None, user=None, password=None):
+    """
+    Loads from user database the mappings needed to resolve interwiki links into modules;
+    they are loaded once per run and shared between the tasks.
+
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :return: ({prefix: url pattern with $1}, {module url: (dbname, page_id)})
+    """
+    with IWLINKS_MAPS_LOCK:
+        if not IWLINKS_MAPS:
+            conn = db_acc.connect_to_user_database(
+                DATABASE_NAME, user_db_port, user, password
+            )
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT prefix, url FROM Interwiki")
+                    prefixes = {
+                        encode_if_necessary(prefix): encode_if_necessary(url)
+                        for prefix, url in cur
+                    }
+                    cur.execute(
+                        "SELECT url, dbname, page_id FROM Scripts WHERE url IS NOT NULL"
+                    )
+                    modules = {
+                        encode_if_necessary(url): (encode_if_necessary(dbname), page_id)
+                        for url, dbname, page_id in cur
+                    }
+                conn.commit()
+            finally:
+                conn.close()
+            IWLINKS_MAPS["prefixes"] = prefixes
+            IWLINKS_MAPS["modules"] = modules
+        return IWLINKS_MAPS["prefixes"], IWLINKS_MAPS["modules"]
+
+
 def get_iwlinks_info(
     db, function_name, replicas_port=None, user_db_port=None, user=None, password=None
 ):
@@ -109,6 +171,10 @@ def get_iwlinks_info(
     `Module:` is not the only prefix for Scribunto modules. It is different for languages e.g `মডিউল:`, ماجول ,ماڈیول.
     So, url was matched with iwl_title.
 
+    iwlinks of the wiki are streamed and every link is expanded into url with the prefix pattern from
+    Interwiki table, which is then looked up among urls of the modules (see get_iwlinks_maps).
+    The number of distinct linking pages is added to iwls of every found module.
+
     :param db: The database to connect to and get data from.
     :param function_names: The name of this function, useful to save function name when data is missed.
     :param replicas_port: port for connecting to meta table through ssh tunneling, if used.
@@ -117,91 +183,65 @@ def get_iwlinks_info(
     :param password: Toolforge password of the tool.
     :return: None
     """
-
-    drop_query = "DROP TABLE IF EXISTS Iwlinks"
-    create_query = (
-        "CREATE TABLE Iwlinks ("
-        "    iwl_from INT UNSIGNED, "
-        "    iwl_prefix VARCHAR(20), "
-        "    iwl_title VARCHAR(255), "
-        "    PRIMARY KEY (iwl_from, iwl_prefix, iwl_title)"
-        ")"
-    )
-    insert_query = (
-        "INSERT INTO Iwlinks(iwl_from, iwl_prefix, iwl_title) "
-        "VALUES(%s, %s, %s) "
-        "ON DUPLICATE KEY UPDATE iwl_title = %s"
-    )
-    query = (
-        "SELECT page_id, dbname, COUNT(DISTINCT iwl_from) AS iwls "
-        "FROM Scripts "
-        "INNER JOIN "
-        "    ("
-        "        SELECT iwl_from, REPLACE(url, '$1', iwl_title) AS iwl_url "
-        "        FROM Interwiki "
-        "        INNER JOIN Iwlinks "
-        "        ON prefix=iwl_prefix "
-        "    ) AS iwl "
-        "ON url=iwl_url "
-        "GROUP BY page_id, dbname"
-    )
-    save_query = "UPDATE Scripts SET iwls = iwls + %s WHERE dbname=%s AND page_id=%s "
-    cols = ["iwls", "dbname", "page_id"]
-
     try:
-        conn_db = db_acc.connect_to_user_database(
-            DATABASE_NAME, user_db_port, user, password
+        prefixes, modules = get_iwlinks_maps(user_db_port, user, password)
+    except Exception as err:
+        print(
+            "Something went wrong. Could not get iwlinks info of %s\n" % db, repr(err)
         )
-        with conn_db.cursor() as db_cur:
-
-            db_cur.execute(drop_query)
-            db_cur.execute(create_query)
+        with open("missed_db_info.txt", "a") as file:
+            file.write(function_name + " " + db + "\n")
+        return
 
-            for df in query_data_generator(
-                "SELECT iwl_from, iwl_prefix, iwl_title FROM iwlinks",
-                function_name,
-                ["iwl_from", "iwl_prefix", "iwl_title"],
-                db,
-                replicas_port,
-                user_db_port,
-                user,
-                password,
-            ):
-                for index, elem in df.iterrows():
-                    params = list(np.concatenate((elem.values, elem.values[-1:])))
-                    db_cur.execute(insert_query, params)
-
-            for df in query_data_generator(
-                query,
+    linked_from = {}  # (dbname, page_id) -> set of iwl_from
+    for df in query_data_generator(
+        "SELECT iwl_from, iwl_prefix, iwl_title FROM iwlinks",
+        function_name,
+        ["iwl_from", "iwl_prefix", "iwl_title"],
+        db,
+        replicas_port,
+        user_db_port,
+        user,
+        password,
+        row_count=IWLINKS_CHUNK_SIZE,
+        stream=True,
+        text_cols=["iwl_prefix", "iwl_title"],
+    ):
+        for iwl_from, iwl_prefix, iwl_title in zip(
+            df["iwl_from"].values, df["iwl_prefix"].values, df["iwl_title"].values
+        ):
+            pattern = prefixes.get(iwl_prefix)
+            if pattern is None:
+                continue
+            module = modules.get(pattern.replace("$1", iwl_title))
+            if module is not None:
+                linked_from.setdefault(module, set()).add(iwl_from)
+
+    df = pd.DataFrame(
+        [
+            (dbname, page_id, len(pages))
+            for (dbname, page_id), pages in linked_from.items()
+        ],
+        columns=["dbname", "page_id", "iwls"],
+    )
+    try:
+        for dbname, df_db in df.groupby("dbname"):
+            save_data(
+                df_db[["page_id", "iwls"]],
+                dbname,
                 function_name,
-                ["page_id", "dbname", "iwls"],
-                DATABASE_NAME,
-                replicas_port,
                 user_db_port,
                 user,
                 password,
-                False,
-            ):
-                save_data(
-                    df,
-                    db,
-                    function_name,
-                    user_db_port,
-                    user,
-                    password,
-                    save_query,
-                    cols,
-                    True,
-                )
-
-            db_cur.execute(drop_query)
-
-        conn_db.commit()
-        conn_db.close()
+                increment=True,
+                raise_errors=True,
+            )
     except Exception as err:
         print(
-            "Something went wrong. Could not get iwlinks info of %s\n" % db, repr(err)
+            "Something went wrong. Could not save iwlinks info of %s\n" % db, repr(err)
         )
+        with open("missed_db_info.txt", "a") as file:
+            file.write(function_name + " " + db + "\n")
 
 
 def get_pagelinks_info(
@@ -228,12 +268,21 @@ def get_pagelinks_info(
         "    AND page_namespace=828 "
         "    AND page_content_model='Scribunto' "
         "    AND pl_namespace=828 "
+        "WHERE {keyset} "
         "GROUP BY page_id"
     )
 
     cols = ["page_id", "pls"]
     for df in query_data_generator(
-        query, function_name, cols, db, replicas_port, user_db_port, user, password
+        query,
+        function_name,
+        cols,
+        db,
+        replicas_port,
+        user_db_port,
+        user,
+        password,
+        key="page_id",
     ):
         save_data(df, db, function_name, user_db_port, user, password)
 
@@ -262,21 +311,56 @@ def get_langlinks_info(
         "    ON ll_from=page_id "
         "    AND page_namespace=828 "
         "    AND page_content_model='Scribunto' "
+        "WHERE {keyset} "
         "GROUP BY page_id"
     )
 
     cols = ["page_id", "langs"]
     for df in query_data_generator(
-        query, function_name, cols, db, replicas_port, user_db_port, user, password
+        query,
+        function_name,
+        cols,
+        db,
+        replicas_port,
+        user_db_port,
+        user,
+        password,
+        key="page_id",
     ):
         save_data(df, db, function_name, user_db_port, user, password)
 
 
-def get_templatelinks_info(
+def get_replica_timestamp(db, overlap=0, replicas_port=None, user=None, password=None):
+    """
+    Returns current time of the replica database as MediaWiki timestamp.
+
+    :param db: The database to connect to.
+    :param overlap: Number of seconds to subtract from the current time.
+    :param replicas_port: port for connecting to meta table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :return: string YYYYMMDDHHMMSS
+    """
+    conn = db_acc.connect_to_replicas_database(db, replicas_port, user, password)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT DATE_FORMAT(UTC_TIMESTAMP() - INTERVAL %s SECOND, "
+                "'%%Y%%m%%d%%H%%i%%s')",
+                overlap,
+            )
+            timestamp = encode_if_necessary(cur.fetchone()[0])
+        conn.commit()
+    finally:
+        conn.close()
+    return timestamp
+
+
+def count_all_transclusions(
     db, function_name, replicas_port=None, user_db_port=None, user=None, password=None
 ):
     """
-    Get the number of transclusions of a module and save in user database.
+    Recounts the number of transclusions for all the modules of the wiki and saves in user database.
 
     :param db: The database to connect to and get data from.
     :param function_names: The name of this function, useful to save function name when data is missed.
@@ -296,6 +380,7 @@ def get_templatelinks_info(
         "    AND page_namespace=828 "
         "    AND page_content_model='Scribunto' "
         "    AND tl_namespace=828 "
+        "WHERE {keyset} "
         "GROUP BY page_id"
     )
 
@@ -309,8 +394,189 @@ def get_templatelinks_info(
         user_db_port,
         user,
         password,
+        stream=True,
+        raise_errors=True,
     ):
-        save_data(df, db, function_name, user_db_port, user, password)
+        save_data(
+            df, db, function_name, user_db_port, user, password, raise_errors=True
+        )
+
+
+def count_changed_transclusions(
+    db,
+    function_name,
+    watermark,
+    replicas_port=None,
+    user_db_port=None,
+    user=None,
+    password=None,
+):
+    """
+    Recounts the number of transclusions only for the modules, transcluded by the pages
+    edited or created since the watermark, and saves in user database. Changed pages are found
+    in recentchanges by its rc_timestamp index, and their links are read by templatelinks' primary key,
+    so neither page nor templatelinks is scanned. Pages, which start transcluding a module through
+    an edited template, are covered too, as templatelinks of the template itself list the module.
+    Modules, which only lost transclusions (the module was removed from a page, or the page was deleted),
+    are not found this way; their counts are corrected by the next full recount.
+
+    :param db: The database to connect to and get data from.
+    :param function_names: The name of this function, useful to save function name when data is missed.
+    :param watermark: MediaWiki timestamp (YYYYMMDDHHMMSS) of the previous run.
+    :param replicas_port: port for connecting to meta table through ssh tunneling, if used.
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :return: None
+    """
+    if not watermark.isdigit():
+        raise ValueError("Invalid watermark %r for %s" % (watermark, db))
+
+    changed_query = (
+        "SELECT DISTINCT tl_title "
+        "FROM recentchanges "
+        "INNER JOIN templatelinks "
+        "    ON tl_from=rc_cur_id "
+        "    AND tl_namespace=828 "
+        "WHERE rc_timestamp >= '%s' "
+        "    AND rc_type IN (0, 1)" % watermark
+    )
+    titles = []
+    for df in query_data_generator(
+        changed_query,
+        function_name,
+        ["title"],
+        db,
+        replicas_port,
+        user_db_port,
+        user,
+        password,
+        stream=True,
+        raise_errors=True,
+    ):
+        titles.extend(df["title"])
+
+    query = (
+        "SELECT page_id, "
+        "COUNT(tl_from) AS transcluded_in "
+        "FROM page "
+        "INNER JOIN templatelinks "
+        "    ON page_title=tl_title "
+        "    AND page_namespace=828 "
+        "    AND page_content_model='Scribunto' "
+        "    AND tl_namespace=828 "
+        "WHERE page_title IN (%s) "
+        "    AND {keyset} "
+        "GROUP BY page_id"
+    )
+
+    cols = ["page_id", "transcluded_in"]
+    for idx in range(0, len(titles), TITLES_BATCH_SIZE):
+        batch = ", ".join(
+            "'%s'" % escape_string(title)
+            for title in titles[idx : idx + TITLES_BATCH_SIZE]
+        )
+        for df in query_data_generator(
+            query % batch,
+            function_name,
+            cols,
+            db,
+            replicas_port,
+            user_db_port,
+            user,
+            password,
+            key="page_id",
+            raise_errors=True,
+        ):
+            save_data(
+                df, db, function_name, user_db_port, user, password, raise_errors=True
+            )
+
+
+def get_templatelinks_info(
+    db,
+    function_name,
+    replicas_port=None,
+    user_db_port=None,
+    user=None,
+    password=None,
+    full_recount=False,
+):
+    """
+    Get the number of transclusions of a module and save in user database.
+    By default only the modules, whose transclusions could have changed since the previous run,
+    are recounted (see count_changed_transclusions). All the modules are recounted, if asked to,
+    on the first run for the wiki and when the last full recount is older than FULL_RECOUNT_DAYS.
+
+    :param db: The database to connect to and get data from.
+    :param function_names: The name of this function, useful to save function name when data is missed.
+    :param replicas_port: port for connecting to meta table through ssh tunneling, if used.
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :param full_recount: Whether to recount transclusions of all the modules.
+    :return: None
+    """
+    watermark, full_recount_time = get_watermark(
+        db, TEMPLATELINKS_WATERMARK, user_db_port, user, password
+    )
+    if (
+        watermark is None
+        or full_recount_time is None
+        or datetime.datetime.utcnow() - full_recount_time
+        > datetime.timedelta(days=FULL_RECOUNT_DAYS)
+    ):
+        full_recount = True
+
+    # taken before counting, so the changes made meanwhile are counted by the next run
+    new_watermark = get_replica_timestamp(
+        db, WATERMARK_OVERLAP, replicas_port, user, password
+    )
+
+    if full_recount:
+        count_all_transclusions(
+            db, function_name, replicas_port, user_db_port, user, password
+        )
+    else:
+        count_changed_transclusions(
+            db, function_name, watermark, replicas_port, user_db_port, user, password
+        )
+
+    save_watermark(
+        db,
+        TEMPLATELINKS_WATERMARK,
+        new_watermark,
+        full_recount,
+        user_db_port,
+        user,
+        password,
+    )
+
+
+def get_templatelinks_full_info(
+    db, function_name, replicas_port=None, user_db_port=None, user=None, password=None
+):
+    """
+    Get the number of transclusions of all the modules and save in user database;
+    full recount version of get_templatelinks_info.
+
+    :param db: The database to connect to and get data from.
+    :param function_names: The name of this function, useful to save function name when data is missed.
+    :param replicas_port: port for connecting to meta table through ssh tunneling, if used.
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :return: None
+    """
+    get_templatelinks_info(
+        db,
+        function_name,
+        replicas_port,
+        user_db_port,
+        user,
+        password,
+        full_recount=True,
+    )
 
 
 def get_transclusions_info(
@@ -337,19 +603,28 @@ def get_transclusions_info(
         "    AND tl_from_namespace=828 "
         "    AND tl_namespace=828 "
         "    AND page_namespace=828 "
-        "    AND page_content_model='Scribunto'"
+        "    AND page_content_model='Scribunto' "
         "WHERE tl_title IN "
         "    ("
         "        SELECT page_title "
         "        FROM page "
         "        WHERE page_namespace=828 AND page_content_model='Scribunto' "
         "    ) "
+        "    AND {keyset} "
         "GROUP BY tl_from"
     )
 
     cols = ["page_id", "transclusions"]
     for df in query_data_generator(
-        query, function_name, cols, db, replicas_port, user_db_port, user, password
+        query,
+        function_name,
+        cols,
+        db,
+        replicas_port,
+        user_db_port,
+        user,
+        password,
+        key="tl_from",
     ):
         save_data(df, db, function_name, user_db_port, user, password)
 
@@ -379,12 +654,21 @@ def get_categories_info(
         "    ON cl_from=page_id "
         "    AND page_namespace=828 "
         "    AND page_content_model='Scribunto' "
+        "WHERE {keyset} "
         "GROUP BY page_id"
     )
 
     cols = ["page_id", "categories"]
     for df in query_data_generator(
-        query, function_name, cols, db, replicas_port, user_db_port, user, password
+        query,
+        function_name,
+        cols,
+        db,
+        replicas_port,
+        user_db_port,
+        user,
+        password,
+        key="page_id",
     ):
         save_data(df, db, function_name, user_db_port, user, password)
 
@@ -411,12 +695,21 @@ def get_edit_protection_info(
         "    ON page_id=pr_page "
         "    AND page_namespace=828 "
         "    AND page_content_model='Scribunto' "
-        "    AND pr_type='edit'"
+        "    AND pr_type='edit' "
+        "WHERE {keyset}"
     )
 
     cols = ["page_id", "pr_level_edit"]
     for df in query_data_generator(
-        query, function_name, cols, db, replicas_port, user_db_port, user, password
+        query,
+        function_name,
+        cols,
+        db,
+        replicas_port,
+        user_db_port,
+        user,
+        password,
+        key="page_id",
     ):
         save_data(df, db, function_name, user_db_port, user, password)
 
@@ -443,16 +736,115 @@ def get_move_protection_info(
         "    ON page_id=pr_page "
         "    AND page_namespace=828 "
         "    AND page_content_model='Scribunto' "
-        "    AND pr_type='move'"
+        "    AND pr_type='move' "
+        "WHERE {keyset}"
     )
 
     cols = ["page_id", "pr_level_move"]
     for df in query_data_generator(
-        query, function_name, cols, db, replicas_port, user_db_port, user, password
+        query,
+        function_name,
+        cols,
+        db,
+        replicas_port,
+        user_db_port,
+        user,
+        password,
+        key="page_id",
     ):
         save_data(df, db, function_name, user_db_port, user, password)
 
 
+def get_module_counts_info(
+    db, function_name, replicas_port=None, user_db_port=None, user=None, password=None
+):
+    """
+    Combined collector: gets in one pass over the modules of the wiki the data, otherwise collected by
+    get_pagelinks_info, get_langlinks_info, get_categories_info, get_edit_protection_info,
+    get_move_protection_info and get_transclusions_info, and saves it with a single update of user database.
+    Unlike the separate collectors, modules without links get 0 and unprotected ones get NULL,
+    so outdated values are overwritten.
+
+    :param db: The database to connect to and get data from.
+    :param function_names: The name of this function, useful to save function name when data is missed.
+    :param replicas_port: port for connecting to meta table through ssh tunneling, if used.
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :return: None
+    """
+
+    query = (
+        "SELECT page_id, "
+        "    ("
+        "        SELECT COUNT(pl_from) "
+        "        FROM pagelinks "
+        "        WHERE pl_namespace=828 AND pl_title=page.page_title "
+        "    ) AS pls, "
+        "    ("
+        "        SELECT COUNT(ll_lang) "
+        "        FROM langlinks "
+        "        WHERE ll_from=page.page_id "
+        "    ) AS langs, "
+        "    ("
+        "        SELECT COUNT(cl_to) "
+        "        FROM categorylinks "
+        "        WHERE cl_from=page.page_id "
+        "    ) AS categories, "
+        "    ("
+        "        SELECT pr_level "
+        "        FROM page_restrictions "
+        "        WHERE pr_page=page.page_id AND pr_type='edit' "
+        "    ) AS pr_level_edit, "
+        "    ("
+        "        SELECT pr_level "
+        "        FROM page_restrictions "
+        "        WHERE pr_page=page.page_id AND pr_type='move' "
+        "    ) AS pr_level_move, "
+        "    ("
+        "        SELECT COUNT(tl_title) "
+        "        FROM templatelinks "
+        "        INNER JOIN page AS module "
+        "            ON module.page_title=tl_title "
+        "            AND module.page_namespace=828 "
+        "            AND module.page_content_model='Scribunto' "
+        "        WHERE tl_from=page.page_id "
+        "            AND tl_from_namespace=828 "
+        "            AND tl_namespace=828 "
+        "    ) AS transclusions "
+        "FROM page "
+        "WHERE page_namespace=828 "
+        "    AND page_content_model='Scribunto' "
+        "    AND {keyset}"
+    )
+
+    cols = [
+        "page_id",
+        "pls",
+        "langs",
+        "categories",
+        "pr_level_edit",
+        "pr_level_move",
+        "transclusions",
+    ]
+    dfs = list(
+        query_data_generator(
+            query,
+            function_name,
+            cols,
+            db,
+            replicas_port,
+            user_db_port,
+            user,
+            password,
+            key="page_id",
+            text_cols=["pr_level_edit", "pr_level_move"],
+        )
+    )
+    if dfs:
+        save_data(pd.concat(dfs), db, function_name, user_db_port, user, password)
+
+
 def get_most_common_tag_info(
     db, function_name, replicas_port=None, user_db_port=None, user=None, password=None
 ):
@@ -526,33 +918,240 @@ def get_most_common_tag_info(
         save_data(df, db, function_name, user_db_port, user, password)
 
 
+COLLECTORS = {
+    "get_revision_info": get_revision_info,
+    "get_iwlinks_info": get_iwlinks_info,
+    "get_pagelinks_info": get_pagelinks_info,
+    "get_langlinks_info": get_langlinks_info,
+    "get_templatelinks_info": get_templatelinks_info,
+    "get_templatelinks_full_info": get_templatelinks_full_info,
+    "get_transclusions_info": get_transclusions_info,
+    "get_categories_info": get_categories_info,
+    "get_edit_protection_info": get_edit_protection_info,
+    "get_move_protection_info": get_move_protection_info,
+    "get_most_common_tag_info": get_most_common_tag_info,
+    "get_module_counts_info": get_module_counts_info,
+}
+
+WORKERS = 4  # number of (db, function) tasks running at the same time
+SECTION_CONNECTIONS = 2  # max number of running tasks on one replica section
+
+
+def positive_int(value):
+    """
+    Argparse type for options, which must be at least 1.
+
+    :param value: value of the option, as given in the command line.
+    :return: int
+    """
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError("must be at least 1, got %s" % value)
+    return number
+
+
+def get_db_sections(replicas_port=None, user=None, password=None):
+    """
+    Returns mapping of dbnames to the replica sections (slices) they are stored on.
+
+    :param replicas_port: port for connecting to meta table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :return: dictionary {dbname: slice}, e.g. {'enwiki': 's1.labsdb'}
+    """
+    try:
+        conn = db_acc.connect_to_replicas_database(
+            "meta_p", replicas_port, user, password
+        )
+        with conn.cursor() as cur:
+            cur.execute("SELECT dbname, slice FROM wiki")
+            ret = {
+                encode_if_necessary(dbname): encode_if_necessary(section)
+                for dbname, section in cur
+            }
+        conn.close()
+        return ret
+    except Exception as err:
+        print("Something went wrong. Could not get replica sections\n", repr(err))
+        exit(1)
+
+
+def run_collector(
+    db, function_name, replicas_port=None, user_db_port=None, user=None, password=None
+):
+    """
+    Runs one collector function for one database.
+
+    :param db: The database to collect data from.
+    :param function_name: Name of the collector function, one of COLLECTORS.
+    :param replicas_port: port for connecting to meta table through ssh tunneling, if used.
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :return: wall-clock time of the task, in seconds
+    """
+    start_time = time.time()
+    try:
+        COLLECTORS[function_name](
+            db, function_name, replicas_port, user_db_port, user, password
+        )
+    except Exception as err:
+        print("Something went wrong running %s for %s\n" % (function_name, db), err)
+        with open("missed_db_info.txt", "a") as file:
+            file.write(function_name + " " + db + "\n")
+    return time.time() - start_time
+
+
+def run_tasks(
+    tasks,
+    replicas_port=None,
+    user_db_port=None,
+    user=None,
+    password=None,
+    workers=WORKERS,
+    section_connections=SECTION_CONNECTIONS,
+):
+    """
+    Runs (db, function_name) tasks on a pool of worker threads.
+    Tasks are started only while their replica section has less than `section_connections`
+    tasks running, so a single section isn't overloaded; sections are served in turns.
+
+    :param tasks: List of (db, function_name) pairs.
+    :param replicas_port: port for connecting to meta table through ssh tunneling, if used.
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :param workers: Number of tasks running at the same time.
+    :param section_connections: Max number of tasks running at the same time on one replica section.
+    :return: list of (function_name, db, seconds) for all the tasks
+    """
+    if workers < 1 or section_connections < 1:
+        # no task could ever be started
+        raise ValueError("workers and section_connections must be at least 1")
+
+    sections = get_db_sections(replicas_port, user, password)
+
+    pending = {}  # section -> tasks waiting to be started
+    for db, function_name in tasks:
+        pending.setdefault(sections.get(db), deque()).append((db, function_name))
+
+    running = {}  # future -> (section, db, function_name)
+    active = Counter()  # section -> number of running tasks
+    timings = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            started = True
+            while started and len(running) < workers:
+                started = False
+                for section in list(pending):
+                    if len(running) == workers:
+                        break
+                    if active[section] >= section_connections:
+                        continue
+                    db, function_name = pending[section].popleft()
+                    future = executor.submit(
+                        run_collector,
+                        db,
+                        function_name,
+                        replicas_port,
+                        user_db_port,
+                        user,
+                        password,
+                    )
+                    running[future] = (section, db, function_name)
+                    active[section] += 1
+                    started = True
+                    if not pending[section]:
+                        del pending[section]
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                section, db, function_name = running.pop(future)
+                active[section] -= 1
+                timings.append((function_name, db, future.result()))
+
+    return timings
+
+
+def print_timings(timings, total_time, slowest=10):
+    """
+    Prints wall-clock report of the finished tasks: totals for every function and the slowest tasks.
+
+    :param timings: List of (function_name, db, seconds), as returned by run_tasks.
+    :param total_time: Wall-clock time of the whole run, in seconds.
+    :param slowest: Number of the slowest tasks to list.
+    :return: None
+    """
+    df = pd.DataFrame(timings, columns=["function", "db", "seconds"])
+    print("Finished %d tasks in %.1f s" % (len(df), total_time))
+    if df.empty:
+        return
+    print(
+        df.groupby("function")["seconds"]
+        .agg(["count", "sum", "mean", "max"])
+        .sort_values("sum", ascending=False)
+        .round(1)
+        .to_string()
+    )
+    print("Slowest tasks:")
+    print(
+        df.sort_values("seconds", ascending=False)
+        .head(slowest)
+        .round(1)
+        .to_string(index=False)
+    )
+
+
 def get_data(
-    function_names, replicas_port=None, user_db_port=None, user=None, password=None
+    function_names,
+    replicas_port=None,
+    user_db_port=None,
+    user=None,
+    password=None,
+    workers=WORKERS,
+    section_connections=SECTION_CONNECTIONS,
 ):
     """
-    Loading data from all databases using a specific function -- therefore collecting a specific set of data.
+    Loading data from all databases using specific functions -- therefore collecting specific sets of data.
+    Every (database, function) pair is a separate task; tasks run in parallel, see run_tasks.
 
     :param function_names: A list of function names to call for all the databases.
     :param replicas_port: port for connecting to meta table through ssh tunneling, if used.
     :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
     :param user: Toolforge username of the tool.
     :param password: Toolforge password of the tool.
+    :param workers: Number of tasks running at the same time.
+    :param section_connections: Max number of tasks running at the same time on one replica section.
     :return: None
     """
-
+    start_time = time.time()
     dbs = get_dbs(user_db_port, user, password)
+    tasks = [(db, function_name) for db in dbs for function_name in function_names]
 
-    for db in dbs:
-        for function_name in function_names:
-            eval(function_name)(
-                db, function_name, replicas_port, user_db_port, user, password
-            )
-            # print("     Loaded %s for %s" % (function_name, db))
+    timings = run_tasks(
+        tasks,
+        replicas_port,
+        user_db_port,
+        user,
+        password,
+        workers,
+        section_connections,
+    )
 
     print("Done loading all data")
+    print_timings(timings, time.time() - start_time)
+    print("Database connections:", db_acc.get_pool_stats())
 
 
-def get_missed_data(replicas_port=None, user_db_port=None, user=None, password=None):
+def get_missed_data(
+    replicas_port=None,
+    user_db_port=None,
+    user=None,
+    password=None,
+    workers=WORKERS,
+    section_connections=SECTION_CONNECTIONS,
+):
     """
     Retry loading missed data from databases.
 
@@ -560,6 +1159,8 @@ def get_missed_data(replicas_port=None, user_db_port=None, user=None, password=N
     :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
     :param user: Toolforge username of the tool.
     :param password: Toolforge password of the tool.
+    :param workers: Number of tasks running at the same time.
+    :param section_connections: Max number of tasks running at the same time on one replica section.
     :return: None
     """
 
@@ -577,10 +1178,17 @@ def get_missed_data(replicas_port=None, user_db_port=None, user=None, password=N
         with open("missed_db_info.txt", "w") as file:
             file.write("")
 
-        for function_name, db in missed:
-            eval(function_name)(
-                db, function_name, replicas_port, user_db_port, user, password
-            )
+        start_time = time.time()
+        timings = run_tasks(
+            [(db, function_name) for function_name, db in missed],
+            replicas_port,
+            user_db_port,
+            user,
+            password,
+            workers,
+            section_connections,
+        )
+        print_timings(timings, time.time() - start_time)
 
         success = True
 
@@ -613,11 +1221,10 @@ if __name__ == "__main__":
         "-fn",
         type=str,
         nargs="+",
+        choices=list(COLLECTORS),
+        metavar="FUNCTION_NAME",
         help="Name of the function to run for all wikis. "
-        "One or more of: get_revision_info, get_iwlinks_info, get_pagelinks_info, "
-        "get_langlinks_info, get_templatelinks_info, get_transclusions_info, "
-        "get_categories_info, get_edit_protection_info, get_move_protection_info, "
-        "get_most_common_tag_info",
+        "One or more of: " + ", ".join(COLLECTORS),
     )
     parser.add_argument(
         "--get-missed",
@@ -626,6 +1233,20 @@ if __name__ == "__main__":
         help="Whether to get the missed information only. Taken from missed_db_info.txt, "
         "which lists function name and database name pairs.",
     )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        type=positive_int,
+        default=WORKERS,
+        help="Number of (database, function) tasks running at the same time.",
+    )
+    parser.add_argument(
+        "--section-connections",
+        "-sc",
+        type=positive_int,
+        default=SECTION_CONNECTIONS,
+        help="Max number of tasks running at the same time on one replica section.",
+    )
     local_data = parser.add_argument_group(
         title="Info for connecting to Toolforge from local pc"
     )
@@ -660,7 +1281,14 @@ if __name__ == "__main__":
         get_interwiki(args.user_db_port, args.user, args.password)
 
     if args.get_missed:
-        get_missed_data(args.replicas_port, args.user_db_port, args.user, args.password)
+        get_missed_data(
+            args.replicas_port,
+            args.user_db_port,
+            args.user,
+            args.password,
+            args.workers,
+            args.section_connections,
+        )
     else:
         get_data(
             args.function_names,
@@ -668,4 +1296,6 @@ if __name__ == "__main__":
             args.user_db_port,
             args.user,
             args.password,
+            args.workers,
+            args.section_connections,
         )
@@ -1,9 +1,8 @@
 from fetch_content import *
-from utils.db_query import encode_if_necessary
+from utils.db_query import decode_text_columns
 from constants import DATABASE_NAME
 import utils.db_access as db_acc
 
-
 pymysql.converters.encoders[np.int64] = pymysql.converters.escape_int
 pymysql.converters.conversions = pymysql.converters.encoders.copy()
 pymysql.converters.conversions.update(pymysql.converters.decoders)
@@ -28,7 +27,7 @@ def get_only_db_pages(user_db_port=None, user=None, password=None):
                 "SELECT page_id, dbname FROM Scripts WHERE in_api = 0 AND in_database = 1",
                 conn,
             )
-            df = pd.DataFrame(SQL_Query).applymap(encode_if_necessary)
+            df = decode_text_columns(pd.DataFrame(SQL_Query), ["dbname"])
             df["wiki"] = df["dbname"].map(get_db_map(dbs=list(df["dbname"].values))[0])
         conn.close()
         return df
@@ -45,6 +44,14 @@ if __name__ == "__main__":
         "More help available at "
         "https://wikitech.wikimedia.org/wiki/Help:Toolforge/Database#SSH_tunneling_for_local_testing_which_makes_use_of_Wiki_Replica_databases"
     )
+    parser.add_argument(
+        "--codec",
+        type=str,
+        choices=codec.available_codecs(),
+        default=codec.DEFAULT_CODEC,
+        help="Format, in which new sourcecodes are stored in Sourcecodes table: "
+        "plain utf8 or compressed.",
+    )
     local_data = parser.add_argument_group(
         title="Info for connecting to Toolforge from local pc"
     )
@@ -69,6 +76,6 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     df = get_only_db_pages(args.user_db_port, args.user, args.password)
-    get_pages(df, 0, 1, args.user_db_port, args.user, args.password)
+    get_pages(df, 0, 1, args.user_db_port, args.user, args.password, args.codec)
 
     print("Done loading pages only in database.")
@@ -3,7 +3,7 @@ import numpy as np
 import argparse
 import sys
 import copy
-from utils.db_query import encode_if_necessary, close_conn
+from utils.db_query import rows_to_dataframe, close_conn
 from constants import DATABASE_NAME
 import utils.db_access as db_acc
 
@@ -38,10 +38,7 @@ def get_data(feature_names, user_db_port, user, password):
         DATABASE_NAME, user_db_port, user, password)
     with conn.cursor() as cur:
         cur.execute(query)
-        df = pd.DataFrame(
-            cur.fetchall(),
-            columns=cols,
-        ).applymap(encode_if_necessary)
+        df = rows_to_dataframe(cur.fetchall(), cols, ["dbname"])
     close_conn(conn)
 
     df["edits_per_editor"] = (df["edits"] / df["editors"]).replace(np.inf, 0)
@@ -129,6 +126,14 @@ def get_multipliers(df, threshold=0.95):
         "transcluded_in": 1e6,
         "transcluded_in_norm": 15,
         "transclusions": 30,
+        "function_count": 50,
+        "dependencies": 10,
+        "exported_keys": 30,
+        "token_count": 20000,
+        "branching": 200,
+        "data_share": 1,
+        "fan_in": 50,
+        "dependents": 1000,
     }
 
     limits_perc = {}
@@ -183,8 +188,14 @@ def get_score(
         "major_edits_norm_score",
         "pls_norm_score",
         "transcluded_in_norm_score",
+        "function_count_score",
+        "dependencies_score",
+        "exported_keys_score",
+        "token_count_score",
+        "branching_score",
+        "data_share_score",
     ],
-    weights=[1, 1, 0.1, 5, 2, 5, 2, 8],
+    weights=[1, 1, 0.1, 5, 2, 5, 2, 8, 0, 0, 0, 0, 0, 0],
 ):
     """
     Returns dataframe with scores of each module in the 'score' column.
@@ -217,7 +228,9 @@ if __name__ == "__main__":
         nargs="+",
         help="Name of the features(columns in Scripts table) to get distribution of."
         "Possible values are editors, edits, major_edits, anonymous_edits, pls, categories, langs,"
-        "transcluded_in, transclusions, length, pageviews.",
+        "transcluded_in, transclusions, length, pageviews, and static features of the sourcecode: "
+        "function_count, dependencies, exported_keys, token_count, branching, data_share, "
+        "and dependency graph: fan_in, dependents.",
         default=["editors", "major_edits", "length",
                  "pls", "langs", "transcluded_in"],
     )
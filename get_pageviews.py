@@ -301,6 +301,8 @@ def get_all_pageviews(replicas_port, user_db_port, user, password, all, rest_api
                 err,
             )
 
+    print("Database connections:", db_acc.get_pool_stats())
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
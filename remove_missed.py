@@ -21,6 +21,11 @@ def remove_missed_contents(user_db_port, user, password):
         with conn.cursor() as cur:
             cur.execute("DELETE FROM Scripts WHERE is_missed=1")
             cur.execute("DELETE FROM Scripts WHERE in_api=0 OR in_database=0")
+            # sourcecodes, which aren't used by any module anymore
+            cur.execute(
+                "DELETE FROM Sourcecodes WHERE content_hash NOT IN "
+                "(SELECT content_hash FROM Scripts WHERE content_hash IS NOT NULL)"
+            )
         conn.commit()
         conn.close()
     except Exception as err:
@@ -0,0 +1,227 @@
+import heapq
+
+import numpy as np
+
+N_TREES = 10
+LEAF_SIZE = 32  # a node with at most that many points isn't split further
+SEARCH_FACTOR = 50  # by default k * SEARCH_FACTOR candidates are compared exactly
+
+
+def normalize(vectors):
+    """
+    Scales vectors to unit length, so cosine distance can be computed with dot products.
+    Zero vectors (e.g. of empty sourcecodes) stay zero.
+
+    :param vectors: matrix, vector per row.
+    :return: float32 numpy matrix
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+class AnnIndex:
+    """
+    Random-projection forest for approximate nearest-neighbour search by cosine distance, as in Annoy:
+    every tree splits the points recursively by the hyperplane halfway between two random points,
+    and a query descends all the trees at once, visiting first the nodes closest to the splitting planes,
+    until enough candidates are collected; the candidates are then compared exactly.
+
+    Points are numbered by rows of the indexed matrix; the vectors themselves are not kept in the index,
+    so they are read from the (memory-mapped) matrix at query time, see EmbeddingStore.
+    Nodes of all the trees are kept in flat arrays: children >= 0 are internal nodes,
+    -1 - leaf for leaves, whose points are leaf_items[leaf_bounds[leaf]:leaf_bounds[leaf + 1]].
+    """
+
+    def __init__(self, normals, offsets, children, leaf_bounds, leaf_items, roots):
+        self.normals = normals
+        self.offsets = offsets
+        self.children = children
+        self.leaf_bounds = leaf_bounds
+        self.leaf_items = leaf_items
+        self.roots = roots
+
+    @classmethod
+    def build(cls, vectors, n_trees=N_TREES, leaf_size=LEAF_SIZE, seed=0):
+        """
+        Builds the forest over rows of the matrix.
+
+        :param vectors: matrix, vector per row.
+        :param n_trees: number of trees; more trees give better recall for slower queries and bigger index.
+        :param leaf_size: maximal number of points in a leaf, unless they are all equal.
+        :param seed: seed of the random choice of the splits.
+        :return: AnnIndex
+        """
+        vectors = normalize(vectors)
+        rng = np.random.default_rng(seed)
+        # equal vectors (of modules with equal sourcecodes) have equal projections, so they are compared by them
+        keys = vectors.dot(rng.normal(size=vectors.shape[1]))
+        normals, offsets, children, leaf_items, leaf_sizes, roots = (
+            [],
+            [],
+            [],
+            [],
+            [],
+            [],
+        )
+        n_nodes = n_leaves = 0
+        for _ in range(n_trees):
+            # nodes of each level of the tree are split at once, with their points sorted by node
+            order = np.arange(len(vectors))
+            points = vectors
+            sizes = np.array([len(vectors)])
+            is_root = True
+            while len(order):
+                starts = np.cumsum(sizes) - sizes
+                nodes = np.repeat(np.arange(len(sizes)), sizes)
+                node_keys = keys[order]
+                split = (sizes > leaf_size) & (
+                    np.maximum.reduceat(node_keys, starts)
+                    > np.minimum.reduceat(node_keys, starts)
+                )
+                refs = np.empty(len(sizes), dtype=np.int64)
+                refs[split] = n_nodes + np.arange(split.sum())
+                refs[~split] = -1 - (n_leaves + np.arange((~split).sum()))
+                n_nodes += split.sum()
+                n_leaves += (~split).sum()
+                leaf_items.append(order[~split[nodes]])
+                leaf_sizes.append(sizes[~split])
+                if is_root:
+                    roots.append(refs[0])
+                    is_root = False
+                else:
+                    # nodes of the level are children of the previous level's nodes, left and right in turn
+                    children.append(refs.reshape(-1, 2))
+
+                keep = split[nodes]
+                order, points, sizes = order[keep], points[keep], sizes[split]
+                node_keys = node_keys[keep]
+                starts = np.cumsum(sizes) - sizes
+                nodes = np.repeat(np.arange(len(sizes)), sizes)
+
+                # the splitting plane is halfway between two random different points of the node
+                a = starts + (rng.random(len(sizes)) * sizes).astype(np.int64)
+                b = starts + (rng.random(len(sizes)) * sizes).astype(np.int64)
+                for _ in range(8):
+                    same = node_keys[a] == node_keys[b]
+                    if not same.any():
+                        break
+                    b[same] = starts[same] + (
+                        rng.random(same.sum()) * sizes[same]
+                    ).astype(np.int64)
+                for node in np.flatnonzero(node_keys[a] == node_keys[b]):
+                    different = np.flatnonzero(
+                        node_keys[starts[node] : starts[node] + sizes[node]]
+                        != node_keys[a[node]]
+                    )
+                    b[node] = starts[node] + different[rng.integers(len(different))]
+                a, b = points[a], points[b]
+                normal = a - b
+                offset = -np.einsum("ij,ij->i", normal, (a + b) / 2)
+                normals.append(normal)
+                offsets.append(offset)
+
+                margins = np.einsum("ij,ij->i", points, normal[nodes])
+                sides = nodes * 2 + (margins + offset[nodes] >= 0)
+                by_side = np.argsort(sides, kind="stable")
+                # points are kept in the order of the nodes, so they are read sequentially
+                order, points = order[by_side], points[by_side]
+                sizes = np.bincount(sides, minlength=2 * len(sizes))
+
+        dim = vectors.shape[1] if vectors.ndim == 2 else 0
+        return cls(
+            np.concatenate(normals) if normals else np.zeros((0, dim), np.float32),
+            np.concatenate(offsets) if offsets else np.zeros(0, np.float32),
+            np.concatenate(children) if children else np.zeros((0, 2), np.int64),
+            np.concatenate([[0], np.cumsum(np.concatenate(leaf_sizes or [[]]))]).astype(
+                np.int64
+            ),
+            np.concatenate(leaf_items or [[]]).astype(np.int64),
+            np.array(roots, dtype=np.int64),
+        )
+
+    def candidates(self, vector, search_k):
+        """
+        Collects points from the leaves, which are the closest to the query in the trees.
+
+        :param vector: normalized query vector.
+        :param search_k: number of the points to collect (at least; whole leaves are taken).
+        :return: numpy array of distinct rows
+        """
+        # max-heap of nodes by the distance of the query to the closest splitting plane on the way to them
+        heap = [(-np.inf, root) for root in self.roots]
+        found = []
+        count = 0
+        while heap and count < search_k:
+            priority, node = heapq.heappop(heap)
+            if node < 0:
+                leaf = -1 - node
+                items = self.leaf_items[
+                    self.leaf_bounds[leaf] : self.leaf_bounds[leaf + 1]
+                ]
+                found.append(items)
+                count += len(items)
+                continue
+            margin = float(self.normals[node].dot(vector) + self.offsets[node])
+            left, right = self.children[node]
+            heapq.heappush(heap, (max(priority, -margin), int(right)))
+            heapq.heappush(heap, (max(priority, margin), int(left)))
+        return np.unique(np.concatenate(found)) if found else np.zeros(0, np.int64)
+
+    def query(self, vectors, vector, k=10, search_k=None, exclude=()):
+        """
+        Finds approximately k nearest neighbours of the vector.
+
+        :param vectors: the indexed matrix (may be memory-mapped).
+        :param vector: query vector.
+        :param k: number of the neighbours.
+        :param search_k: number of the candidates compared exactly, k * SEARCH_FACTOR by default.
+        :param exclude: rows, which shouldn't be returned, e.g. the row of the queried module.
+        :return: (rows, cosine distances) numpy arrays, sorted by distance
+        """
+        vector = normalize(np.reshape(vector, (1, -1)))[0]
+        rows = self.candidates(vector, search_k or k * SEARCH_FACTOR)
+        rows = rows[~np.isin(rows, exclude)]
+        distances = 1 - normalize(vectors[rows]).dot(vector)
+        order = np.argsort(distances, kind="stable")[:k]
+        return rows[order], distances[order]
+
+    def save(self, path, **meta):
+        """
+        :param path: path of .npz file.
+        :param meta: values saved along the index, like the version of the indexed vectors.
+        :return: None
+        """
+        with open(path, "wb") as file:
+            np.savez(
+                file,
+                normals=self.normals,
+                offsets=self.offsets,
+                children=self.children,
+                leaf_bounds=self.leaf_bounds,
+                leaf_items=self.leaf_items,
+                roots=self.roots,
+                **{"meta_" + key: np.array(value) for key, value in meta.items()}
+            )
+
+    @classmethod
+    def load(cls, path):
+        """
+        :param path: path of .npz file, written by save.
+        :return: (AnnIndex, dict of the saved meta values)
+        """
+        with np.load(path) as data:
+            index = cls(
+                data["normals"],
+                data["offsets"],
+                data["children"],
+                data["leaf_bounds"],
+                data["leaf_items"],
+                data["roots"],
+            )
+            meta = {
+                key[len("meta_") :]: data[key].item()
+                for key in data.files
+                if key.startswith("meta_")
+            }
+        return index, meta
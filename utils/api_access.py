@@ -0,0 +1,173 @@
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import mwapi
+import requests
+
+USER_AGENT = "abstract-wiki-ds"
+MAX_CONNECTIONS = 8
+MAX_HOST_CONNECTIONS = 2
+MAXLAG = 5  # seconds of database replication lag, above which the API should refuse our requests
+MAX_TRIES = 5
+BACKOFF = 2  # seconds to wait before the first retry; doubled after every failed try
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_API_ERRORS = {
+    "maxlag",
+    "ratelimited",
+    "readonly",
+    "internal_api_error_DBQueryError",
+}
+
+
+class RequestLimiter:
+    """
+    Limits the number of API requests running at the same time,
+    both in total and for every host separately. Can be shared between threads.
+    """
+
+    def __init__(
+        self, max_connections=MAX_CONNECTIONS, max_host_connections=MAX_HOST_CONNECTIONS
+    ):
+        """
+        :param max_connections: maximum number of simultaneous requests to all hosts.
+        :param max_host_connections: maximum number of simultaneous requests to a single host.
+        """
+        self.max_host_connections = max_host_connections
+        self._global = threading.BoundedSemaphore(max_connections)
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _host_semaphore(self, host):
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(
+                    self.max_host_connections
+                )
+            return self._hosts[host]
+
+    @contextmanager
+    def limit(self, host):
+        """
+        Blocks until a request to the host is allowed, and holds the slot while in the context.
+
+        :param host: host name the request is sent to, e.g. en.wikipedia.org
+        """
+        host_semaphore = self._host_semaphore(host)
+        with host_semaphore:
+            with self._global:
+                yield
+
+
+def parse_retry_after(value):
+    """
+    Parses value of Retry-After header, which is either a number of seconds or a HTTP date.
+
+    :param value: header value, or None if there was no header.
+    :return: number of seconds to wait, or None if unknown
+    """
+    if value is None:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        delay = parsedate_to_datetime(value) - datetime.now(timezone.utc)
+        return max(delay.total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class LimitedSession(requests.Session):
+    """
+    requests.Session, which sends every request through RequestLimiter, if given,
+    and remembers status and Retry-After header of the last response. The last response is
+    remembered per thread, so the session can be shared by threads fetching batches of one wiki.
+    """
+
+    def __init__(self, limiter=None):
+        super().__init__()
+        self.limiter = limiter
+        self._last = threading.local()
+
+    @property
+    def status_code(self):
+        return getattr(self._last, "status_code", None)
+
+    @property
+    def retry_after(self):
+        return getattr(self._last, "retry_after", None)
+
+    def request(self, method, url, *args, **kwargs):
+        host = urlparse(url).netloc
+        with self.limiter.limit(host) if self.limiter else nullcontext():
+            response = super().request(method, url, *args, **kwargs)
+            # read the body while still holding the slot, even for streamed responses
+            response.content
+        self._last.status_code = response.status_code
+        self._last.retry_after = parse_retry_after(response.headers.get("Retry-After"))
+        return response
+
+
+def create_session(wiki, limiter=None):
+    """
+    Creates API session for the wiki.
+
+    :param wiki: url of the wiki, e.g. https://en.wikipedia.org
+    :param limiter: RequestLimiter to send requests through, if needed.
+    :return: mwapi.Session
+    """
+    return mwapi.Session(wiki, user_agent=USER_AGENT, session=LimitedSession(limiter))
+
+
+def is_retryable(session, err):
+    """
+    Checks whether a failed request is worth retrying: the API was overloaded or lagged,
+    or the connection failed.
+
+    :param session: mwapi.Session, which sent the request.
+    :param err: the raised exception.
+    :return: bool
+    """
+    if isinstance(err, mwapi.errors.APIError):
+        return err.code in RETRY_API_ERRORS
+    if isinstance(err, (mwapi.errors.ConnectionError, mwapi.errors.TimeoutError)):
+        return True
+    # mwapi doesn't check the status, so error pages end up as JSON decoding errors
+    return getattr(session.session, "status_code", None) in RETRY_STATUSES
+
+
+def get_with_retries(
+    session, params, max_tries=MAX_TRIES, backoff=BACKOFF, maxlag=MAXLAG
+):
+    """
+    Sends GET request to the API with `maxlag` parameter, retrying with exponential backoff,
+    if the API is lagged or overloaded. The wait is never shorter than the Retry-After
+    the server asked for.
+
+    :param session: mwapi.Session, see create_session.
+    :param params: parameters of the request.
+    :param max_tries: maximum number of tries.
+    :param backoff: seconds to wait before the first retry; doubled after every failed try.
+    :param maxlag: value of `maxlag` parameter, None to not send it.
+    :return: response document
+    """
+    params = dict(params)
+    if maxlag is not None:
+        params["maxlag"] = maxlag
+
+    for attempt in range(max_tries):
+        try:
+            return session.get(params)
+        except Exception as err:
+            if attempt == max_tries - 1 or not is_retryable(session, err):
+                raise
+            delay = backoff * 2**attempt
+            retry_after = getattr(session.session, "retry_after", None)
+            if retry_after is not None:
+                delay = max(delay, retry_after)
+            time.sleep(delay)
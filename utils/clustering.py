@@ -0,0 +1,413 @@
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components, minimum_spanning_tree
+from sklearn.cluster import OPTICS, MiniBatchKMeans
+
+from utils.ann_index import AnnIndex, LEAF_SIZE
+
+MAX_EPS = np.inf
+MIN_SAMPLES = 5
+METRIC = "minkowski"
+ALGORITHM = "auto"
+CLUSTER_METHOD = "xi"
+XI = 0.0005
+
+KMEANS_CLUSTER_SIZE = 100  # average number of modules in a k-means cluster
+KMEANS_BATCH = 4096
+# modules farther from the centroid than that many median distances of their cluster are noise
+KMEANS_OUTLIER_FACTOR = 3
+
+KNN = 10  # neighbours of every module in the k-NN graph
+KNN_TREES = 10  # random-projection trees, whose leaves give candidate neighbours
+
+
+def relabel(labels):
+    """
+    Numbers clusters from 0, keeping noise (-1) as it is.
+
+    :param labels: numpy array of cluster labels, -1 for noise.
+    :return: numpy array of labels
+    """
+    clustered = labels >= 0
+    result = np.full(len(labels), -1, dtype=np.int64)
+    result[clustered] = np.unique(labels[clustered], return_inverse=True)[1]
+    return result
+
+
+def cluster_optics(X):
+    """
+    Clusters the embeddings with OPTICS over all pairs of them: exact, but needs quadratic time.
+    Noise modules are reported close to the cluster, which precedes them in the OPTICS ordering.
+
+    :param X: matrix of embeddings.
+    :return: (labels, -1 for noise; labels of the clusters closest to noise modules; the fitted model)
+    """
+    clustering = OPTICS(
+        max_eps=MAX_EPS,
+        min_samples=MIN_SAMPLES,
+        metric=METRIC,
+        algorithm=ALGORITHM,
+        cluster_method=CLUSTER_METHOD,
+        xi=XI,
+        n_jobs=-1,
+    ).fit(X)
+
+    labels = clustering.labels_
+    ordered = labels[clustering.ordering_]
+    # position of the last clustered module up to every position of the ordering
+    last = np.maximum.accumulate(np.where(ordered >= 0, np.arange(len(ordered)), -1))
+    nearest = np.empty(len(labels), dtype=np.int64)
+    nearest[clustering.ordering_] = np.where(
+        last >= 0, ordered[np.maximum(last, 0)], -1
+    )
+    return labels, nearest, clustering
+
+
+def cluster_kmeans(X, cluster_size=KMEANS_CLUSTER_SIZE, seed=0):
+    """
+    Clusters the embeddings with mini-batch k-means, in time linear in the number of modules and clusters.
+    The clusters are refined: modules far from their centroid and clusters smaller than MIN_SAMPLES
+    become noise, reported close to the cluster of their nearest centroid.
+
+    :param X: matrix of embeddings.
+    :param cluster_size: average number of modules in a cluster, which gives the number of clusters.
+    :param seed: seed of the random initialization.
+    :return: (labels, -1 for noise; labels of the clusters closest to noise modules; the fitted model)
+    """
+    X = np.asarray(X, dtype=np.float32)
+    model = MiniBatchKMeans(
+        n_clusters=max(1, min(len(X), len(X) // cluster_size)),
+        batch_size=KMEANS_BATCH,
+        n_init=3,
+        random_state=seed,
+    ).fit(X)
+
+    nearest = model.labels_.astype(np.int64)
+    distances = np.linalg.norm(X - model.cluster_centers_[nearest], axis=1)
+    median = pd.Series(distances).groupby(nearest).transform("median").values
+    noise = distances > KMEANS_OUTLIER_FACTOR * median
+    sizes = np.bincount(nearest[~noise], minlength=model.n_clusters)
+    noise |= sizes[nearest] < MIN_SAMPLES
+
+    # clusters, which are left, are numbered from 0, and noise is reported close to them
+    labels = relabel(np.where(noise, -1, nearest))
+    kept = np.full(model.n_clusters, -1, dtype=np.int64)
+    kept[nearest[~noise]] = labels[~noise]
+    return labels, kept[nearest], model
+
+
+def leaf_neighbours(index, X, width):
+    """
+    Finds candidate neighbours of every point in the (single-tree) index: the other points of its leaf.
+    Big leaves consist of equal points, so a point gets only the next points of its leaf.
+
+    :param index: AnnIndex.
+    :param X: the indexed matrix.
+    :param width: maximal number of candidates of a point, not less than LEAF_SIZE - 1.
+    :return: (candidates, distances) matrices of width columns; -1 and inf where there are less candidates
+    """
+    bounds, items = index.leaf_bounds, index.leaf_items
+    sizes = np.diff(bounds)
+    candidates = np.full((len(X), width), -1, dtype=np.int64)
+    distances = np.full((len(X), width), np.inf, dtype=np.float32)
+    for size in np.unique(sizes[sizes > 1]):
+        members = items[bounds[:-1][sizes == size][:, None] + np.arange(size)]
+        if size <= LEAF_SIZE:
+            # distances between all the points of every leaf of that size at once
+            vectors = X[members].astype(np.float64)
+            squares = (vectors**2).sum(axis=2)
+            leaf_distances = np.sqrt(
+                np.maximum(
+                    squares[:, :, None]
+                    + squares[:, None, :]
+                    - 2 * np.einsum("lid,ljd->lij", vectors, vectors),
+                    0,
+                )
+            )
+            i, j = np.nonzero(~np.eye(size, dtype=bool))
+            columns = j - (j > i)
+            candidates[members[:, i], columns] = members[:, j]
+            distances[members[:, i], columns] = leaf_distances[:, i, j]
+        else:
+            count = min(width, size - 1)
+            i = np.repeat(np.arange(size), count)
+            columns = np.tile(np.arange(count), size)
+            candidates[members[:, i], columns] = members[:, (i + columns + 1) % size]
+            distances[members[:, i], columns] = 0
+    return candidates, distances
+
+
+def knn_graph(X, k=KNN, n_trees=KNN_TREES, seed=0):
+    """
+    Builds approximate k-nearest-neighbour graph by euclidean distance: points, which share a leaf
+    in any of the random-projection trees, are candidate neighbours, and the closest k candidates are kept.
+    Trees are built one by one, so only the candidates of one tree are in memory at once.
+
+    :param X: matrix of embeddings.
+    :param k: number of neighbours.
+    :param n_trees: number of trees.
+    :param seed: seed of the first tree.
+    :return: (neighbours, distances) matrices of k columns, sorted by distance; -1 and inf where not found
+    """
+    X = np.asarray(X, dtype=np.float32)
+    rows = np.arange(len(X))[:, None]
+    neighbours = np.full((len(X), k), -1, dtype=np.int64)
+    distances = np.full((len(X), k), np.inf, dtype=np.float32)
+    for tree in range(n_trees):
+        candidates, found = leaf_neighbours(
+            AnnIndex.build(X, 1, seed=seed + tree), X, max(k, LEAF_SIZE - 1)
+        )
+        candidates = np.hstack([neighbours, candidates])
+        found = np.hstack([distances, found])
+
+        # a candidate, found again, is dropped: repeats are next to each other, when sorted by id
+        order = np.lexsort((found, candidates), axis=1)
+        candidates, found = candidates[rows, order], found[rows, order]
+        repeated = np.zeros(candidates.shape, dtype=bool)
+        repeated[:, 1:] = candidates[:, 1:] == candidates[:, :-1]
+        found[repeated | (candidates < 0)] = np.inf
+
+        order = np.argsort(found, axis=1, kind="stable")[:, :k]
+        neighbours, distances = candidates[rows, order], found[rows, order]
+        neighbours[np.isinf(distances)] = -1
+    return neighbours, distances
+
+
+def mst_edges(neighbours, distances, core):
+    """
+    Builds minimum spanning tree of the mutual reachability graph over k-NN edges:
+    weight of an edge is max(core distances of its ends, distance between them).
+    Components of the graph, which aren't connected, are joined by edges of infinite weight,
+    so the result is always a tree. Modules without core distance are joined that way only.
+
+    :param neighbours: matrix of neighbours, -1 where not found, see knn_graph.
+    :param distances: matrix of distances to the neighbours.
+    :param core: core distance of every module, inf for modules with less than MIN_SAMPLES - 1 neighbours.
+    :return: (first, second, weights) arrays of n - 1 edges
+    """
+    n = len(core)
+    found = (neighbours >= 0) & np.isfinite(core)[:, None]
+    sources = np.nonzero(found)[0]
+    targets = neighbours[found]
+    weights = np.maximum(np.maximum(core[sources], core[targets]), distances[found])
+    kept = np.isfinite(weights)
+    # csgraph treats zero weights as missing edges, so all the weights are shifted,
+    # which doesn't change the tree
+    tree = minimum_spanning_tree(
+        csr_matrix(
+            (weights[kept].astype(np.float64) + 1, (sources[kept], targets[kept])),
+            shape=(n, n),
+        )
+    ).tocoo()
+    first, second, weights = tree.row, tree.col, tree.data - 1
+
+    components = connected_components(tree, directed=False)[1]
+    representatives = np.unique(components, return_index=True)[1]
+    return (
+        np.concatenate([first, representatives[:-1]]),
+        np.concatenate([second, representatives[1:]]),
+        np.concatenate([weights, np.full(len(representatives) - 1, np.inf)]),
+    )
+
+
+def single_linkage(n, first, second, weights):
+    """
+    Merges the modules along the tree edges from the shortest one (single-linkage hierarchy).
+    Merge i creates node n + i.
+
+    :param n: number of modules.
+    :param first: first ends of the n - 1 tree edges.
+    :param second: second ends of the edges.
+    :param weights: weights of the edges.
+    :return: (left, right, distance, size) arrays of the merges: merged nodes, distance of the merge,
+    number of modules of the new node
+    """
+    order = np.argsort(weights, kind="stable")
+    parent = list(range(2 * n - 1))
+    size = [1] * n + [0] * (n - 1)
+    left, right = [], []
+
+    def find(node):
+        while parent[node] != node:
+            parent[node] = parent[parent[node]]
+            node = parent[node]
+        return node
+
+    for a, b in zip(first[order].tolist(), second[order].tolist()):
+        a, b = find(a), find(b)
+        node = n + len(left)
+        parent[a] = parent[b] = node
+        size[node] = size[a] + size[b]
+        left.append(a)
+        right.append(b)
+    return (
+        np.array(left, dtype=np.int64),
+        np.array(right, dtype=np.int64),
+        weights[order],
+        np.array(size[n:], dtype=np.int64),
+    )
+
+
+def condense_tree(n, left, right, distance, size, min_size=MIN_SAMPLES):
+    """
+    Condenses the single-linkage hierarchy, as in HDBSCAN: going down from the root, a split into two parts
+    of at least min_size modules gives two new clusters; smaller parts fall out of the cluster as noise,
+    at density lambda = 1 / distance of the split.
+
+    :param n: number of modules.
+    :param left: left nodes of the merges, see single_linkage.
+    :param right: right nodes of the merges.
+    :param distance: distances of the merges.
+    :param size: numbers of modules of the merged nodes.
+    :param min_size: minimal number of modules in a cluster.
+    :return: (parents, children, lambdas, sizes) arrays of the edges of condensed tree: clusters are
+    numbered from n (the root), and children below n are modules
+    """
+    with np.errstate(divide="ignore"):
+        lambdas = 1 / distance
+    # exact copies merge at zero distance; their density is high, but finite
+    lambdas = np.minimum(lambdas, np.finfo(np.float32).max).tolist()
+    left, right, size = left.tolist(), right.tolist(), size.tolist()
+
+    def node_size(node):
+        return size[node - n] if node >= n else 1
+
+    def leaves(node):
+        stack, result = [node], []
+        while stack:
+            node = stack.pop()
+            if node < n:
+                result.append(node)
+            else:
+                stack += [left[node - n], right[node - n]]
+        return result
+
+    edges = []
+    root = 2 * n - 2
+    labels = {root: n}
+    next_label = n + 1
+    stack = [root] if n > 1 else []
+    while stack:
+        node = stack.pop()
+        cluster = labels[node]
+        merge = node - n
+        lam = lambdas[merge]
+        children = [(child, node_size(child)) for child in (left[merge], right[merge])]
+        if all(child_size >= min_size for _, child_size in children):
+            for child, child_size in children:
+                labels[child] = next_label
+                next_label += 1
+                edges.append((cluster, labels[child], lam, child_size))
+                stack.append(child)
+        else:
+            for child, child_size in children:
+                if child_size >= min_size:
+                    labels[child] = cluster
+                    stack.append(child)
+                else:
+                    edges += [(cluster, leaf, lam, 1) for leaf in leaves(child)]
+    if not edges:
+        return tuple(
+            np.zeros(0, dtype) for dtype in (np.int64, np.int64, float, np.int64)
+        )
+    parents, children, lambdas, sizes = zip(*edges)
+    return (
+        np.array(parents, dtype=np.int64),
+        np.array(children, dtype=np.int64),
+        np.array(lambdas),
+        np.array(sizes, dtype=np.int64),
+    )
+
+
+def select_clusters(n, parents, children, lambdas, sizes):
+    """
+    Chooses the clusters of the condensed tree by excess of mass, as HDBSCAN does: a cluster is kept,
+    if its stability - sum of (lambda at which a module leaves it - lambda at which it was born) -
+    is at least the total stability of the clusters selected below it. The root isn't selectable.
+
+    :param n: number of modules.
+    :param parents: parents of the edges of condensed tree, see condense_tree.
+    :param children: children of the edges.
+    :param lambdas: lambdas of the edges.
+    :param sizes: numbers of modules of the children.
+    :return: labels of the modules, -1 for noise
+    """
+    n_clusters = max(parents.max() + 1 - n, 1) if len(parents) else 1
+    is_cluster = children >= n
+    birth = np.zeros(n_clusters)
+    birth[children[is_cluster] - n] = lambdas[is_cluster]
+    parent_of = np.full(n_clusters, -1, dtype=np.int64)
+    parent_of[children[is_cluster] - n] = parents[is_cluster] - n
+    stability = np.bincount(
+        parents - n,
+        weights=(lambdas - birth[parents - n]) * sizes,
+        minlength=n_clusters,
+    )
+
+    # children are numbered after their parents, so they are decided first
+    selected = np.zeros(n_clusters, dtype=bool)
+    below = np.zeros(
+        n_clusters
+    )  # stability of the clusters, selected under every cluster
+    for cluster in range(n_clusters - 1, 0, -1):
+        if stability[cluster] >= below[cluster]:
+            selected[cluster] = True
+            below[parent_of[cluster]] += stability[cluster]
+        else:
+            below[parent_of[cluster]] += below[cluster]
+    # the topmost selected cluster wins; parents go first in this order
+    chosen = np.full(n_clusters, -1, dtype=np.int64)
+    for cluster in range(1, n_clusters):
+        above = chosen[parent_of[cluster]]
+        chosen[cluster] = (
+            above if above >= 0 else (cluster if selected[cluster] else -1)
+        )
+
+    labels = np.full(n, -1, dtype=np.int64)
+    points = ~is_cluster
+    labels[children[points]] = chosen[parents[points] - n]
+    return relabel(labels)
+
+
+def cluster_knn_density(X, k=KNN):
+    """
+    Density-based clustering (HDBSCAN) over approximate k-NN graph, in near-linear time:
+    core distance of a module is the distance to its MIN_SAMPLES-th neighbour (counting itself, as in OPTICS),
+    and minimum spanning tree of mutual reachability distances between the neighbours is cut
+    where the clusters are the most stable, see select_clusters. Every cluster gets its own density
+    threshold, so no global eps is needed; modules, which don't belong to any cluster, are noise.
+    Noise modules are reported close to the cluster of their nearest clustered neighbour.
+
+    :param X: matrix of embeddings.
+    :param k: number of neighbours in the graph, not less than MIN_SAMPLES.
+    :return: (labels, -1 for noise; labels of the clusters closest to noise modules; dict with core distances)
+    """
+    n = len(X)
+    if n < MIN_SAMPLES:
+        empty = np.full(n, -1, dtype=np.int64)
+        return empty, empty, {"core_distances": np.zeros(n, np.float32)}
+    neighbours, distances = knn_graph(X, max(k, MIN_SAMPLES))
+    core = distances[:, MIN_SAMPLES - 2]
+
+    labels = select_clusters(
+        n,
+        *condense_tree(n, *single_linkage(n, *mst_edges(neighbours, distances, core))),
+    )
+
+    found = neighbours >= 0
+    neighbour_labels = np.where(found, labels[np.maximum(neighbours, 0)], -1)
+    clustered = neighbour_labels >= 0
+    nearest = np.where(
+        clustered.any(axis=1),
+        neighbour_labels[np.arange(n), clustered.argmax(axis=1)],
+        -1,
+    )
+    return labels, nearest, {"core_distances": core}
+
+
+CLUSTERING_BACKENDS = {
+    "optics": cluster_optics,
+    "kmeans": cluster_kmeans,
+    "knn-density": cluster_knn_density,
+}
@@ -1,10 +1,207 @@
+import time
+import atexit
+import socket
+import threading
 import pymysql
 import toolforge
+from pymysql.constants import SERVER_STATUS
 
+POOL_MAX_SIZE = 4  # max number of idle connections kept for one (cluster, host, port)
+# max number of idle connections kept for all the keys together; the least recently used ones are closed,
+# so the pool stays well below max_user_connections of the replicas (about 10 per tool)
+POOL_MAX_TOTAL = 4
+POOL_MAX_IDLE = 300  # seconds, after which an idle connection is closed
+POOL_PING_AFTER = 30  # seconds of idling, after which a connection is pinged
 
-def connect_to_user_database(db_name, user_db_port=None, user=None, password=None):
+# replica host of every dbname, resolved once; wikis of one section share the host
+_replica_hosts = {}
+
+
+class PooledConnection:
     """
-    Establishes connection to database, created by user, in Toolforge.
+    Connection taken from ConnectionPool. Behaves as the pymysql connection it wraps,
+    but close() returns the connection to the pool instead of closing it.
+    """
+
+    def __init__(self, pool, key, conn):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+
+    def __getattr__(self, name):
+        if self._conn is None:
+            raise pymysql.err.InterfaceError("Connection was returned to the pool")
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn is not None:
+            self._pool.release(self._key, self._conn)
+            self._conn = None
+
+
+class ConnectionPool:
+    """
+    Process-wide pool of pymysql connections, keyed by (cluster, host, port).
+    Can be shared between threads.
+    """
+
+    def __init__(
+        self,
+        max_size=POOL_MAX_SIZE,
+        max_idle=POOL_MAX_IDLE,
+        ping_after=POOL_PING_AFTER,
+        max_total=POOL_MAX_TOTAL,
+    ):
+        """
+        :param max_size: max number of idle connections kept for one key.
+        :param max_idle: seconds, after which an idle connection is closed.
+        :param ping_after: seconds of idling, after which a connection is checked before reuse.
+        :param max_total: max number of idle connections kept for all the keys together.
+        """
+        self.max_size = max_size
+        self.max_total = max_total
+        self.max_idle = max_idle
+        self.ping_after = ping_after
+        self.opened = 0
+        self.reused = 0
+        self.evicted = 0
+        self._idle = {}  # key -> list of (connection, time it was released)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except:
+            pass
+
+    def _pop_expired(self):
+        """
+        Removes connections idling for too long from the pool, and then the least recently released ones
+        over max_total; should be called with lock held.
+        """
+        expired = []
+        now = time.time()
+        for key, idle in list(self._idle.items()):
+            while idle and now - idle[0][1] > self.max_idle:
+                expired.append(idle.pop(0)[0])
+            if not idle:
+                del self._idle[key]
+        total = sum(len(idle) for idle in self._idle.values())
+        while total > self.max_total:
+            # lists are in release order, so the oldest connection of every key is the first one
+            key = min(self._idle, key=lambda key: self._idle[key][0][1])
+            expired.append(self._idle[key].pop(0)[0])
+            if not self._idle[key]:
+                del self._idle[key]
+            total -= 1
+        self.evicted += len(expired)
+        return expired
+
+    def acquire(self, key, connect):
+        """
+        Takes an idle connection for the key from the pool, or opens a new one.
+
+        :param key: tuple (cluster, host, port).
+        :param connect: function without arguments, which opens a new connection.
+        :return: PooledConnection
+        """
+        while True:
+            with self._lock:
+                expired = self._pop_expired()
+                idle = self._idle.get(key)
+                entry = idle.pop() if idle else None
+            for conn in expired:
+                self._close(conn)
+
+            if entry is None:
+                break
+
+            conn, released = entry
+            if time.time() - released > self.ping_after:
+                try:
+                    conn.ping(reconnect=False)
+                except Exception:
+                    with self._lock:
+                        self.evicted += 1
+                    self._close(conn)
+                    continue
+
+            with self._lock:
+                self.reused += 1
+            return PooledConnection(self, key, conn)
+
+        conn = connect()
+        with self._lock:
+            self.opened += 1
+        return PooledConnection(self, key, conn)
+
+    def release(self, key, conn):
+        """
+        Returns the connection to the pool, if it's still usable and there's room for it.
+        Unfinished transaction is rolled back, so the next user doesn't get a stale snapshot.
+        Connections, which idled for too long or exceed max_total, are closed here too,
+        so they don't stay open, when the pool isn't used anymore.
+
+        :param key: tuple (cluster, host, port).
+        :param conn: pymysql connection.
+        :return: None
+        """
+        healthy = conn.open and not (
+            # result of a server-side cursor wasn't read till the end
+            conn._result is not None
+            and conn._result.unbuffered_active
+        )
+        if healthy and conn.server_status & SERVER_STATUS.SERVER_STATUS_IN_TRANS:
+            try:
+                conn.rollback()
+            except Exception:
+                healthy = False
+
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if healthy and len(idle) < self.max_size:
+                idle.append((conn, time.time()))
+                conn = None
+            else:
+                self.evicted += 1
+            expired = self._pop_expired()
+        if conn is not None:
+            self._close(conn)
+        for conn in expired:
+            self._close(conn)
+
+    def close_all(self):
+        """
+        Closes all idle connections.
+
+        :return: None
+        """
+        with self._lock:
+            idle = [entry[0] for entries in self._idle.values() for entry in entries]
+            self._idle = {}
+        for conn in idle:
+            self._close(conn)
+
+    def stats(self):
+        """
+        :return: dictionary with number of connections opened, reused and evicted from the pool
+        """
+        with self._lock:
+            return {
+                "opened": self.opened,
+                "reused": self.reused,
+                "evicted": self.evicted,
+            }
+
+
+POOL = ConnectionPool()
+atexit.register(POOL.close_all)
+
+
+def open_user_database(db_name, user_db_port=None, user=None, password=None):
+    """
+    Opens new connection to database, created by user, in Toolforge.
     :param db_name: name of user's database
     :param user_db_port: port for connecting to db through ssh tunneling, if used
     :param user: Toolforge username of the tool
@@ -33,9 +230,9 @@ def connect_to_user_database(db_name, user_db_port=None, user=None, password=Non
         exit(1)
 
 
-def connect_to_replicas_database(db_name, replicas_port=None, user=None, password=None):
+def open_replicas_database(db_name, replicas_port=None, user=None, password=None):
     """
-    Establishes connection to Wikimedia replicas database in Toolforge.
+    Opens new connection to Wikimedia replicas database in Toolforge.
     :param db_name: name of the database
     :param replicas_port: port for connecting to db through ssh tunneling, if used
     :param user: Toolforge username of the tool
@@ -66,3 +263,77 @@ def connect_to_replicas_database(db_name, replicas_port=None, user=None, passwor
         print("Failure: Please establish connection to Toolforge")
         print("Error: ", err)
         exit(1)
+
+
+def connect_to_user_database(db_name, user_db_port=None, user=None, password=None):
+    """
+    Establishes connection to database, created by user, in Toolforge.
+    The connection is taken from the pool; close() returns it back.
+    :param db_name: name of user's database
+    :param user_db_port: port for connecting to db through ssh tunneling, if used
+    :param user: Toolforge username of the tool
+    :param password: Toolforge password pf the tool
+    :return: PooledConnection to the database
+    """
+    return POOL.acquire(
+        ("tools", db_name, user_db_port),
+        lambda: open_user_database(db_name, user_db_port, user, password),
+    )
+
+
+def get_replica_host(dbname):
+    """
+    Finds the address of the analytics replica serving the database.
+    Per-wiki hostnames point to the server of the wiki's section,
+    so connections to wikis of the same section can be shared.
+    :param dbname: name of the database, without "_p"
+    :return: ip address of the replica, or the hostname, if it can't be resolved
+    """
+    if dbname not in _replica_hosts:
+        # same naming as in toolforge.connect
+        host = "%s.analytics.db.svc.wikimedia.cloud" % (
+            "s7" if dbname == "meta" else dbname
+        )
+        try:
+            _replica_hosts[dbname] = socket.gethostbyname(host)
+        except OSError:
+            _replica_hosts[dbname] = host
+    return _replica_hosts[dbname]
+
+
+def connect_to_replicas_database(db_name, replicas_port=None, user=None, password=None):
+    """
+    Establishes connection to Wikimedia replicas database in Toolforge.
+    The connection is taken from the pool; close() returns it back.
+    Idle connections are kept per replica host, not per database,
+    so the database is selected again on every call.
+    :param db_name: name of the database
+    :param replicas_port: port for connecting to db through ssh tunneling, if used
+    :param user: Toolforge username of the tool
+    :param password: Toolforge password pf the tool
+    :return: PooledConnection to the database
+    """
+    dbname = db_name[:-2] if db_name[-2:] == "_p" else db_name
+    if replicas_port:
+        key = ("analytics", "127.0.0.1", replicas_port)
+    else:
+        key = ("analytics", get_replica_host(dbname), None)
+    conn = POOL.acquire(
+        key,
+        lambda: open_replicas_database(db_name, replicas_port, user, password),
+    )
+    try:
+        conn.select_db(dbname + "_p")
+    except pymysql.err.Error:
+        conn.close()
+        raise
+    return conn
+
+
+def get_pool_stats():
+    """
+    Returns counters of the connection pool.
+
+    :return: dictionary with number of connections opened, reused and evicted
+    """
+    return POOL.stats()
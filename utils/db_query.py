@@ -3,13 +3,18 @@ import pandas as pd
 import numpy as np
 import pymysql
 import time
+import hashlib
 import utils.db_access as db_acc
+import utils.sourcecode_codec as codec
 from constants import DATABASE_NAME
 
 pymysql.converters.encoders[np.int64] = pymysql.converters.escape_int
 pymysql.converters.conversions = pymysql.converters.encoders.copy()
 pymysql.converters.conversions.update(pymysql.converters.decoders)
 
+BATCH_SIZE = 1000  # max number of rows written with one statement
+MAX_STMT_LENGTH = 1024000  # same limit pymysql uses for splitting executemany
+
 
 def encode_if_necessary(b):
     if type(b) is bytes:
@@ -17,6 +22,37 @@ def encode_if_necessary(b):
     return b
 
 
+def decode_text_columns(df, text_cols=None):
+    """
+    Decodes bytes into str in text columns of the dataframe, one column at a time.
+    Numeric and datetime columns are left as they are, keeping their native dtypes.
+
+    :param df: DataFrame built from the rows returned by pymysql; modified in place.
+    :param text_cols: Names of the columns to decode. If None, all columns of object dtype are decoded.
+    :return: dataframe
+    """
+    if text_cols is None:
+        text_cols = [col for col in df.columns if df[col].dtype == object]
+    for col in text_cols:
+        df[col] = [
+            value.decode("utf8") if type(value) is bytes else value
+            for value in df[col].values
+        ]
+    return df
+
+
+def rows_to_dataframe(rows, cols, text_cols=None):
+    """
+    Builds dataframe from the rows returned by pymysql, decoding only the text columns.
+
+    :param rows: Sequence of rows, as returned by cursor.fetchall() or cursor.fetchmany().
+    :param cols: The name of the columns to be used in dataframe.
+    :param text_cols: Names of the columns to decode. If None, all columns of object dtype are decoded.
+    :return: dataframe
+    """
+    return decode_text_columns(pd.DataFrame(rows, columns=cols), text_cols)
+
+
 def get_dbs(user_db_port=None, user=None, password=None):
     """
     Returns a list of all the dbnames from Sources table.
@@ -42,6 +78,162 @@ def get_dbs(user_db_port=None, user=None, password=None):
         exit(1)
 
 
+def get_watermark(dbname, name, user_db_port=None, user=None, password=None):
+    """
+    Returns the watermark, saved by the last incremental run of a collector for the database.
+
+    :param dbname: The database the collector was run for.
+    :param name: Name of the watermark, usually the name of the collector.
+    :param user_db_port: Port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :return: (watermark, full_recount_time), or (None, None) if there's no watermark yet
+    """
+    conn = db_acc.connect_to_user_database(DATABASE_NAME, user_db_port, user, password)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                "SELECT watermark, full_recount_time FROM Watermarks "
+                "WHERE dbname=%s AND name=%s",
+                (dbname, name),
+            )
+            row = cur.fetchone()
+        conn.commit()
+    finally:
+        close_conn(conn)
+    if row is None:
+        return None, None
+    return encode_if_necessary(row[0]), row[1]
+
+
+def save_watermark(
+    dbname,
+    name,
+    watermark,
+    full_recount=False,
+    user_db_port=None,
+    user=None,
+    password=None,
+):
+    """
+    Saves the watermark of a collector for the database.
+
+    :param dbname: The database the collector was run for.
+    :param name: Name of the watermark, usually the name of the collector.
+    :param watermark: MediaWiki timestamp (YYYYMMDDHHMMSS), the next incremental run should start from.
+    :param full_recount: Whether the run was a full recount; if so, its time is saved as well.
+    :param user_db_port: Port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :return: None
+    """
+    query = (
+        "INSERT INTO Watermarks(dbname, name, watermark, update_time, full_recount_time) "
+        "VALUES(%s, %s, %s, UTC_TIMESTAMP(), IF(%s, UTC_TIMESTAMP(), NULL)) "
+        "ON DUPLICATE KEY UPDATE watermark=VALUES(watermark), update_time=VALUES(update_time), "
+        "full_recount_time=IFNULL(VALUES(full_recount_time), full_recount_time)"
+    )
+    conn = db_acc.connect_to_user_database(DATABASE_NAME, user_db_port, user, password)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query, (dbname, name, watermark, full_recount))
+        conn.commit()
+    finally:
+        close_conn(conn)
+
+
+def get_content_hash(sourcecode):
+    """
+    Returns the key, under which the sourcecode is stored in Sourcecodes table;
+    equal to SHA1(sourcecode) in MySQL.
+
+    :param sourcecode: Sourcecode of the module.
+    :return: hex string of SHA-1 of the utf8-encoded sourcecode
+    """
+    return hashlib.sha1(sourcecode.encode("utf8")).hexdigest()
+
+
+def save_sourcecodes(
+    cur, sourcecodes, batch_size=BATCH_SIZE, codec_name=codec.DEFAULT_CODEC
+):
+    """
+    Saves sourcecodes into Sourcecodes table, sending only those which aren't stored yet.
+
+    :param cur: Cursor of the connection to the user database.
+    :param sourcecodes: Dictionary {content_hash: sourcecode}.
+    :param batch_size: Maximum number of rows written or looked up with one statement.
+    :param codec_name: Format, in which the sourcecodes are stored, see utils.sourcecode_codec.
+    :return: number of new sourcecodes
+    """
+    hashes = list(sourcecodes)
+    stored = set()
+    for i in range(0, len(hashes), batch_size):
+        batch = hashes[i : i + batch_size]
+        cur.execute(
+            "SELECT content_hash FROM Sourcecodes WHERE content_hash IN (%s)"
+            % ", ".join(["%s"] * len(batch)),
+            batch,
+        )
+        stored.update(encode_if_necessary(row[0]) for row in cur.fetchall())
+
+    rows = [
+        [h, codec.encode(sourcecodes[h], codec_name)]
+        for h in hashes
+        if h not in stored
+    ]
+    bulk_upsert(
+        cur,
+        "Sourcecodes",
+        ["content_hash", "sourcecode"],
+        rows,
+        ["content_hash"],
+        batch_size,
+    )
+    return len(rows)
+
+
+def get_dedup_stats(user_db_port=None, user=None, password=None, condition=None):
+    """
+    Counts how many distinct sourcecodes are shared by the modules in Scripts table.
+
+    :param user_db_port: Port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :param condition: SQL condition to count only some of the modules, e.g. "is_data=0".
+    :return: (number of modules with sourcecode, number of distinct sourcecodes)
+    """
+    query = (
+        "SELECT COUNT(*), COUNT(DISTINCT content_hash) FROM Scripts "
+        "WHERE content_hash IS NOT NULL"
+    )
+    if condition:
+        query += " AND " + condition
+    conn = db_acc.connect_to_user_database(DATABASE_NAME, user_db_port, user, password)
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query)
+            pages, distinct = cur.fetchone()
+        conn.commit()
+    finally:
+        close_conn(conn)
+    return pages, distinct
+
+
+def print_dedup_ratio(pages, distinct, what="Sourcecodes"):
+    """
+    Prints how many times deduplication reduced the number of processed sourcecodes.
+
+    :param pages: Number of modules.
+    :param distinct: Number of distinct sourcecodes among them.
+    :param what: What the numbers describe.
+    :return: None
+    """
+    print(
+        "%s: %d modules share %d distinct sourcecodes (dedup ratio %.2f)"
+        % (what, pages, distinct, pages / max(distinct, 1))
+    )
+
+
 def close_conn(conn):
     try:
         conn.close()
@@ -49,7 +241,88 @@ def close_conn(conn):
         pass
 
 
-def query_data_generator(
+def df_to_rows(df):
+    """
+    Converts dataframe to list of rows, ready to be passed as query parameters.
+
+    :param df: DataFrame to convert.
+    :return: list of lists, where NaN values are replaced with None (NULL).
+    """
+    return df.astype(object).where(df.notna(), None).values.tolist()
+
+
+def bulk_upsert(cur, table, cols, rows, update_cols, batch_size=BATCH_SIZE):
+    """
+    Inserts rows into the table with multi-row INSERT ... ON DUPLICATE KEY UPDATE statements.
+
+    :param cur: Cursor of the connection to the database.
+    :param table: Name of the table.
+    :param cols: Names of the columns, in order of values in each row.
+    :param rows: List of rows (lists of values).
+    :param update_cols: Columns updated when the row already exists: either names of the columns,
+    which get the new value, or custom assignments like "is_missed = 0".
+    :param batch_size: Maximum number of rows written with one statement.
+    :return: None
+    """
+    updates = ", ".join(
+        col if "=" in col else "%s = VALUES(%s)" % (col, col) for col in update_cols
+    )
+    query = "INSERT INTO %s(%s) VALUES(%s) ON DUPLICATE KEY UPDATE %s" % (
+        table,
+        ", ".join(cols),
+        ", ".join(["%s"] * len(cols)),
+        updates,
+    )
+    # pymysql turns executemany of INSERT ... VALUES into multi-row statements
+    for i in range(0, len(rows), batch_size):
+        cur.executemany(query, rows[i : i + batch_size])
+
+
+def bulk_update(
+    cur, table, key_cols, cols, rows, batch_size=BATCH_SIZE, increment=False
+):
+    """
+    Updates existing rows of the table with multi-row UPDATE ... JOIN statements.
+    Unlike bulk_upsert, rows that don't exist in the table are not created.
+
+    :param cur: Cursor of the connection to the database.
+    :param table: Name of the table.
+    :param key_cols: Columns identifying the row, e.g. ["page_id", "dbname"].
+    :param cols: Columns to update.
+    :param rows: List of rows (lists of values) in order of key_cols + cols.
+    :param batch_size: Maximum number of rows written with one statement.
+    :param increment: Whether to add the values to the stored ones instead of replacing them.
+    :return: None
+    """
+    all_cols = list(key_cols) + list(cols)
+    first_select = "SELECT " + ", ".join("%s AS " + col for col in all_cols)
+    select = "SELECT " + ", ".join(["%s"] * len(all_cols))
+    on = " AND ".join("t.%s = v.%s" % (col, col) for col in key_cols)
+    if increment:
+        updates = ", ".join("t.%s = t.%s + v.%s" % (col, col, col) for col in cols)
+    else:
+        updates = ", ".join("t.%s = v.%s" % (col, col) for col in cols)
+
+    def flush(selects):
+        cur.execute(
+            "UPDATE %s AS t INNER JOIN (%s) AS v ON %s SET %s"
+            % (table, " UNION ALL ".join(selects), on, updates)
+        )
+
+    selects = []
+    length = 0
+    for row in rows:
+        selects.append(cur.mogrify(select if selects else first_select, row))
+        length += len(selects[-1])
+        if len(selects) >= batch_size or length >= MAX_STMT_LENGTH:
+            flush(selects)
+            selects = []
+            length = 0
+    if selects:
+        flush(selects)
+
+
+def stream_data_generator(
     query,
     function_name,
     cols,
@@ -60,10 +333,13 @@ def query_data_generator(
     password=None,
     replicas=True,
     row_count=500,
-    no_offset=False
+    text_cols=None,
+    raise_errors=False,
 ):
     """
-    Query database (db) and return outputs in chunks.
+    Run the query once with an unbuffered server-side cursor and return outputs in chunks as rows arrive.
+    Retries are done only before the first chunk is returned, as rows can't be re-read afterwards.
+    If the consumer stops early, the connection is closed without reading the rest of the result.
 
     :param query: The SQL query to run.
     :param function_name: The function that was used to collect this data, useful for saving when data is missed due to errors.
@@ -74,40 +350,182 @@ def query_data_generator(
     :param user: Toolforge username of the tool.
     :param password: Toolforge password of the tool.
     :param replicas: False if collecting data from toolsdb user database, True if collecting from other wikimedia databases.
+    :param row_count: Number of rows in one chunk.
+    :param text_cols: Columns to decode from bytes into str; if None, all columns of object dtype are decoded.
+    :param raise_errors: Whether to raise the error instead of logging the (function, db) pair into missed_db_info.txt.
+    :return: dataframe
+    """
+    max_tries = 3
+    retry_counter = 0
+    conn = None
+    cur = None
+    exhausted = False
+
+    try:
+        while True:
+            try:
+                conn = (
+                    db_acc.connect_to_replicas_database(
+                        db, replicas_port, user, password
+                    )
+                    if replicas
+                    else db_acc.connect_to_user_database(
+                        DATABASE_NAME, user_db_port, user, password
+                    )
+                )
+                cur = conn.cursor(pymysql.cursors.SSCursor)
+                cur.execute(query)
+                break
+            except (pymysql.err.DatabaseError, pymysql.err.OperationalError) as err:
+                close_conn(conn)
+                conn = None
+                if retry_counter == max_tries:
+                    raise Exception(err)
+                print(
+                    "Retrying query of '%s' from %s in 1 minute..."
+                    % (function_name, db)
+                )
+                retry_counter += 1
+                time.sleep(60)
+
+        while True:
+            rows = cur.fetchmany(row_count)
+            if not rows:
+                exhausted = True
+                return
+            yield rows_to_dataframe(rows, cols, text_cols)
+    except Exception as err:
+        if raise_errors:
+            raise
+        print("Something went wrong. Could not query from %s \n" % db, repr(err))
+        with open("missed_db_info.txt", "a") as file:
+            file.write(function_name + " " + db + "\n")
+    finally:
+        # closing the cursor would read all the remaining rows, so it's done only for a finished result
+        if exhausted:
+            cur.close()
+            conn.commit()
+        close_conn(conn)
+
+
+def query_data_generator(
+    query,
+    function_name,
+    cols,
+    db=None,
+    replicas_port=None,
+    user_db_port=None,
+    user=None,
+    password=None,
+    replicas=True,
+    row_count=500,
+    no_offset=False,
+    key=None,
+    stream=False,
+    text_cols=None,
+    raise_errors=False,
+):
+    """
+    Query database (db) and return outputs in chunks. One connection is used for all the chunks
+    (a new one is opened only when retrying after an error).
+
+    By default chunks are requested with LIMIT/OFFSET, so the database has to skip all the previous
+    rows for every next chunk. If `key` is given, keyset pagination is used instead: the query has to
+    contain a "{keyset}" placeholder in its WHERE (or ON) clause, which is replaced with
+    "<key> > <last seen value>", and the results are ordered by key; thus every chunk starts with
+    an index seek right after the previous one.
+
+    If `stream` is set, the query is run only once with an unbuffered server-side cursor, and chunks
+    are built from the rows as they arrive, so memory usage doesn't depend on the size of the result.
+    As the server waits while a chunk is processed, the consumer shouldn't spend too long on one chunk.
+
+    :param query: The SQL query to run; shouldn't contain ORDER BY or LIMIT.
+    :param function_name: The function that was used to collect this data, useful for saving when data is missed due to errors.
+    :param cols: The name of the columns to be used in dataframe for the data collected with SQL.
+    :param db: The database from which the data was collected.
+    :param replicas_port: port for connecting to meta table through ssh tunneling, if used.
+    :param user_db_port: port for connecting to local Sources table through ssh tunneling, if used.
+    :param user: Toolforge username of the tool.
+    :param password: Toolforge password of the tool.
+    :param replicas: False if collecting data from toolsdb user database, True if collecting from other wikimedia databases.
     :param row_count: Number of rows to get in one query from the database.
     :param no_offset: Disables offset for requests, which contents change while iterating.
+    :param key: Column (as it should be written in the query) to use for keyset pagination.
+    Its values have to be unique in the results, and it has to be the first of the selected columns.
+    :param stream: Whether to stream results of a single query instead of paginating;
+    "{keyset}" placeholder, if present, is replaced with TRUE.
+    :param text_cols: Columns to decode from bytes into str; if None, all columns of object dtype are decoded.
+    :param raise_errors: Whether to raise the error instead of logging the (function, db) pair into missed_db_info.txt.
     :return: dataframe
     """
+    if stream:
+        yield from stream_data_generator(
+            query.replace("{keyset}", "TRUE"),
+            function_name,
+            cols,
+            db,
+            replicas_port,
+            user_db_port,
+            user,
+            password,
+            replicas,
+            row_count,
+            text_cols,
+            raise_errors,
+        )
+        return
+
+    if key is not None and "{keyset}" not in query:
+        raise ValueError("Query has no {keyset} placeholder for keyset pagination")
 
     offset = 0
+    last_key = None
     max_tries = 3
+    conn = None
 
-    while True:
-        retry_counter = 0
-        try:
+    try:
+        while True:
+            retry_counter = 0
             while True:
                 try:
-                    conn = (
-                        db_acc.connect_to_replicas_database(
-                            db, replicas_port, user, password
+                    if conn is None:
+                        conn = (
+                            db_acc.connect_to_replicas_database(
+                                db, replicas_port, user, password
+                            )
+                            if replicas
+                            else db_acc.connect_to_user_database(
+                                DATABASE_NAME, user_db_port, user, password
+                            )
                         )
-                        if replicas
-                        else db_acc.connect_to_user_database(
-                            DATABASE_NAME, user_db_port, user, password
+
+                    if key is None:
+                        chunk_query = query + " LIMIT %d OFFSET %d" % (
+                            row_count,
+                            offset,
                         )
-                    )
-                    with conn.cursor() as cur:
-                        cur.execute(query + " LIMIT %d OFFSET %d" % (row_count, offset))
-                        df = pd.DataFrame(cur.fetchall(), columns=cols).applymap(
-                            encode_if_necessary
+                    else:
+                        condition = (
+                            "TRUE"
+                            if last_key is None
+                            else "%s > %s" % (key, conn.escape(last_key))
                         )
-                    close_conn(conn)
+                        chunk_query = query.replace(
+                            "{keyset}", condition
+                        ) + " ORDER BY %s LIMIT %d" % (key, row_count)
+
+                    with conn.cursor() as cur:
+                        cur.execute(chunk_query)
+                        df = rows_to_dataframe(cur.fetchall(), cols, text_cols)
+                    # end the transaction, so the next chunk sees changes, committed meanwhile
+                    conn.commit()
                     break
                 except (
                     pymysql.err.DatabaseError,
                     pymysql.err.OperationalError,
                 ) as err:
                     close_conn(conn)
+                    conn = None
                     if retry_counter == max_tries:
                         raise Exception(err)
                     print(
@@ -116,16 +534,21 @@ def query_data_generator(
                     )
                     retry_counter += 1
                     time.sleep(60)
-            if not no_offset:
+            if key is not None and len(df) > 0:
+                last_key = df.iloc[-1, 0]
+            elif not no_offset:
                 offset += row_count
             if len(df) == 0:
                 return
             yield df
-        except Exception as err:
-            print("Something went wrong. Could not query from %s \n" % db, repr(err))
-            with open("missed_db_info.txt", "a") as file:
-                file.write(function_name + " " + db + "\n")
-            break
+    except Exception as err:
+        if raise_errors:
+            raise
+        print("Something went wrong. Could not query from %s \n" % db, repr(err))
+        with open("missed_db_info.txt", "a") as file:
+            file.write(function_name + " " + db + "\n")
+    finally:
+        close_conn(conn)
 
 
 def save_data(
@@ -138,6 +561,10 @@ def save_data(
     query=None,
     cols=None,
     custom=False,
+    batch_size=BATCH_SIZE,
+    increment=False,
+    raise_errors=False,
+    key_cols=None,
 ):
     """
     Save data from df into Scripts table.
@@ -151,18 +578,23 @@ def save_data(
     :param query: Only used when custom=True. The query to use to save into table.
     :param cols: Only used when custom=True. The column list in order of params in the query.
     :param custom: True if providing custom query and column list to use to save into table.
+    :param batch_size: Maximum number of rows written with one statement; not used when custom=True.
+    :param increment: Whether to add the values to the stored ones instead of replacing them; not used when custom=True.
+    :param raise_errors: Whether to raise the error instead of logging the (function, db) pair into missed_db_info.txt.
+    :param key_cols: Columns, by which the updated rows are found; df has to start with them. By default
+    rows are found by page_id (the first column of df) and dbname (taken from the argument); not used when custom=True.
     :return: None
     """
 
-    if not custom:
-        cols = df.columns.values[1:]  # skip page_id
-        updates = ",".join([col + "=%s" for col in cols])
-
-        query = "UPDATE Scripts SET %s WHERE dbname='%s' AND page_id=%s " % (
-            updates,
-            dbname,
-            "%s",
-        )
+    if not custom and key_cols is None:
+        key_cols = ["page_id", "dbname"]
+        cols = list(df.columns.values[1:])  # skip page_id
+        rows = [[row[0], dbname] + row[1:] for row in df_to_rows(df)]
+    elif not custom:
+        cols = list(df.columns.values[len(key_cols) :])
+        rows = df_to_rows(df)
+    else:
+        rows = df_to_rows(df[cols])
 
     max_tries = 3
 
@@ -174,14 +606,18 @@ def save_data(
                     DATABASE_NAME, user_db_port, user, password
                 )
                 with conn.cursor() as cur:
-                    for index, elem in df.iterrows():
-                        if not custom:
-                            params = list(
-                                np.concatenate((elem.values[1:], elem.values[0:1]))
-                            )
-                        else:
-                            params = [elem[col] for col in cols]
-                        cur.execute(query, params)
+                    if not custom:
+                        bulk_update(
+                            cur,
+                            "Scripts",
+                            key_cols,
+                            cols,
+                            rows,
+                            batch_size,
+                            increment,
+                        )
+                    else:
+                        cur.executemany(query, rows)
                 conn.commit()
                 close_conn(conn)
                 break
@@ -197,6 +633,8 @@ def save_data(
                 time.sleep(60)
 
     except Exception as err:
+        if raise_errors:
+            raise
         print("Something went wrong. Error saving pages from %s \n" % dbname, repr(err))
         with open("missed_db_info.txt", "a") as file:
             file.write(function_name + " " + dbname + "\n")
\ No newline at end of file
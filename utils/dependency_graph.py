@@ -0,0 +1,146 @@
+from collections import deque
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+CANONICAL_PREFIX = "module"
+
+
+def normalize_name(name):
+    """
+    Normalizes page name the way MediaWiki does: underscores are spaces, surrounding spaces are dropped.
+
+    :param name: page name without namespace prefix.
+    :return: str
+    """
+    return " ".join(name.replace("_", " ").split())
+
+
+def resolve_dependencies(scripts, edges):
+    """
+    Resolves names of the required modules, like "Module:Arguments", to page_id of the modules in the same wiki.
+    Both the canonical "Module:" prefix and the local namespace name (as seen in titles of the wiki's modules)
+    are recognized; the first letter of the name is capitalized, if there's no exact match.
+
+    :param scripts: DataFrame with columns dbname, page_id, title.
+    :param edges: DataFrame with columns dbname, dependency.
+    :return: numpy array of page_id of the required modules, NaN where not resolved
+    """
+    pages = {}
+    prefixes = {}
+    for dbname, page_id, title in zip(
+        scripts["dbname"], scripts["page_id"], scripts["title"]
+    ):
+        if not isinstance(title, str) or ":" not in title:
+            continue
+        prefix, name = title.split(":", 1)
+        pages[(dbname, normalize_name(name))] = page_id
+        prefixes.setdefault(dbname, {CANONICAL_PREFIX}).add(prefix.strip().lower())
+
+    resolved = np.full(len(edges), np.nan)
+    for i, (dbname, dependency) in enumerate(zip(edges["dbname"], edges["dependency"])):
+        if ":" not in dependency:
+            continue  # Scribunto libraries, like require("strict")
+        prefix, name = dependency.split(":", 1)
+        if prefix.strip().lower() not in prefixes.get(dbname, ()):
+            continue
+        name = normalize_name(name)
+        page_id = pages.get((dbname, name))
+        if page_id is None and name:
+            page_id = pages.get((dbname, name[0].upper() + name[1:]))
+        if page_id is not None:
+            resolved[i] = page_id
+    return resolved
+
+
+def unique_edges(sources, targets, n):
+    """
+    Removes loops and repeated edges.
+
+    :param sources: array of sources of the edges.
+    :param targets: array of targets of the edges.
+    :param n: number of nodes.
+    :return: (sources, targets) int64 arrays
+    """
+    sources = np.asarray(sources, dtype=np.int64)
+    targets = np.asarray(targets, dtype=np.int64)
+    # sorting one int64 key is much faster than np.unique(..., axis=0)
+    keys = np.unique(sources[sources != targets] * n + targets[sources != targets])
+    return keys // n, keys % n
+
+
+def popcount(bits):
+    """
+    :param bits: non-negative int.
+    :return: number of set bits
+    """
+    return bin(bits).count("1")
+
+
+def count_dependents(n, sources, targets):
+    """
+    Counts direct (fan-in) and transitive dependents of every node of a directed graph,
+    where edge source -> target means that source depends on target.
+
+    Strongly connected components (modules requiring each other) are collapsed with scipy, and
+    the sets of transitive dependents are propagated through the resulting DAG in topological order
+    as bitsets. Bits are numbered separately in every weakly connected part of the graph (usually a wiki
+    or a group of its modules), so bitsets grow with the size of the part, not of the whole graph.
+
+    :param n: number of nodes.
+    :param sources: array of nodes, which depend on the targets.
+    :param targets: array of nodes, which the sources depend on.
+    :return: (fan_in, dependents) numpy arrays of length n
+    """
+    sources, targets = unique_edges(sources, targets, n)
+
+    fan_in = np.bincount(targets, minlength=n)
+    if len(sources) == 0:
+        return fan_in, np.zeros(n, dtype=np.int64)
+
+    graph = csr_matrix(
+        (np.ones(len(sources), dtype=np.int8), (sources, targets)), shape=(n, n)
+    )
+    n_comps, comps = connected_components(graph, directed=True, connection="strong")
+    _, parts = connected_components(graph, directed=True, connection="weak")
+    sizes = np.bincount(comps, minlength=n_comps)
+    comp_parts = np.empty(n_comps, dtype=np.int64)
+    comp_parts[comps] = parts
+
+    comp_sources, comp_targets = unique_edges(comps[sources], comps[targets], n_comps)
+    successors = csr_matrix(
+        (np.ones(len(comp_sources), dtype=np.int8), (comp_sources, comp_targets)),
+        shape=(n_comps, n_comps),
+    )
+    indptr = successors.indptr.tolist()
+    indices = successors.indices.tolist()
+    remaining = np.bincount(comp_targets, minlength=n_comps).tolist()
+    sizes = sizes.tolist()
+    comp_parts = comp_parts.tolist()
+
+    # members of a cycle depend on each other
+    comp_dependents = [size - 1 for size in sizes]
+    ancestors = {}  # component -> bitset of nodes, which depend on it, collected so far
+    offsets = {}  # part -> first unused bit
+    queue = deque(comp for comp in range(n_comps) if remaining[comp] == 0)
+    while queue:
+        comp = queue.popleft()
+        bits = ancestors.pop(comp, 0)
+        comp_dependents[comp] += popcount(bits)
+        start, end = indptr[comp], indptr[comp + 1]
+        if start == end:
+            continue
+
+        # bits of the component's nodes are allocated in topological order
+        offset = offsets.get(comp_parts[comp], 0)
+        offsets[comp_parts[comp]] = offset + sizes[comp]
+        bits |= ((1 << sizes[comp]) - 1) << offset
+        for succ in indices[start:end]:
+            ancestors[succ] = ancestors.get(succ, 0) | bits
+            remaining[succ] -= 1
+            if remaining[succ] == 0:
+                queue.append(succ)
+
+    dependents = np.array(comp_dependents, dtype=np.int64)[comps]
+    return fan_in, dependents
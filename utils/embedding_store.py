@@ -0,0 +1,223 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+INDEX_DTYPE = np.dtype([("dbname", "S32"), ("page_id", "<u4"), ("content_hash", "S40")])
+COPY_CHUNK = 65536  # rows copied at once, when the matrix is rewritten
+
+
+class EmbeddingStore:
+    """
+    On-disk store of embeddings of all modules: float32 matrix in <path>.npy, row per module,
+    and its index - (dbname, page_id, content_hash) of every row - in <path>.index.npy.
+    Version of the model, which computed the embeddings, is kept in <path>.json.
+
+    The matrix is memory-mapped, so readers (clustering, nearest-neighbour queries, web app)
+    share the vectors without loading them into memory or loading the model.
+    Changed rows are overwritten in place; new rows are appended by writing a new file
+    chunk by chunk and replacing the old one, so readers of the old file are not disturbed.
+    """
+
+    def __init__(self, path):
+        """
+        :param path: path of the store files without extension, e.g. "WE_embeddings".
+        """
+        self.path = path
+        self.version = None
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self.index = pd.DataFrame(
+            {
+                "dbname": pd.Series([], dtype=object),
+                "page_id": pd.Series([], dtype=np.int64),
+                "content_hash": pd.Series([], dtype=object),
+            }
+        )
+        self._rows = pd.Series([], dtype=np.int64)
+        self.load()
+
+    @property
+    def vectors_file(self):
+        return self.path + ".npy"
+
+    @property
+    def index_file(self):
+        return self.path + ".index.npy"
+
+    @property
+    def meta_file(self):
+        return self.path + ".json"
+
+    def load(self):
+        """
+        (Re)opens the store files, if they exist.
+
+        :return: None
+        """
+        try:
+            with open(self.meta_file) as file:
+                meta = json.load(file)
+            vectors = np.load(self.vectors_file, mmap_mode="r")
+            index = np.load(self.index_file)
+        except (OSError, ValueError):
+            return
+        if len(index) != len(vectors):
+            return
+
+        self.version = meta.get("version")
+        self.vectors = vectors
+        self.index = pd.DataFrame(
+            {
+                "dbname": np.char.decode(index["dbname"], "utf8").astype(object),
+                "page_id": index["page_id"].astype(np.int64),
+                "content_hash": np.char.decode(index["content_hash"], "ascii").astype(
+                    object
+                ),
+            }
+        )
+        self._rows = pd.Series(
+            np.arange(len(index)),
+            index=pd.MultiIndex.from_arrays(
+                [self.index["dbname"], self.index["page_id"]]
+            ),
+        )
+
+    def __len__(self):
+        return len(self.index)
+
+    def find(self, df):
+        """
+        Finds rows of the modules in the store.
+
+        :param df: DataFrame with columns dbname, page_id.
+        :return: numpy array of row numbers, -1 for modules not in the store
+        """
+        keys = pd.MultiIndex.from_arrays([df["dbname"], df["page_id"]])
+        return self._rows.reindex(keys).fillna(-1).values.astype(np.int64)
+
+    def find_hashes(self, hashes):
+        """
+        Finds a row with embedding of every given sourcecode.
+
+        :param hashes: content_hash values.
+        :return: numpy array of row numbers, -1 for sourcecodes not in the store
+        """
+        rows = pd.Series(
+            np.arange(len(self.index)), index=self.index["content_hash"].values
+        )
+        rows = rows[~rows.index.duplicated()]
+        return rows.reindex(list(hashes)).fillna(-1).values.astype(np.int64)
+
+    def changed(self, df):
+        """
+        Checks which modules are new or have another sourcecode than the stored one.
+
+        :param df: DataFrame with columns dbname, page_id, content_hash.
+        :return: numpy array of bools
+        """
+        rows = self.find(df)
+        stored = self.index["content_hash"].values[np.maximum(rows, 0)]
+        return (rows < 0) | (stored != df["content_hash"].values)
+
+    def update(self, df, vectors, version):
+        """
+        Saves embeddings of the modules: rows of the stored modules are overwritten, new modules are appended.
+        If the store holds embeddings of another model version, it's cleared first.
+
+        :param df: DataFrame with columns dbname, page_id, content_hash.
+        :param vectors: Matrix of embeddings, row per module in df.
+        :param version: Version of the model, which computed the embeddings.
+        :return: None
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if version != self.version or (
+            len(self) and self.vectors.shape[1] != vectors.shape[1]
+        ):
+            self.version = version
+            # nothing is kept
+            self._write(self.index.iloc[:0], vectors[:0], np.arange(0))
+            self.load()
+
+        rows = self.find(df)
+        old = rows >= 0
+        if old.any():
+            # overwritten in place; the file is reopened for writing only for that
+            matrix = np.load(self.vectors_file, mmap_mode="r+")
+            matrix[rows[old]] = vectors[old]
+            matrix.flush()
+            del matrix
+            self.index.loc[rows[old], "content_hash"] = df["content_hash"].values[old]
+        if (~old).any():
+            index = pd.concat(
+                [self.index, df.loc[~old, ["dbname", "page_id", "content_hash"]]],
+                ignore_index=True,
+            )
+            self._write(index, vectors[~old])
+        else:
+            self._write_index(self.index)
+        self.load()
+
+    def retain(self, df):
+        """
+        Removes the modules, which are not in df, from the store.
+
+        :param df: DataFrame with columns dbname, page_id of all the modules, which should be kept.
+        :return: None
+        """
+        keep = np.zeros(len(self), dtype=bool)
+        rows = self.find(df)
+        keep[rows[rows >= 0]] = True
+        if keep.all():
+            return
+        self._write(self.index[keep].reset_index(drop=True), None, np.flatnonzero(keep))
+        self.load()
+
+    def _write_index(self, index):
+        data = np.empty(len(index), dtype=INDEX_DTYPE)
+        data["dbname"] = [dbname.encode("utf8") for dbname in index["dbname"]]
+        data["page_id"] = index["page_id"].values
+        data["content_hash"] = [h.encode("ascii") for h in index["content_hash"]]
+
+        def write_data(tmp):
+            with open(tmp, "wb") as file:
+                np.save(file, data)
+
+        def write_meta(tmp):
+            with open(tmp, "w") as file:
+                json.dump({"version": self.version}, file)
+
+        self._replace(self.index_file, write_data)
+        self._replace(self.meta_file, write_meta)
+
+    def _write(self, index, new_vectors, kept_rows=None):
+        """
+        Writes a new matrix: the kept rows of the current one (all of them by default), then new_vectors.
+        Rows are copied chunk by chunk, so the whole matrix is never loaded into memory.
+        """
+        if kept_rows is None:
+            kept_rows = np.arange(len(self))
+        dim = new_vectors.shape[1] if new_vectors is not None else self.vectors.shape[1]
+        n_new = len(new_vectors) if new_vectors is not None else 0
+
+        def write(tmp):
+            matrix = np.lib.format.open_memmap(
+                tmp, mode="w+", dtype=np.float32, shape=(len(kept_rows) + n_new, dim)
+            )
+            for start in range(0, len(kept_rows), COPY_CHUNK):
+                chunk = kept_rows[start : start + COPY_CHUNK]
+                matrix[start : start + len(chunk)] = self.vectors[chunk]
+            if n_new:
+                matrix[len(kept_rows) :] = new_vectors
+            matrix.flush()
+            del matrix
+
+        self._replace(self.vectors_file, write)
+        self._write_index(index)
+
+    @staticmethod
+    def _replace(path, write):
+        """Writes the file under a temporary name and then replaces the old one, so readers never see it half-written."""
+        tmp = path + ".tmp"
+        write(tmp)
+        os.replace(tmp, path)
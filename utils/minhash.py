@@ -0,0 +1,160 @@
+import zlib
+
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+
+from utils.dependency_graph import unique_edges
+
+NUM_PERM = 128  # hash functions in a signature
+# LSH bands of NUM_PERM // BANDS rows: pairs with Jaccard above ~(1 / BANDS) ** (BANDS / NUM_PERM),
+# 0.71 for 16 bands of 8 rows, most likely share a band
+BANDS = 16
+SHINGLE_SIZE = 5  # tokens in a shingle
+MAX_BUCKET = 50  # sourcecodes in an LSH bucket, above which only the neighbours in the bucket are paired
+PAIRS_CHUNK = 100000  # pairs compared at once
+
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def make_permutations(num_perm=NUM_PERM, seed=1):
+    """
+    Draws the hash functions of MinHash: multiply-shift hashing (a * x + b) mod 2 ** 64 >> 32
+    of 32-bit shingle hashes, which needs no modulo. The same seed gives the same functions
+    in every process, so signatures, computed in different processes or runs, are comparable.
+
+    :param num_perm: number of the functions.
+    :param seed: seed of the random generator.
+    :return: (a, b) uint64 arrays
+    """
+    rng = np.random.RandomState(seed)
+    a = rng.randint(0, 1 << 63, size=num_perm, dtype=np.uint64) * np.uint64(
+        2
+    ) + np.uint64(1)
+    b = rng.randint(0, 1 << 63, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+PERMUTATIONS = make_permutations()
+
+
+def shingle_hashes(tokens, size=SHINGLE_SIZE):
+    """
+    Hashes every run of size consecutive tokens into 32 bits: tokens are hashed with crc32,
+    and the hashes of the runs are combined from the hashes of the tokens with numpy.
+
+    :param tokens: list of str.
+    :param size: number of tokens in a shingle; documents shorter than that are one shingle.
+    :return: uint64 numpy array of distinct hashes (empty for no tokens)
+    """
+    if not tokens:
+        return np.zeros(0, dtype=np.uint64)
+    token_hashes = np.fromiter(
+        (zlib.crc32(token.encode("utf8")) for token in tokens),
+        dtype=np.uint64,
+        count=len(tokens),
+    )
+    size = min(size, len(token_hashes))
+    hashes = np.zeros(len(token_hashes) - size + 1, dtype=np.uint64)
+    for i in range(size):
+        # polynomial hash, overflowing uint64 on purpose
+        hashes = hashes * np.uint64(1000003) + token_hashes[i : len(hashes) + i]
+    return np.unique((hashes >> np.uint64(32)) ^ (hashes & MAX_HASH))
+
+
+def get_signature(tokens, permutations=PERMUTATIONS, size=SHINGLE_SIZE):
+    """
+    Computes MinHash signature of the set of shingles of the tokens: the minimum of every hash function.
+    Share of equal values in signatures of two documents estimates Jaccard similarity of their shingles.
+
+    :param tokens: list of str.
+    :param permutations: hash functions, see make_permutations.
+    :param size: number of tokens in a shingle.
+    :return: uint32 numpy array of len(permutations[0]) values, all MAX_HASH for no tokens
+    """
+    a, b = permutations
+    hashes = shingle_hashes(tokens, size)
+    if not len(hashes):
+        return np.full(len(a), MAX_HASH, dtype=np.uint32)
+    # overflowing uint64 on purpose; computed in place, as it's the most time-consuming part
+    values = np.multiply.outer(a, hashes)
+    values += b[:, None]
+    values >>= np.uint64(32)
+    return values.min(axis=1).astype(np.uint32)
+
+
+def get_candidate_pairs(signatures, bands=BANDS, max_bucket=MAX_BUCKET):
+    """
+    Finds pairs of signatures, which are equal in at least one band (LSH banding).
+    In big buckets (like of the tiniest modules) only the neighbours in sorted order are paired,
+    so the number of pairs stays linear; such buckets are still connected.
+
+    :param signatures: uint32 matrix, signature per row.
+    :param bands: number of bands, should divide the length of signatures.
+    :param max_bucket: size of a bucket, above which only the neighbours are paired.
+    :return: (first, second) int64 arrays of rows, first < second, every pair once
+    """
+    n, num_perm = signatures.shape
+    rows = num_perm // bands
+    multipliers = np.random.RandomState(0).randint(
+        1, 1 << 62, size=rows, dtype=np.uint64
+    )
+    first, second = [], []
+    for band in range(bands):
+        # hash of the band's values; colliding hashes just add candidates, which are verified later
+        keys = (
+            signatures[:, band * rows : (band + 1) * rows].astype(np.uint64)
+            * multipliers
+        ).sum(axis=1)
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        sizes = np.diff(np.r_[starts, n])
+
+        # neighbours in every bucket
+        same = keys[1:] == keys[:-1]
+        first.append(order[:-1][same])
+        second.append(order[1:][same])
+        # all the other pairs of the small buckets, for buckets of every size at once
+        for size in range(3, max_bucket + 1):
+            bucket_starts = starts[sizes == size]
+            if len(bucket_starts):
+                i, j = np.triu_indices(size, 2)
+                first.append(order[bucket_starts[:, None] + i].ravel())
+                second.append(order[bucket_starts[:, None] + j].ravel())
+
+    if not first:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    first, second = np.concatenate(first), np.concatenate(second)
+    return unique_edges(np.minimum(first, second), np.maximum(first, second), n)
+
+
+def estimate_jaccard(signatures, first, second):
+    """
+    :param signatures: uint32 matrix, signature per row.
+    :param first: rows of the first signatures of the pairs.
+    :param second: rows of the second signatures of the pairs.
+    :return: float numpy array of estimated Jaccard similarity of every pair
+    """
+    jaccard = np.empty(len(first))
+    for i in range(0, len(first), PAIRS_CHUNK):
+        chunk = slice(i, i + PAIRS_CHUNK)
+        jaccard[chunk] = (signatures[first[chunk]] == signatures[second[chunk]]).mean(
+            axis=1
+        )
+    return jaccard
+
+
+def group_pairs(n, first, second):
+    """
+    Groups rows connected by the pairs.
+
+    :param n: number of rows.
+    :param first: first rows of the pairs.
+    :param second: second rows of the pairs.
+    :return: numpy array of group number of every row
+    """
+    graph = csr_matrix(
+        (np.ones(len(first), dtype=np.int8), (first, second)), shape=(n, n)
+    )
+    return connected_components(graph, directed=False)[1]
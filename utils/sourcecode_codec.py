@@ -0,0 +1,87 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Encoded sourcecode is the header (MAGIC + codec id) followed by the compressed utf8 content.
+# Plain sourcecodes are stored as utf8 without a header; Lua code never starts with a zero byte,
+# so they can't be confused with the encoded ones.
+MAGIC = b"\x00"
+CODEC_IDS = {"zlib": b"z", "zstd": b"s"}
+CODEC_NAMES = {codec_id: name for name, codec_id in CODEC_IDS.items()}
+# codec used for writing sourcecodes, unless the writer is told otherwise (fetch_content.py --codec);
+# "plain" stores them uncompressed
+DEFAULT_CODEC = "plain"
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def available_codecs():
+    """
+    :return: list of codecs usable in this environment
+    """
+    codecs = ["plain", "zlib"]
+    if zstandard is not None:
+        codecs.append("zstd")
+    return codecs
+
+
+def encode(sourcecode, codec=DEFAULT_CODEC):
+    """
+    Encodes sourcecode for storing in Sourcecodes table.
+
+    :param sourcecode: Sourcecode of the module.
+    :param codec: "plain", "zlib" or "zstd"; zstd requires zstandard package.
+    :return: bytes
+    """
+    data = sourcecode.encode("utf8")
+    if codec == "plain":
+        return data
+    if codec == "zlib":
+        payload = zlib.compress(data, ZLIB_LEVEL)
+    elif codec == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd codec requires zstandard package")
+        payload = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    else:
+        raise ValueError("Unknown codec: %s" % codec)
+    return MAGIC + CODEC_IDS[codec] + payload
+
+
+def decode(data, maxlen=None):
+    """
+    Decodes sourcecode, stored in Sourcecodes table, in any of the formats.
+
+    :param data: Stored value: bytes, str (for tables with TEXT column) or None.
+    :param maxlen: The length to which the sourcecode should be truncated, if needed.
+    :return: str, or None if data is None
+    """
+    if data is None:
+        return None
+    if isinstance(data, str):
+        return data[:maxlen]
+
+    if data[:1] == MAGIC:
+        codec = CODEC_NAMES.get(data[1:2])
+        if codec == "zlib":
+            data = zlib.decompress(data[2:])
+        elif codec == "zstd":
+            if zstandard is None:
+                raise ValueError("zstd codec requires zstandard package")
+            data = zstandard.ZstdDecompressor().decompress(data[2:])
+        else:
+            raise ValueError("Unknown codec id: %r" % data[1:2])
+    return data.decode("utf8")[:maxlen]
+
+
+def decode_column(values, maxlen=None):
+    """
+    Decodes a column of stored sourcecodes.
+
+    :param values: Iterable of stored values.
+    :param maxlen: The length to which the sourcecodes should be truncated, if needed.
+    :return: list of str
+    """
+    return [decode(value, maxlen) for value in values]
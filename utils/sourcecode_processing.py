@@ -1,5 +1,72 @@
 import re
 
+# Every alternative either matches in one pass or ends at the end of the code,
+# so tokenizing never backtracks over the already scanned part: the whole scan is linear.
+# Unterminated strings end at the end of the line, unterminated long brackets - at the end of the code.
+# Whitespace before a token is matched together with it; trailing whitespace is cut off by endpos,
+# so it isn't rescanned from every position.
+TOKEN_PATTERN = re.compile(
+    r"\s*(?:"
+    r"(?P<comment>--(?:\[(?P<clevel>=*)\[[\s\S]*?(?:\](?P=clevel)\]|\Z)|[^\n]*))|"
+    r"(?P<string>\[(?P<slevel>=*)\[[\s\S]*?(?:\](?P=slevel)\]|\Z)|"
+    r"\"(?:[^\"\\\n]+|\\z\s*|\\[\s\S])*\"?|"
+    r"'(?:[^'\\\n]+|\\z\s*|\\[\s\S])*'?)|"
+    r"(?P<number>0[xX](?:[0-9a-fA-F]+\.?[0-9a-fA-F]*|\.[0-9a-fA-F]+)(?:[pP][+-]?\d+)?|"
+    r"(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)|"
+    r"(?P<name>[^\W\d]\w*)|"
+    r"(?P<op>\.\.\.|\.\.|==|~=|<=|>=|//|::|<<|>>|[^\w\s])"
+    r")"
+)
+WORD_PATTERN = re.compile(r"(?u)\w+|[^\w\s]")
+LONG_BRACKET_PATTERN = re.compile(r"^\[(=*)\[\n?([\s\S]*?)(?:\]\1\])?$")
+
+BRANCH_KEYWORDS = {"if", "elseif", "while", "for", "repeat", "and", "or"}
+LITERAL_NAMES = {"true", "false", "nil"}
+TABLE_OPS = {"{", "}", "[", "]", "=", ",", ";"}
+LOADERS = {
+    "require",
+    "loadData",
+    "loadJsonData",
+}  # require and mw.loadData/mw.loadJsonData
+FEATURES = [
+    "function_count",
+    "dependencies",
+    "exported_keys",
+    "token_count",
+    "branching",
+    "data_share",
+]
+
+
+def iter_tokens(code):
+    """
+    Splits Lua sourcecode into tokens in a single pass; whitespace is skipped.
+    Kinds of tokens: "comment", "string" (including long brackets [==[ ]==] of any level),
+    "number", "name" (identifiers and keywords) and "op".
+
+    @param code: string, containing sourcecode.
+    @return: generator of (kind, start, end) tuples, where code[start:end] is the token
+    """
+    for match in TOKEN_PATTERN.finditer(code, 0, len(code.rstrip())):
+        kind = match.lastgroup
+        yield kind, match.start(kind), match.end()
+
+
+def tokenize(code, comments=False):
+    """
+    Splits Lua sourcecode into tokens, see iter_tokens.
+
+    @param code: string, containing sourcecode.
+    @param comments: whether to keep comment tokens.
+    @return: list of (kind, text) tuples
+    """
+    tokens = []
+    for match in TOKEN_PATTERN.finditer(code, 0, len(code.rstrip())):
+        kind = match.lastgroup
+        if comments or kind != "comment":
+            tokens.append((kind, match.group(kind)))
+    return tokens
+
 
 def remove_comments(code):
     """
@@ -10,15 +77,186 @@ def remove_comments(code):
     @param code: string, containing sourcecode which should be processed.
     @return: string withe sourcecode without any comments and tabulations
     """
-    no_comments_code = re.sub(r"--\[\[[\s\S]*\]\]|"          # multi-line comments like --[[ comment ]]
-                              r"--\[=\[[\s\S]*\]=\]|"        # multi-line comments like --[=[ comment ]=]
-                              "--.*",                       # single-line comments like -- comment
-                              "", code)
-    cleaned_code = re.sub(r"^\s*", "", no_comments_code, flags=re.MULTILINE)
+    pieces = []
+    position = 0
+    for kind, start, end in iter_tokens(code):
+        if kind == "comment":
+            pieces.append(code[position:start])
+            position = end
+    pieces.append(code[position:])
+    cleaned_code = re.sub(r"^\s*", "", "".join(pieces), flags=re.MULTILINE)
 
     return cleaned_code
 
 
+def get_words(tokens):
+    """
+    Splits tokens into words for similarity detection: names, numbers and operators are kept whole,
+    strings are split into the quotes and the words inside, comments are dropped.
+
+    @param tokens: list of (kind, text) tuples, see tokenize.
+    @return: list of words
+    """
+    words = []
+    for kind, text in tokens:
+        if kind == "string":
+            words.extend(WORD_PATTERN.findall(text))
+        elif kind != "comment":
+            words.append(text)
+    return words
+
+
+def preprocess_text(document, lexer=False):
+    """
+    Tokenizes a string of sourcecode into a list of tokens.
+
+    @param document: A string of sourcecode.
+    @param lexer: Whether to use Lua lexer, which drops comments and keeps operators and numbers whole.
+    @return: List of tokens.
+    """
+    if lexer:
+        return get_words(tokenize(document))
+    return WORD_PATTERN.findall(document)
+
+
+def get_string_value(text):
+    """
+    Returns the contents of a string literal; escape sequences are left as they are.
+
+    @param text: string token, e.g. "Module:Arguments" or [[Module:Arguments]].
+    @return: string
+    """
+    match = LONG_BRACKET_PATTERN.match(text)
+    if match:
+        return match.group(2)
+    return text[1:-1] if len(text) > 1 and text[-1] == text[0] else text[1:]
+
+
+def get_features(code):
+    """
+    Calculates static metrics of the module in one pass over its tokens:
+    - function_count: number of defined functions;
+    - dependencies: number of distinct modules loaded with require, mw.loadData or mw.loadJsonData;
+    - exported_keys: number of keys of the returned table (`return {...}` or `return p`);
+    - token_count: number of tokens, not counting comments;
+    - branching: cyclomatic-ish complexity, 1 + number of conditions and loops;
+    - data_share: share of characters of the tokens, which are literals, table keys or table punctuation.
+
+    @param code: sourcecode of the module, or list of its tokens from tokenize.
+    @return: dictionary with the metrics, and names of the loaded modules under "required"
+    """
+    tokens = tokenize(code) if isinstance(code, str) else code
+    tokens = [token for token in tokens if token[0] != "comment"]
+    n = len(tokens)
+
+    functions = 0
+    branching = 1
+    chars = 0
+    data_chars = 0
+    required = set()
+    # table name -> keys assigned to it, like p.key = ... or function p.key()
+    assigned = {}
+    depth = 0
+    owner = None  # table, which constructor is being read, like p = {...}, or "return"
+    owner_depth = None
+    returned = None
+
+    for i, (kind, text) in enumerate(tokens):
+        chars += len(text)
+        if kind == "string" or kind == "number":
+            data_chars += len(text)
+        elif kind == "name":
+            if text in LITERAL_NAMES:
+                data_chars += len(text)
+            elif text == "function":
+                functions += 1
+            elif text in BRANCH_KEYWORDS:
+                branching += 1
+            elif text in LOADERS and (
+                text == "require"
+                or (
+                    i >= 2
+                    and tokens[i - 1] == ("op", ".")
+                    and tokens[i - 2] == ("name", "mw")
+                )
+            ):
+                j = i + 2 if i + 1 < n and tokens[i + 1] == ("op", "(") else i + 1
+                if j < n and tokens[j][0] == "string":
+                    required.add(get_string_value(tokens[j][1]))
+            elif text == "return" and i + 2 == n and tokens[i + 1][0] == "name":
+                returned = tokens[i + 1][1]
+
+            # p.key = ..., function p.key(...), function p:key(...)
+            if (
+                i >= 2
+                and tokens[i - 1] in (("op", "."), ("op", ":"))
+                and tokens[i - 2][0] == "name"
+            ):
+                if (i + 1 < n and tokens[i + 1] == ("op", "=")) or (
+                    i >= 3 and tokens[i - 3] == ("name", "function")
+                ):
+                    assigned.setdefault(tokens[i - 2][1], set()).add(text)
+        elif text == "{":
+            depth += 1
+            if owner is None and i >= 1:
+                if tokens[i - 1] == ("name", "return"):
+                    owner = "return"
+                elif (
+                    depth == 1
+                    and i >= 2
+                    and tokens[i - 1] == ("op", "=")
+                    and tokens[i - 2][0] == "name"
+                ):
+                    owner = tokens[i - 2][1]
+                if owner is not None:
+                    owner_depth = depth
+                    assigned[owner] = set()
+        elif text == "}":
+            if depth == owner_depth:
+                owner = owner_depth = None
+            depth = max(depth - 1, 0)
+        elif text == "=" and i >= 1:
+            key = None
+            if tokens[i - 1][0] == "name":
+                key = tokens[i - 1][1]
+                if depth > 0:
+                    # key of a table constructor
+                    data_chars += len(key)
+            elif (
+                tokens[i - 1] == ("op", "]") and i >= 3 and tokens[i - 2][0] == "string"
+            ):
+                key = get_string_value(tokens[i - 2][1])
+                if (
+                    i >= 4
+                    and tokens[i - 3] == ("op", "[")
+                    and tokens[i - 4][0] == "name"
+                    and depth == 0
+                ):
+                    # p["key"] = ...
+                    assigned.setdefault(tokens[i - 4][1], set()).add(key)
+            if owner is not None and depth == owner_depth and key is not None:
+                assigned[owner].add(key)
+
+        if kind == "op" and text in TABLE_OPS and (depth > 0 or text == "}"):
+            # punctuation of table constructors
+            data_chars += len(text)
+
+    if owner == "return" or (returned is None and "return" in assigned):
+        exported = assigned.get("return", set())
+    else:
+        exported = assigned.get(returned, set())
+
+    return {
+        "function_count": functions,
+        "dependencies": len(required),
+        "exported_keys": len(exported),
+        "token_count": n,
+        "branching": branching,
+        "data_share": data_chars / chars if chars else 0.0,
+        "required": sorted(required),
+    }
+
+
 def check_if_data_function(code):
     """
     Checks if the function is believed to be a data function, meaning it is used only for storing
@@ -26,10 +264,18 @@ def check_if_data_function(code):
     For now, data function is the function, which consists only of `return {data` statement.
     (there's not always an ending bracket; it might be a bug, but semantically they still contain data).
 
-    @param code: sourcecode of the function (with no comments)
+    @param code: sourcecode of the function, or list of its tokens from tokenize, to not tokenize it again.
     @return: True/False
     """
-    if re.match(r"^return\s*{[\s\S]*$", code):
-        return True
+    if isinstance(code, str):
+        # only the first tokens matter, so the rest of the code isn't tokenized
+        tokens = ((kind, code[start:end]) for kind, start, end in iter_tokens(code))
     else:
-        return False
+        tokens = code
+    first = []
+    for token in tokens:
+        if token[0] != "comment":
+            first.append(token)
+            if len(first) == 2:
+                break
+    return first == [("name", "return"), ("op", "{")]
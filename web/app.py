@@ -3,6 +3,7 @@ from flask import Flask, jsonify, request, send_from_directory
 from flask_cors import CORS
 
 from server_utils.database_connections import *
+from server_utils.similarity import get_similar_modules
 from server_utils.scores_processing import get_score, filter_data_modules,\
     filter_families_with_linkage, filter_languages_with_linkage
 
@@ -61,6 +62,26 @@ def get_single_script_data(wiki, id):
         })
 
 
+# api for serving modules with the closest embeddings to the script, across all wikis
+@app.route('/api/<wiki>/<id>/similar')
+def get_similar_scripts_data(wiki, id):
+    k = min(request.args.get('k', 10, type=int), 100)
+    df = get_similar_modules(wiki, id, k)
+
+    if df is None:
+        return jsonify({
+            'status': 'NotFound',
+        })
+    else:
+        titled = add_scripts_titles(df)
+        if titled is not None:
+            df = titled
+        return jsonify({
+            'status': 'success',
+            'data': df.to_json(orient='index'),
+        })
+
+
 # api for serving ranking of script pages
 @app.route('/api/data', methods=['GET'])
 def get_requested_data():
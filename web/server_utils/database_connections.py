@@ -1,3 +1,4 @@
+import zlib
 import pymysql
 import toolforge
 import yaml
@@ -6,6 +7,11 @@ import numpy as np
 
 from server_utils.save_for_client import save_column_to_json
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 # for successfully establishing connection to the databases, write your username, password
 # and user's database name into config.yml
 with open("config.yml", 'r') as ymlfile:
@@ -22,6 +28,41 @@ def encode_if_necessary(b):
     return b
 
 
+# duplicated from utils to avoid copying utils folder
+def decode_sourcecode(data):
+    """
+    Decodes sourcecode, stored in Sourcecodes table: either plain utf8,
+    or b"\\x00" + codec id (b"z" for zlib, b"s" for zstd) + compressed utf8.
+    :param data: stored value.
+    :return: str.
+    """
+    if data is None or isinstance(data, str):
+        return data
+    if data[:2] == b"\x00z":
+        data = zlib.decompress(data[2:])
+    elif data[:2] == b"\x00s":
+        data = zstandard.ZstdDecompressor().decompress(data[2:])
+    return data.decode("utf8")
+
+
+# duplicated from utils to avoid copying utils folder
+def rows_to_dataframe(rows, cols, text_cols):
+    """
+    Builds dataframe from the rows returned by pymysql, decoding only the text columns.
+    :param rows: sequence of rows, as returned by cursor.fetchall().
+    :param cols: the name of the columns to be used in dataframe.
+    :param text_cols: names of the columns to decode from bytes into str.
+    :return: pandas.DataFrame.
+    """
+    df = pd.DataFrame(rows, columns=cols)
+    for col in text_cols:
+        df[col] = [
+            value.decode("utf8") if type(value) is bytes else value
+            for value in df[col].values
+        ]
+    return df
+
+
 # duplicated from utils to avoid copying utils folder
 def connect_to_user_database(user_db_port=None):
     """
@@ -128,6 +169,7 @@ def get_sourcecode_from_database(dbname, page_id, user_db_port=None):
     query = (
         "select dbname, page_id, title, sourcecode, cluster "
         "from Scripts "
+        "left join Sourcecodes on Sourcecodes.content_hash = Scripts.content_hash "
         "where dbname = %s and page_id = %s"
     )
     cols = ["dbname", "pageid", "title", "sourcecode", "cluster"]
@@ -138,8 +180,10 @@ def get_sourcecode_from_database(dbname, page_id, user_db_port=None):
             cur.execute(query, (dbname, page_id))
             res = cur.fetchall()
             if res:
+                row = list(res[0])
+                row[3] = decode_sourcecode(row[3])
                 df = pd.Series(
-                    res[0],
+                    row,
                     index=cols,
                 ).map(encode_if_necessary)
 
@@ -173,10 +217,7 @@ def get_close_sourcecodes(dbname, page_id, cluster, user_db_port=None, eps=0):
             cur.execute(query, (cluster + eps, cluster - eps))
             res = cur.fetchall()
             if res:
-                df = pd.DataFrame(
-                    res,
-                    columns=cols,
-                ).applymap(encode_if_necessary)
+                df = rows_to_dataframe(res, cols, ["dbname", "title"])
                 curr_index = df[(df['dbname'] == dbname) & (df['pageid'] == int(page_id))].index
                 df.drop(curr_index, inplace=True)
 
@@ -207,11 +248,36 @@ def get_scripts_titles(df, user_db_port=None):
                     query, [elem["page_id"], elem["dbname"]]
                 )
                 res.append(cur.fetchall()[0])
-        df = pd.DataFrame(
-            res,
-            columns=cols
-        ).applymap(encode_if_necessary)
+        df = rows_to_dataframe(res, cols, ["dbname", "title"])
+
+        return df
+    except Exception as err:
+        print("Something went wrong. ", repr(err))
 
+
+def add_scripts_titles(df, user_db_port=None):
+    """
+    Adds page titles to the scripts, whose info is stored into the dataframe, fetching them with a single query.
+    :param df: pandas.DataFrame, containing page IDs (pageid) and dbnames for scripts we want the titles of.
+    :param user_db_port: port for connecting to db through ssh tunneling, if used.
+    :return: pandas.DataFrame with title column, in the same order.
+    """
+    if df.empty:
+        df['title'] = []
         return df
+    query = (
+        "select dbname, page_id, title "
+        "from Scripts "
+        "where (dbname, page_id) in (" + ", ".join(["(%s, %s)"] * len(df)) + ")"
+    )
+    try:
+        conn = connect_to_user_database(user_db_port)
+        with conn.cursor() as cur:
+            cur.execute(
+                query,
+                [value for key in df[['dbname', 'pageid']].values.tolist() for value in key],
+            )
+            titles = rows_to_dataframe(cur.fetchall(), ["dbname", "pageid", "title"], ["dbname", "title"])
+        return df.merge(titles, on=['dbname', 'pageid'], how='left')
     except Exception as err:
         print("Something went wrong. ", repr(err))
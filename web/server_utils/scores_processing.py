@@ -51,8 +51,14 @@ def get_score(
         "major_edits_norm_score",
         "pls_norm_score",
         "transcluded_in_norm_score",
+        "function_count_score",
+        "dependencies_score",
+        "exported_keys_score",
+        "token_count_score",
+        "branching_score",
+        "data_share_score",
     ],
-    weights=[1, 1, 0.1, 5, 2, 5, 2, 8],
+    weights=[1, 1, 0.1, 5, 2, 5, 2, 8, 0, 0, 0, 0, 0, 0],
 ):
     """
     Returns dataframe with scores of each module in the 'score' column.
@@ -67,5 +73,6 @@ def get_score(
         sys.exit("Number of features is not equal to the number of weights!")
     df = pd.read_csv(csv_address)
     weights = [w / sum(weights) for w in weights]           # Normalize weights
-    df["score"] = df[feature_names].dot(weights)
+    # features, missing from a csv file generated before they were added, don't add to the score
+    df["score"] = df.reindex(columns=feature_names, fill_value=0).dot(weights)
     return df.sort_values(by=["score"], ascending=False)
\ No newline at end of file
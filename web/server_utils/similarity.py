@@ -0,0 +1,129 @@
+import os
+import heapq
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+SEARCH_FACTOR = 50
+
+# the index is reloaded only after detect_similarity rebuilds it
+_loaded = {}
+
+
+# duplicated from utils to avoid copying utils folder (see utils/embedding_store.py and utils/ann_index.py)
+def normalize(vectors):
+    """
+    Scales vectors to unit length; zero vectors stay zero.
+    :param vectors: matrix, vector per row.
+    :return: float32 numpy matrix.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+
+def load_similarity_index(path):
+    """
+    Opens embeddings store of the modules, saved by detect_similarity, and the nearest-neighbour index over it.
+    :param path: path of the store files without extension.
+    :return: dict with the store and the index, or None if they are missing or out of date.
+    """
+    index_file = path + '.ann.npz'
+    try:
+        mtime = os.path.getmtime(index_file)
+    except OSError:
+        return None
+    if path in _loaded and _loaded[path]['mtime'] == mtime:
+        return _loaded[path]
+
+    try:
+        with np.load(index_file) as data:
+            loaded = {key: data[key] for key in data.files}
+        vectors = np.load(path + '.npy', mmap_mode='r')
+        rows = np.load(path + '.index.npy')
+    except (OSError, ValueError):
+        return None
+    if loaded['meta_rows'].item() != len(rows) or len(rows) != len(vectors):
+        return None
+
+    loaded['mtime'] = mtime
+    loaded['vectors'] = vectors
+    loaded['modules'] = pd.DataFrame({
+        'dbname': np.char.decode(rows['dbname'], 'utf8').astype(object),
+        'pageid': rows['page_id'].astype(np.int64),
+    })
+    loaded['rows'] = pd.Series(
+        np.arange(len(rows)),
+        index=pd.MultiIndex.from_arrays([loaded['modules']['dbname'], loaded['modules']['pageid']]),
+    )
+    _loaded[path] = loaded
+    return loaded
+
+
+def query_similarity_index(loaded, row, k, search_k):
+    """
+    Finds approximately k nearest neighbours of the module by cosine distance of the embeddings,
+    descending all the trees of the random-projection forest at once.
+    :param loaded: dict, returned by load_similarity_index.
+    :param row: row of the module in the store.
+    :param k: number of neighbours.
+    :param search_k: number of candidates, compared exactly.
+    :return: (rows, distances) numpy arrays, sorted by distance.
+    """
+    normals, offsets, children = loaded['normals'], loaded['offsets'], loaded['children']
+    leaf_bounds, leaf_items = loaded['leaf_bounds'], loaded['leaf_items']
+    vector = normalize(loaded['vectors'][row:row + 1])[0]
+
+    heap = [(-np.inf, root) for root in loaded['roots']]
+    found = []
+    count = 0
+    while heap and count < search_k:
+        priority, node = heapq.heappop(heap)
+        if node < 0:
+            items = leaf_items[leaf_bounds[-1 - node]:leaf_bounds[-node]]
+            found.append(items)
+            count += len(items)
+            continue
+        margin = float(normals[node].dot(vector) + offsets[node])
+        left, right = children[node]
+        heapq.heappush(heap, (max(priority, -margin), int(right)))
+        heapq.heappush(heap, (max(priority, margin), int(left)))
+
+    rows = np.unique(np.concatenate(found)) if found else np.zeros(0, np.int64)
+    rows = rows[rows != row]
+    distances = 1 - normalize(loaded['vectors'][rows]).dot(vector)
+    order = np.argsort(distances, kind='stable')[:k]
+    return rows[order], distances[order]
+
+
+def get_similar_modules(
+    dbname,
+    page_id,
+    k=10,
+    path=str(Path.home()) + '/abstract-wikipedia-data-science/WE_embeddings',
+):
+    """
+    Finds modules across all wikis, whose embeddings are the closest to the embedding of the given module,
+    regardless of the clusters they were put in.
+    :param dbname: name of the database, from which the processed script was fetched.
+    :param page_id: page ID of this page on this database.
+    :param k: number of modules to return.
+    :param path: path of the embeddings store of detect_similarity, without extension.
+    :return: pandas.DataFrame with columns dbname, pageid, distance, or None if the module isn't indexed
+    (or page_id isn't a number).
+    """
+    loaded = load_similarity_index(path)
+    if loaded is None:
+        return None
+    try:
+        page_id = int(page_id)
+    except ValueError:
+        return None
+    row = loaded['rows'].get((dbname, page_id))
+    if row is None:
+        return None
+    rows, distances = query_similarity_index(loaded, row, k, k * SEARCH_FACTOR)
+    df = loaded['modules'].iloc[rows].reset_index(drop=True)
+    df['distance'] = distances
+    return df